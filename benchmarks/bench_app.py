@@ -0,0 +1,168 @@
+"""
+End-to-end benchmark of the bot with a fake LLM and a fake Telegram transport
+
+Every simulated user randomizes a story, tweaks the settings and continues it
+to the end. No network is used, so it runs in CI.
+
+python -m benchmarks.bench_app --users 1000 --latency 0.5 --tokens-per-second 50
+"""
+
+import argparse
+import asyncio
+import random
+import resource
+import sys
+import time
+import tracemalloc
+from collections import defaultdict
+
+from fairytale_bot import rate_limit
+from fairytale_bot.fairytale_settings import FairytaleSettingsHandler
+from fairytale_bot.fake_llm import FakeGptPlugin
+from fairytale_bot.lib import MainApp, MainHandler
+from fairytale_bot.user_settings import UserSettingsHandler
+
+from benchmarks.fake_telegram import FakeBot, FakeMessage, FakeTransport, FakeUser
+
+
+class BenchmarkApp(MainApp):
+    # don't let the per-user limits stop the simulated users
+    DEFAULT_USER_LIMIT = PREMIUM_USER_LIMIT = 10**9
+    DEFAULT_USER_REQUESTS_PER_MINUTE = PREMIUM_USER_REQUESTS_PER_MINUTE = 10**9
+    # the fake transport has no flood limits
+    PACE_TELEGRAM_SENDS = False
+
+
+def get_memory() -> int:
+    """
+    Python allocations if tracemalloc is on, otherwise the peak RSS, in bytes
+    """
+    if tracemalloc.is_tracing():
+        return tracemalloc.get_traced_memory()[0]
+    max_rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # kilobytes on linux, bytes on macos
+    return max_rss if sys.platform == "darwin" else max_rss * 1024
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))] if values else 0.0
+
+
+async def simulate_user(i, app, handlers, transport, latencies, premium_share):
+    main_handler, user_settings_handler, settings_handler = handlers
+    user = FakeUser(id=i, username=f"user_{i}")
+    bot = FakeBot(transport)
+
+    def message(text):
+        return FakeMessage(transport, chat_id=i, user=user, text=text)
+
+    async def command(name, coroutine):
+        start = time.perf_counter()
+        try:
+            await coroutine
+        except Exception:
+            # the real dispatcher logs and drops failed updates too
+            latencies[f"{name} (failed)"].append(time.perf_counter() - start)
+            return
+        latencies[name].append(time.perf_counter() - start)
+
+    # spread the users over the first second
+    await asyncio.sleep(random.random())
+    if random.random() < premium_share:
+        await command(
+            "upgrade", user_settings_handler.upgrade_handler(message("/upgrade"), app)
+        )
+    await command(
+        "randomize", main_handler.randomize_handler(message("/randomize"), app, bot)
+    )
+    await command(
+        "set_random_author",
+        settings_handler.set_random_author(message("/set_random_author"), app),
+    )
+    while app.story_stages[user.username] < len(
+        app.story_structures[user.username]["all_parts"]
+    ):
+        stage = app.story_stages[user.username]
+        await command(
+            "continue",
+            main_handler.generate_next_story_part_handler(
+                message("/continue"), app, bot
+            ),
+        )
+        if app.story_stages[user.username] == stage:
+            break  # failed, don't retry forever
+
+
+async def run(args):
+    if args.no_model_rate_limit:
+        for model in (MainApp.DEFAULT_MODEL, MainApp.PREMIUM_MODEL):
+            rate_limit.MODEL_RATE_LIMITS[model] = (10**9, 10**12)
+
+    fake_gpt = FakeGptPlugin(
+        latency=args.latency,
+        tokens_per_second=args.tokens_per_second,
+        error_rate=args.error_rate,
+    )
+    app = BenchmarkApp()
+    app.gpt = fake_gpt
+    app.PREFETCH_STORY_PARTS = args.prefetch
+    handlers = (MainHandler(), UserSettingsHandler(), FairytaleSettingsHandler())
+    transport = FakeTransport()
+    latencies = defaultdict(list)
+
+    if args.tracemalloc:
+        tracemalloc.start()
+    memory_before = get_memory()
+    start = time.perf_counter()
+    await asyncio.gather(
+        *(
+            simulate_user(i, app, handlers, transport, latencies, args.premium_share)
+            for i in range(args.users)
+        )
+    )
+    elapsed = time.perf_counter() - start
+    await app.llm_scheduler.close()
+    memory_per_user = (get_memory() - memory_before) / args.users
+    tracemalloc.stop()
+
+    stories = sum(1 for i in range(args.users) if app.stories[f"user_{i}"])
+    messages = transport.count("message", "edit", "document")
+    print(f"users: {args.users}, elapsed: {elapsed:.1f}s")
+    print(f"messages/sec: {messages / elapsed:.1f} ({messages} sends and edits)")
+    for name, values in latencies.items():
+        print(
+            f"{name:>18}: n={len(values)}"
+            f" p50={percentile(values, 0.5):.3f}s"
+            f" p95={percentile(values, 0.95):.3f}s"
+            f" p99={percentile(values, 0.99):.3f}s"
+        )
+    print(f"memory per user: {memory_per_user / 1024:.1f} KiB")
+    print(f"LLM calls: {fake_gpt.calls}, errors: {fake_gpt.errors}")
+    print(f"LLM calls per story: {fake_gpt.calls / max(stories, 1):.2f}")
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--users", type=int, default=1000)
+    parser.add_argument("--latency", type=float, default=0.5)
+    parser.add_argument("--tokens-per-second", type=float, default=50)
+    parser.add_argument("--error-rate", type=float, default=0.0)
+    parser.add_argument("--premium-share", type=float, default=0.1)
+    parser.add_argument("--prefetch", action="store_true")
+    parser.add_argument(
+        "--tracemalloc",
+        action="store_true",
+        help="measure memory with tracemalloc - exact, but slows everything down",
+    )
+    parser.add_argument(
+        "--no-model-rate-limit",
+        action="store_true",
+        help="measure the bot itself, not the OpenAI quota",
+    )
+    args = parser.parse_args()
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
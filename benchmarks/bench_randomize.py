@@ -0,0 +1,102 @@
+"""
+/randomize with the structure and the first part in one LLM call vs two calls
+
+Every simulated user runs /randomize once, with the structure cache off so
+that each story needs a new structure. Reports the time until the story text
+starts to show, the time until the first part is complete, and the LLM calls
+and tokens per story.
+
+python -m benchmarks.bench_randomize --users 200 --latency 0.5 --tokens-per-second 50
+"""
+
+import argparse
+import asyncio
+import random
+import time
+
+from fairytale_bot import rate_limit
+from fairytale_bot.fake_llm import FakeGptPlugin
+from fairytale_bot.lib import MainApp, MainHandler
+from fairytale_bot.response_cache import ResponseCacheMode
+
+from benchmarks.bench_app import percentile
+from benchmarks.fake_telegram import FakeBot, FakeMessage, FakeTransport, FakeUser
+
+
+class BenchmarkApp(MainApp):
+    DEFAULT_USER_LIMIT = PREMIUM_USER_LIMIT = 10**9
+    DEFAULT_USER_REQUESTS_PER_MINUTE = PREMIUM_USER_REQUESTS_PER_MINUTE = 10**9
+    PACE_TELEGRAM_SENDS = False
+    # every story needs a new structure and new story parts
+    STRUCTURE_CACHE_SIZE = 0
+    DEFAULT_RESPONSE_CACHE = PREMIUM_RESPONSE_CACHE = ResponseCacheMode.OFF
+
+
+def is_story_text(text: str) -> bool:
+    text = text.replace(MainApp.STORY_BEGINNING, "")
+    text = text.replace(MainHandler.CONTINUE_SUFFIX, "")
+    return bool(text.strip()) and "Moral set to" not in text and "..." not in text
+
+
+async def simulate_user(i, app, handler, transport, results):
+    user = FakeUser(id=i, username=f"user_{i}")
+    message = FakeMessage(transport, chat_id=i, user=user, text="/randomize")
+    await asyncio.sleep(random.random())
+    start = time.perf_counter()
+    await handler.randomize_handler(message, app, FakeBot(transport))
+    results.append((i, start, time.perf_counter()))
+
+
+async def run(fused: bool, args):
+    fake_gpt = FakeGptPlugin(
+        latency=args.latency, tokens_per_second=args.tokens_per_second
+    )
+    app = BenchmarkApp()
+    app.gpt = fake_gpt
+    app.FUSE_STRUCTURE_AND_FIRST_PART = fused
+    handler = MainHandler()
+    transport = FakeTransport()
+    results = []
+    await asyncio.gather(
+        *(simulate_user(i, app, handler, transport, results) for i in range(args.users))
+    )
+    await app.llm_scheduler.close()
+
+    first_text = {}
+    for sent_at, kind, chat_id, text in transport.sent:
+        if kind in ("message", "edit") and chat_id not in first_text:
+            if is_story_text(text):
+                first_text[chat_id] = sent_at
+    to_first_text = [first_text[i] - start for i, start, _ in results]
+    to_complete = [end - start for _, start, end in results]
+    stories = sum(1 for i in range(args.users) if app.stories[f"user_{i}"])
+    tokens = sum(app.metrics.prompt_tokens.values.values()) + sum(
+        app.metrics.completion_tokens.values.values()
+    )
+    name = "fused" if fused else "two calls"
+    print(
+        f"{name:>9}: first text p50={percentile(to_first_text, 0.5):.2f}s"
+        f" p95={percentile(to_first_text, 0.95):.2f}s,"
+        f" complete p50={percentile(to_complete, 0.5):.2f}s"
+        f" p95={percentile(to_complete, 0.95):.2f}s,"
+        f" {fake_gpt.calls / max(stories, 1):.2f} LLM calls"
+        f" and {tokens / max(stories, 1):.0f} tokens per story"
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--users", type=int, default=200)
+    parser.add_argument("--latency", type=float, default=0.5)
+    parser.add_argument("--tokens-per-second", type=float, default=50)
+    args = parser.parse_args()
+    # measure the flows, not the OpenAI quota
+    for model in (MainApp.DEFAULT_MODEL, MainApp.PREMIUM_MODEL):
+        rate_limit.MODEL_RATE_LIMITS[model] = (10**9, 10**12)
+
+    for fused in (False, True):
+        asyncio.run(run(fused, args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,135 @@
+"""
+Memory per user of the session objects vs the baseline dict per kind of state
+
+Every simulated user sets up a story and generates a part, a share of them
+upgrades. The story content is shared between the users, so only the
+bookkeeping of the state is measured.
+
+python -m benchmarks.bench_sessions --users 100000
+"""
+
+import argparse
+import gc
+import time
+import tracemalloc
+from collections import defaultdict
+
+from fairytale_bot.session import SessionField, SessionStore, Tier
+from fairytale_bot.storage import InMemoryStore
+from fairytale_bot.user_settings import StoryCompression
+
+STRUCTURE = {"raw": "...", "all_parts": ["- part"] * 9}
+STORY = ["Once upon a time..."]
+
+
+class BaselineState:
+    """The baseline layout: one (default)dict per field on the app"""
+
+    def __init__(self):
+        self.morals = {}
+        self.topics = {}
+        self.authors = defaultdict(lambda: "Grimm")
+        self.usage = defaultdict(int)
+        self.story_structures = {}
+        self.story_stages = defaultdict(int)
+        self.stories = defaultdict(list)
+        self.max_tokens_per_user = defaultdict(lambda: 200)
+        self.compression_per_user = defaultdict(
+            lambda: StoryCompression.FEW_LINES_PER_PART
+        )
+        self.model_per_user = defaultdict(lambda: "gpt-3.5-turbo")
+        self.user_limits = defaultdict(lambda: 10)
+
+    def simulate(self, user: str, premium: bool):
+        if premium:  # set_premium
+            self.max_tokens_per_user[user] = 1000
+            self.compression_per_user[user] = StoryCompression.COMPLETE_STORY
+            self.model_per_user[user] = "gpt-4"
+            self.user_limits[user] = 100
+        self.morals[user] = "be kind"
+        self.topics[user] = "a dragon"
+        self.authors[user] = "Grimm"
+        self.story_structures[user] = STRUCTURE
+        # generating a part reads the settings - the defaultdicts store them
+        for settings in (
+            self.max_tokens_per_user,
+            self.compression_per_user,
+            self.model_per_user,
+            self.user_limits,
+        ):
+            settings[user]
+        self.story_stages[user] += 1
+        self.stories[user] = STORY
+        self.usage[user] += 1
+
+
+class SessionState:
+    def __init__(self):
+        self.sessions = SessionStore(InMemoryStore())
+        self.sessions.add_tier(
+            Tier(
+                "default", 200, StoryCompression.FEW_LINES_PER_PART, "gpt-3.5-turbo", 10
+            )
+        )
+        self.sessions.add_tier(
+            Tier("premium", 1000, StoryCompression.COMPLETE_STORY, "gpt-4", 100)
+        )
+        self.fields = {
+            name: SessionField(self.sessions, field)
+            for name, field in (
+                ("morals", "moral"),
+                ("topics", "topic"),
+                ("authors", "author"),
+                ("story_structures", "structure"),
+                ("story_stages", "stage"),
+                ("stories", "story"),
+                ("usage", "usage"),
+            )
+        }
+
+    def simulate(self, user: str, premium: bool):
+        fields = self.fields
+        if premium:
+            session = self.sessions.get_or_create(user)
+            session.set_tier("premium")
+            self.sessions.save(user, session)
+        fields["morals"][user] = "be kind"
+        fields["topics"][user] = "a dragon"
+        fields["authors"][user] = "Grimm"
+        fields["story_structures"][user] = STRUCTURE
+        fields["story_stages"][user] = 1
+        fields["stories"][user] = STORY
+        fields["usage"][user] = 1
+
+
+def measure(state_class, users: int, premium_share: float):
+    users_names = [f"user_{i}" for i in range(users)]
+    gc.collect()
+    tracemalloc.start()
+    start = time.perf_counter()
+    state = state_class()
+    for i, user in enumerate(users_names):
+        state.simulate(user, premium=i < users * premium_share)
+    elapsed = time.perf_counter() - start
+    gc.collect()
+    memory = tracemalloc.get_traced_memory()[0]
+    tracemalloc.stop()
+    return memory / users, elapsed, state
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=100_000)
+    parser.add_argument("--premium-share", type=float, default=0.1)
+    args = parser.parse_args()
+
+    for name, state_class in (("baseline", BaselineState), ("sessions", SessionState)):
+        per_user, elapsed, _ = measure(state_class, args.users, args.premium_share)
+        print(
+            f"{name:>8}: {per_user:.0f} bytes per user,"
+            f" {args.users / elapsed:.0f} users/s set up"
+        )
+
+
+if __name__ == "__main__":
+    main()
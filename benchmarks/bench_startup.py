@@ -0,0 +1,91 @@
+"""
+Cold start of the bot: import time of the modules and set-up of the app
+
+Each stage runs in a fresh interpreter with `python -X importtime`, the report
+lists where the import time of the last stage goes, by top level package.
+Exits with an error if setting up the dispatcher takes longer than --budget.
+
+python -m benchmarks.bench_startup --runs 3 --budget 1.5
+"""
+
+import argparse
+import statistics
+import subprocess
+import sys
+from collections import Counter
+
+# stage -> code run in a fresh interpreter, each includes the previous ones
+STAGES = {
+    "package": "import fairytale_bot",
+    "bot module": "import fairytale_bot.bot",
+    "app": "from fairytale_bot.bot import app",
+    "dispatcher": "from fairytale_bot.bot import dp",
+}
+TIMER = (
+    "import time\n"
+    "start = time.perf_counter()\n"
+    "{code}\n"
+    "print(time.perf_counter() - start)\n"
+)
+
+
+def run_stage(code: str):
+    """
+    :param code:
+    :return: seconds spent in the code, import time in us by module
+    """
+    result = subprocess.run(
+        [sys.executable, "-X", "importtime", "-c", TIMER.format(code=code)],
+        capture_output=True,
+        text=True,
+    )
+    if result.returncode:
+        raise RuntimeError(result.stderr[-2000:])
+    imports = {}
+    for line in result.stderr.splitlines():
+        # import time: self [us] | cumulative | imported package
+        if not line.startswith("import time:") or "imported package" in line:
+            continue
+        self_us, _, module = line[len("import time:") :].split("|")
+        imports[module.strip()] = int(self_us)
+    return float(result.stdout.split()[-1]), imports
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--runs", type=int, default=3)
+    parser.add_argument("--top", type=int, default=10)
+    parser.add_argument(
+        "--budget", type=float, default=1.5, help="seconds to set up the dispatcher"
+    )
+    args = parser.parse_args()
+
+    # the first run fills the OS file cache, like any restart after the first
+    run_stage(STAGES["package"])
+    elapsed = None
+    for stage, code in STAGES.items():
+        times = []
+        for _ in range(args.runs):
+            elapsed, imports = run_stage(code)
+            times.append(elapsed)
+        elapsed = statistics.median(times)
+        print(
+            f"{stage:>10}: {elapsed * 1000:7.1f} ms,"
+            f" {len(imports)} modules, {sum(imports.values()) / 1000:.1f} ms importing"
+        )
+
+    by_package = Counter()
+    for module, self_us in imports.items():
+        by_package[module.split(".")[0]] += self_us
+    print("\nslowest packages to import, last run of the last stage:")
+    for package, self_us in by_package.most_common(args.top):
+        print(f"  {package:<20} {self_us / 1000:7.1f} ms")
+
+    if elapsed > args.budget:
+        print(f"\nover the budget: {elapsed:.2f}s > {args.budget:.2f}s")
+        sys.exit(1)
+    print(f"\nwithin the budget: {elapsed:.2f}s <= {args.budget:.2f}s")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,68 @@
+"""
+Benchmark the state store backends with simulated users
+
+python -m benchmarks.bench_storage --users 10000
+"""
+
+import argparse
+import random
+import tempfile
+import time
+from pathlib import Path
+
+from fairytale_bot.storage import InMemoryStore, SqliteStore
+
+NAMESPACES = ["usage", "story_stages", "stories", "morals", "model"]
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))]
+
+
+def run(store, users: int, ops: int):
+    timings = {"read": [], "write": []}
+    for i in range(ops):
+        user = f"user_{random.randrange(users)}"
+        namespace = random.choice(NAMESPACES)
+        if random.random() < 0.5:
+            start = time.perf_counter()
+            store.get(namespace, user)
+            timings["read"].append(time.perf_counter() - start)
+        else:
+            value = ["Once upon a time..." * 10] if namespace == "stories" else i
+            start = time.perf_counter()
+            store.set(namespace, user, value)
+            timings["write"].append(time.perf_counter() - start)
+    store.flush()
+    return timings
+
+
+def main():
+    parser = argparse.ArgumentParser()
+    parser.add_argument("--users", type=int, default=10_000)
+    parser.add_argument("--ops", type=int, default=200_000)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as tmp:
+        stores = {
+            "memory": InMemoryStore(),
+            "sqlite": SqliteStore(str(Path(tmp) / "state.db")),
+        }
+        for name, store in stores.items():
+            start = time.perf_counter()
+            timings = run(store, args.users, args.ops)
+            total = time.perf_counter() - start
+            for op, values in timings.items():
+                print(
+                    f"{name:>6} {op:>5}: "
+                    f"p50={percentile(values, 0.5) * 1e6:.1f}us "
+                    f"p99={percentile(values, 0.99) * 1e6:.1f}us "
+                    f"max={max(values) * 1e6:.1f}us"
+                )
+            print(f"{name:>6} total: {args.ops / total:.0f} ops/s")
+            store.close()
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,82 @@
+"""
+Micro-benchmark of the story structure parser on the test corpus
+
+Compares the single-pass parser with the previous re.split based one,
+both for speed and for how many structures they split into sections.
+
+python -m benchmarks.bench_structure_parser --repeat 2000
+"""
+
+import argparse
+import re
+import time
+from pathlib import Path
+
+from fairytale_bot.structure_parser import (
+    STORY_SECTIONS,
+    StructureParser,
+    parse_story_structure,
+)
+
+CORPUS_DIR = Path(__file__).parent.parent / "tests" / "data" / "structures"
+
+
+def legacy_parse_story_structure(text: str) -> dict:
+    """The parser before the single-pass one, for comparison"""
+
+    def extract(part):
+        return [line for line in part.splitlines() if line.strip().startswith("-")]
+
+    headers = ["exposition", "climax", "resolution"]
+    story_structure = {"raw": text, "all_parts": []}
+    story_structure.update({header: [] for header in headers})
+    if all(header in text for header in headers):
+        parts = re.split("|".join(headers), text)
+        for header, part in zip(headers, parts[1:]):
+            story_structure[header] = extract(part)
+            story_structure["all_parts"].extend(story_structure[header])
+    else:
+        story_structure["all_parts"] = extract(text)
+    return story_structure
+
+
+def parse_streaming(text: str, chunk_size: int = 4) -> dict:
+    parser = StructureParser()
+    for i in range(0, len(text), chunk_size):
+        parser.feed(text[i : i + chunk_size])
+    parser.close()
+    return parser.result()
+
+
+def count_sectioned(parse, texts) -> int:
+    return sum(
+        all(parse(text)[section] for section in STORY_SECTIONS) for text in texts
+    )
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--repeat", type=int, default=2000)
+    args = parser.parse_args()
+
+    texts = [path.read_bytes().decode() for path in sorted(CORPUS_DIR.glob("*.txt"))]
+    print(f"corpus: {len(texts)} structures, {sum(map(len, texts))} chars")
+    for name, parse in (
+        ("legacy", legacy_parse_story_structure),
+        ("single-pass", parse_story_structure),
+        ("streaming, 4-char chunks", parse_streaming),
+    ):
+        start = time.perf_counter()
+        for _ in range(args.repeat):
+            for text in texts:
+                parse(text)
+        elapsed = time.perf_counter() - start
+        per_structure = elapsed / (args.repeat * len(texts)) * 1e6
+        print(
+            f"{name:>25}: {per_structure:.1f} us per structure,"
+            f" split into sections: {count_sectioned(parse, texts)}/{len(texts)}"
+        )
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,133 @@
+"""
+Load test of the webhook server: posts synthetic updates over HTTP
+
+The handlers don't call Telegram or the LLM - each update takes
+--handler-latency seconds of waiting and --cpu-ms of CPU work, so the test
+shows how the worker pool spreads users over tasks and processes.
+
+python -m benchmarks.bench_webhook --updates 5000 --users 500 --processes 4
+"""
+
+import argparse
+import asyncio
+import os
+import random
+import time
+
+from aiogram import Bot, Dispatcher
+from aiohttp import ClientSession
+from aiohttp.test_utils import TestServer
+
+from fairytale_bot.webhook import (
+    ProcessWorkerPool,
+    TaskWorkerPool,
+    create_webhook_app,
+    dispatcher_handler,
+)
+
+# --handler-latency and --cpu-ms, read in the worker processes too
+HANDLER_LATENCY = float(os.getenv("FAIRYTALE_BENCH_HANDLER_LATENCY", "0.05"))
+HANDLER_CPU_MS = float(os.getenv("FAIRYTALE_BENCH_CPU_MS", "1"))
+
+dp = Dispatcher()
+bot = Bot("42:BENCHMARK")
+
+
+@dp.message()
+async def handle_message(message):
+    await asyncio.sleep(HANDLER_LATENCY)
+    deadline = time.perf_counter() + HANDLER_CPU_MS / 1000
+    while time.perf_counter() < deadline:
+        pass
+
+
+def make_update(update_id: int, user_id: int) -> dict:
+    return {
+        "update_id": update_id,
+        "message": {
+            "message_id": update_id,
+            "date": int(time.time()),
+            "chat": {"id": user_id, "type": "private"},
+            "from": {"id": user_id, "is_bot": False, "first_name": "Load"},
+            "text": "/continue",
+        },
+    }
+
+
+def percentile(values, q):
+    values = sorted(values)
+    return values[min(len(values) - 1, int(len(values) * q))] if values else 0.0
+
+
+async def run(args):
+    if args.processes:
+        pool = ProcessWorkerPool(
+            args.processes, module_name="benchmarks.bench_webhook", workers=args.workers
+        )
+    else:
+        pool = TaskWorkerPool(dispatcher_handler(dp, bot), args.workers)
+    server = TestServer(create_webhook_app(pool))
+    await server.start_server()
+    url = str(server.make_url("/webhook"))
+    if args.processes:
+        await pool.wait_ready()
+
+    updates = [
+        make_update(i, random.randrange(args.users)) for i in range(args.updates)
+    ]
+    response_times = []
+    statuses = {}
+    semaphore = asyncio.Semaphore(args.concurrency)
+
+    async with ClientSession() as session:
+
+        async def post(update):
+            async with semaphore:
+                start = time.perf_counter()
+                async with session.post(url, json=update) as response:
+                    await response.read()
+                response_times.append(time.perf_counter() - start)
+                statuses[response.status] = statuses.get(response.status, 0) + 1
+
+        start = time.perf_counter()
+        await asyncio.gather(*(post(update) for update in updates))
+        posted = time.perf_counter() - start
+        if args.processes:
+            await pool.close()  # waits for the workers to drain their queues
+        else:
+            await pool.join()
+        processed = time.perf_counter() - start
+
+    await server.close()
+    await bot.session.close()
+
+    print(f"updates: {args.updates}, users: {args.users}, statuses: {statuses}")
+    print(f"posted in {posted:.1f}s ({args.updates / posted:.0f} updates/sec)")
+    print(f"processed in {processed:.1f}s ({args.updates / processed:.0f} updates/sec)")
+    print(
+        f"response time: p50={percentile(response_times, 0.5) * 1000:.1f}ms"
+        f" p95={percentile(response_times, 0.95) * 1000:.1f}ms"
+        f" p99={percentile(response_times, 0.99) * 1000:.1f}ms"
+    )
+
+
+def main():
+    global HANDLER_LATENCY, HANDLER_CPU_MS
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--updates", type=int, default=5000)
+    parser.add_argument("--users", type=int, default=500)
+    parser.add_argument("--concurrency", type=int, default=100)
+    parser.add_argument("--processes", type=int, default=0)
+    parser.add_argument("--workers", type=int, default=256)
+    parser.add_argument("--handler-latency", type=float, default=HANDLER_LATENCY)
+    parser.add_argument("--cpu-ms", type=float, default=HANDLER_CPU_MS)
+    args = parser.parse_args()
+    HANDLER_LATENCY, HANDLER_CPU_MS = args.handler_latency, args.cpu_ms
+    # the worker processes import the module again, they read the environment
+    os.environ["FAIRYTALE_BENCH_HANDLER_LATENCY"] = str(HANDLER_LATENCY)
+    os.environ["FAIRYTALE_BENCH_CPU_MS"] = str(HANDLER_CPU_MS)
+    asyncio.run(run(args))
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,70 @@
+"""
+Fake Telegram transport: records what the handlers send instead of calling the API
+"""
+
+import time
+from dataclasses import dataclass, field
+from typing import List, Tuple
+
+
+@dataclass
+class FakeUser:
+    id: int
+    username: str
+    full_name: str = "Benchmark User"
+
+
+@dataclass
+class FakeChat:
+    id: int
+    type: str = "private"
+
+
+@dataclass
+class FakeTransport:
+    """Log of everything sent to Telegram: (timestamp, kind, chat_id, text)"""
+
+    sent: List[Tuple[float, str, int, str]] = field(default_factory=list)
+
+    def record(self, kind: str, chat_id: int, text: str = ""):
+        self.sent.append((time.perf_counter(), kind, chat_id, text))
+
+    def count(self, *kinds: str) -> int:
+        return sum(1 for _, kind, _, _ in self.sent if kind in kinds)
+
+
+class FakeBot:
+    def __init__(self, transport: FakeTransport):
+        self.transport = transport
+
+    async def send_chat_action(self, chat_id: int, action, **kwargs):
+        self.transport.record("chat_action", chat_id)
+
+    async def send_message(self, chat_id: int, text: str, **kwargs):
+        self.transport.record("message", chat_id, text)
+        return FakeMessage(self.transport, chat_id, FakeUser(chat_id, "bot"), text)
+
+    async def send_document(self, chat_id: int, document, **kwargs):
+        self.transport.record("document", chat_id)
+
+
+class FakeMessage:
+    def __init__(self, transport: FakeTransport, chat_id: int, user: FakeUser, text):
+        self.transport = transport
+        self.chat = FakeChat(chat_id)
+        self.from_user = user
+        self.text = text
+        self.bot = FakeBot(transport)
+
+    async def answer(self, text: str, **kwargs):
+        self.transport.record("message", self.chat.id, text)
+        return FakeMessage(self.transport, self.chat.id, self.from_user, text)
+
+    async def edit_text(self, text: str, **kwargs):
+        self.transport.record("edit", self.chat.id, text)
+        self.text = text
+        return self
+
+    async def delete(self, **kwargs):
+        self.transport.record("delete", self.chat.id)
+        return True
@@ -1,15 +1,21 @@
+def _get_version() -> str:
+    import importlib.metadata
 
-from importlib.metadata import PackageNotFoundError
+    try:
+        return importlib.metadata.version(__package__ or __name__)
+    except importlib.metadata.PackageNotFoundError:
+        import tomllib
+        from pathlib import Path
 
-try:
-    import importlib.metadata
+        path = Path(__file__).parent.parent / "pyproject.toml"
+        with open(path, "rb") as f:
+            return tomllib.load(f)["tool"]["poetry"]["version"]
 
-    __version__ = importlib.metadata.version(__package__ or __name__)
-    del importlib
-except PackageNotFoundError:
-    import toml
-    from pathlib import Path
 
-    path = Path(__file__).parent.parent / "pyproject.toml"
-    __version__ = toml.load(path)["tool"]["poetry"]["version"]
-    del toml, Path, path
+def __getattr__(name: str):
+    # looked up on first access - importing the package stays cheap
+    if name == "__version__":
+        global __version__
+        __version__ = _get_version()
+        return __version__
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
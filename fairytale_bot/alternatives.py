@@ -0,0 +1,107 @@
+import asyncio
+from collections import OrderedDict
+from typing import Awaitable, Callable, List, Optional, Set
+
+from loguru import logger
+
+
+class _Alternatives:
+    __slots__ = ("stage", "parts", "tasks")
+
+    def __init__(self, stage: int):
+        self.stage = stage
+        self.parts: List[str] = []
+        self.tasks: Set[asyncio.Task] = set()
+
+
+class AlternativesCache:
+    """
+    Spare versions of the current story part, for instant /regenerate
+
+    Spares are generated in the background and kept per user for one story
+    stage only - moving on or changing the story drops them.
+    """
+
+    def __init__(self, max_users: int = 10_000):
+        self.max_users = max_users
+        self._entries: "OrderedDict[str, _Alternatives]" = OrderedDict()
+
+    def __len__(self):
+        return len(self._entries)
+
+    def has(self, user: str, stage: int) -> bool:
+        """
+        Whether a spare is ready or being generated
+        :param user:
+        :param stage:
+        :return:
+        """
+        entry = self._entries.get(user)
+        return (
+            entry is not None
+            and entry.stage == stage
+            and bool(entry.parts or entry.tasks)
+        )
+
+    def generate(
+        self, user: str, stage: int, generate: Callable[[], Awaitable[str]], n: int
+    ):
+        """
+        Start generating spares, replacing the ones of the user
+        :param user:
+        :param stage: index of the story stage
+        :param generate: coroutine factory producing a story part
+        :param n: number of spares
+        :return:
+        """
+        self.invalidate(user)
+        entry = self._entries[user] = _Alternatives(stage)
+        for _ in range(n):
+            task = asyncio.create_task(generate())
+            entry.tasks.add(task)
+            task.add_done_callback(lambda task: self._on_done(entry, task))
+        while len(self._entries) > self.max_users:
+            _, evicted = self._entries.popitem(last=False)
+            self._cancel(evicted)
+
+    @staticmethod
+    def _on_done(entry: _Alternatives, task: asyncio.Task):
+        entry.tasks.discard(task)
+        if task.cancelled():
+            return
+        if task.exception() is not None:
+            logger.warning(f"Failed to generate a spare story part: {task.exception()}")
+            return
+        entry.parts.append(task.result())
+
+    async def pop(self, user: str, stage: int) -> Optional[str]:
+        """
+        Get a spare, waiting for one if they are still being generated
+        :param user:
+        :param stage:
+        :return: the story part or None if there are no spares
+        """
+        entry = self._entries.get(user)
+        if entry is None or entry.stage != stage:
+            return None
+        self._entries.move_to_end(user)
+        while not entry.parts and entry.tasks:
+            await asyncio.wait(set(entry.tasks), return_when=asyncio.FIRST_COMPLETED)
+        if not entry.parts or self._entries.get(user) is not entry:
+            return None
+        return entry.parts.pop(0)
+
+    def invalidate(self, user: str):
+        """
+        Drop the spares of the user and cancel the ones being generated
+        :param user:
+        :return:
+        """
+        entry = self._entries.pop(user, None)
+        if entry is not None:
+            self._cancel(entry)
+
+    @staticmethod
+    def _cancel(entry: _Alternatives):
+        for task in list(entry.tasks):
+            task.cancel()
@@ -0,0 +1,168 @@
+import json
+import sqlite3
+import time
+import zlib
+from typing import Iterator, List, Optional, Tuple
+
+from loguru import logger
+
+try:
+    import zstandard
+except ImportError:  # optional, zlib is used without it
+    zstandard = None
+
+# first byte of every blob - the codec it was compressed with
+ZLIB_CODEC = b"z"
+ZSTD_CODEC = b"s"
+
+TITLE_MAX_LENGTH = 60
+
+
+def compress(data: bytes, level: int = 6) -> bytes:
+    if zstandard is not None:
+        return ZSTD_CODEC + zstandard.ZstdCompressor(level=level).compress(data)
+    return ZLIB_CODEC + zlib.compress(data, level)
+
+
+def decompress(blob: bytes) -> bytes:
+    codec, data = blob[:1], blob[1:]
+    if codec == ZSTD_CODEC:
+        if zstandard is None:
+            raise RuntimeError("zstandard is required to read this story")
+        return zstandard.ZstdDecompressor().decompress(data)
+    return zlib.decompress(data)
+
+
+class StoryArchive:
+    """
+    Finished stories of all users, compressed in SQLite
+
+    A small index table keeps the metadata used for listing,
+    the compressed stories are only read when a story is opened.
+    Nothing is kept in memory.
+    """
+
+    def __init__(self, path: str = ":memory:", level: int = 6):
+        """
+        :param path: SQLite db, can be shared with the state store
+        :param level: compression level
+        """
+        self.path = path
+        self.level = level
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS archive_index ("
+            " user TEXT NOT NULL,"
+            " idx INTEGER NOT NULL,"
+            " created REAL NOT NULL,"
+            " title TEXT NOT NULL,"
+            " author TEXT,"
+            " parts INTEGER NOT NULL,"
+            " size INTEGER NOT NULL,"
+            " PRIMARY KEY (user, idx)"
+            ") WITHOUT ROWID"
+        )
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS archive_stories ("
+            " user TEXT NOT NULL,"
+            " idx INTEGER NOT NULL,"
+            " data BLOB NOT NULL,"
+            " PRIMARY KEY (user, idx)"
+            ")"
+        )
+        self._conn.commit()
+
+    def add(self, user: str, story: dict) -> int:
+        """
+        Archive a finished story
+        :param user:
+        :param story: topic, moral, author, structure, stage and story parts
+        :return: number of the story in the user's archive, starting from 1
+        """
+        data = json.dumps(story, ensure_ascii=False).encode()
+        blob = compress(data, self.level)
+        title = (story.get("topic") or story.get("moral") or "Untitled").strip()
+        if len(title) > TITLE_MAX_LENGTH:
+            title = title[: TITLE_MAX_LENGTH - 3] + "..."
+        with self._conn:
+            index = self.count(user) + 1
+            self._conn.execute(
+                "INSERT INTO archive_index"
+                " (user, idx, created, title, author, parts, size)"
+                " VALUES (?, ?, ?, ?, ?, ?, ?)",
+                (
+                    user,
+                    index,
+                    time.time(),
+                    title,
+                    story.get("author"),
+                    len(story.get("story") or []),
+                    len(data),
+                ),
+            )
+            self._conn.execute(
+                "INSERT INTO archive_stories (user, idx, data) VALUES (?, ?, ?)",
+                (user, index, blob),
+            )
+        logger.debug(f"Archived story {index} of {user}: {len(data)} -> {len(blob)}")
+        return index
+
+    def count(self, user: str) -> int:
+        row = self._conn.execute(
+            "SELECT COUNT(*) FROM archive_index WHERE user = ?", (user,)
+        ).fetchone()
+        return row[0]
+
+    def list(self, user: str, offset: int = 0, limit: int = 10) -> List[dict]:
+        """
+        Metadata of the user's stories, oldest first
+        :param user:
+        :param offset:
+        :param limit:
+        :return: dicts with index, created, title, author, parts, size
+        """
+        rows = self._conn.execute(
+            "SELECT idx, created, title, author, parts, size FROM archive_index"
+            " WHERE user = ? ORDER BY idx LIMIT ? OFFSET ?",
+            (user, limit, offset),
+        ).fetchall()
+        keys = ("index", "created", "title", "author", "parts", "size")
+        return [dict(zip(keys, row)) for row in rows]
+
+    def get(self, user: str, index: int) -> Optional[dict]:
+        """
+        Load and decompress one story
+        :param user:
+        :param index: number of the story, starting from 1
+        :return: the story dict or None if there's no such story
+        """
+        row = self._conn.execute(
+            "SELECT data FROM archive_stories WHERE user = ? AND idx = ?",
+            (user, index),
+        ).fetchone()
+        if row is None:
+            return None
+        return json.loads(decompress(row[0]))
+
+    def iter_stories(self, user: str) -> Iterator[Tuple[int, dict]]:
+        """
+        Load the user's stories one at a time, oldest first
+        :param user:
+        :return: iterator over (index, story)
+        """
+        cursor = self._conn.execute(
+            "SELECT idx, data FROM archive_stories WHERE user = ? ORDER BY idx",
+            (user,),
+        )
+        for index, blob in cursor:
+            yield index, json.loads(decompress(blob))
+
+    def delete_user(self, user: str):
+        with self._conn:
+            self._conn.execute("DELETE FROM archive_index WHERE user = ?", (user,))
+            self._conn.execute("DELETE FROM archive_stories WHERE user = ?", (user,))
+
+    def close(self):
+        self._conn.close()
@@ -0,0 +1,224 @@
+"""
+Generate complete stories offline, for a static catalogue
+
+Every moral from random_morals.txt is combined with a subset of the plots,
+each story is generated with the same structure and story part logic the
+bot uses, and finished stories are appended to a JSONL file.
+
+The output file is the checkpoint: stories already in it are skipped on
+the next run. With FAIRYTALE_STATE_DB set, unfinished stories also resume
+from the last generated part.
+
+python -m fairytale_bot.batch stories.jsonl --plots 10 --concurrency 20
+"""
+
+import argparse
+import asyncio
+import hashlib
+import json
+import random
+import time
+from pathlib import Path
+from typing import Iterable, List, Set
+
+from loguru import logger
+
+from fairytale_bot.lib import MainApp
+
+
+class BatchApp(MainApp):
+    # batch users are one-off, only the model rate limits apply
+    DEFAULT_USER_LIMIT = PREMIUM_USER_LIMIT = 10**9
+    DEFAULT_USER_REQUESTS_PER_MINUTE = PREMIUM_USER_REQUESTS_PER_MINUTE = 10**9
+
+
+def make_job_id(job: dict) -> str:
+    key = json.dumps([job["topic"], job["moral"], job["author"], job["premium"]])
+    return hashlib.sha1(key.encode()).hexdigest()[:16]
+
+
+def make_jobs(
+    morals: Iterable[str],
+    plots: Iterable[str],
+    authors: List[str],
+    premium: bool = False,
+    seed: int = 0,
+) -> List[dict]:
+    """
+    Every moral × plot combination, with an author picked at random
+    :param morals:
+    :param plots:
+    :param authors:
+    :param premium: generate with the premium model and settings
+    :param seed: same seed - same authors, so the job ids stay stable
+    :return:
+    """
+    rng = random.Random(seed)
+    jobs = []
+    for moral in morals:
+        for plot in plots:
+            job = {
+                "topic": plot,
+                "moral": moral,
+                "author": rng.choice(authors),
+                "premium": premium,
+            }
+            job["id"] = make_job_id(job)
+            jobs.append(job)
+    return jobs
+
+
+def load_done_ids(path: Path) -> Set[str]:
+    """
+    Ids of the stories already in the output file
+    :param path:
+    :return:
+    """
+    done = set()
+    if not path.exists():
+        return done
+    with path.open() as f:
+        for line in f:
+            try:
+                done.add(json.loads(line)["id"])
+            except (ValueError, KeyError):
+                # a line cut short by a crash
+                logger.warning(f"Skipping a broken line in {path}")
+    return done
+
+
+async def generate_story(app: MainApp, job: dict) -> dict:
+    """
+    Generate a complete story, continuing from the saved state if there is one
+    :param app:
+    :param job:
+    :return: the job with the structure and the story parts
+    """
+    user = f"batch_{job['id']}"
+    if user not in app.story_structures:
+        if job["premium"]:
+            app.set_premium(user)
+        else:
+            app.set_default(user)
+        app.set_moral(job["moral"], user)
+        app.set_topic(job["topic"], user)
+        app.set_author(job["author"], user)
+        structure = await app._generate_story_structure(
+            topic=job["topic"],
+            moral=job["moral"],
+            author=job["author"],
+            model=app.model_per_user[user],
+            user=user,
+        )
+        app.set_story_structure(user, structure)
+
+    n_parts = len(app.story_structures[user]["all_parts"])
+    while app.story_stages[user] < n_parts:
+        await app.generate_next_story_part(user)
+
+    result = dict(
+        job,
+        model=app.model_per_user[user],
+        structure=app.story_structures[user]["raw"],
+        # popped, so that reset() doesn't archive it
+        story=app.stories.pop(user),
+    )
+    app.reset(user)
+    return result
+
+
+async def run_batch(
+    app: MainApp, jobs: List[dict], output: Path, concurrency: int = 10
+) -> int:
+    """
+    Generate the stories missing from the output file, `concurrency` at a time
+    :param app:
+    :param jobs:
+    :param output: JSONL file, finished stories are appended as they complete
+    :param concurrency:
+    :return: number of stories generated
+    """
+    done = load_done_ids(output)
+    jobs = [job for job in jobs if job["id"] not in done]
+    logger.info(f"{len(done)} stories done, {len(jobs)} to go")
+    semaphore = asyncio.Semaphore(concurrency)
+    generated = 0
+    failed = 0
+    start = time.perf_counter()
+
+    with output.open("a") as f:
+
+        async def run_job(job):
+            nonlocal generated, failed
+            async with semaphore:
+                try:
+                    result = await generate_story(app, job)
+                except Exception:
+                    logger.exception(f"Failed to generate story {job['id']}")
+                    failed += 1
+                    return
+            f.write(json.dumps(result, ensure_ascii=False) + "\n")
+            f.flush()
+            generated += 1
+            if generated % 10 == 0:
+                rate = generated / (time.perf_counter() - start)
+                logger.info(f"{generated}/{len(jobs)} stories, {rate:.2f}/s")
+
+        await asyncio.gather(*(run_job(job) for job in jobs))
+
+    elapsed = time.perf_counter() - start
+    logger.info(
+        f"Generated {generated} stories in {elapsed:.1f}s,"
+        f" {failed} failed - run again to retry them"
+    )
+    return generated
+
+
+def main():
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("output", type=Path)
+    parser.add_argument("--plots", type=int, default=10, help="plots per moral")
+    parser.add_argument("--morals", type=int, default=None, help="default: all")
+    parser.add_argument("--concurrency", type=int, default=10)
+    parser.add_argument("--premium", action="store_true")
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument(
+        "--fake-llm", action="store_true", help="offline run with a fake LLM"
+    )
+    args = parser.parse_args()
+
+    if args.fake_llm:
+        from fairytale_bot.fake_llm import FakeGptPlugin
+
+        app = BatchApp()
+        app.gpt = FakeGptPlugin(latency=0.1, tokens_per_second=1000)
+    else:
+        from bot_lib.plugins import GptPlugin
+
+        app = BatchApp(plugins=[GptPlugin])
+
+    plots = random.Random(args.seed).sample(
+        app.random_plots, min(args.plots, len(app.random_plots))
+    )
+    jobs = make_jobs(
+        app.random_morals[: args.morals],
+        plots,
+        app.random_fairytale_authors,
+        premium=args.premium,
+        seed=args.seed,
+    )
+
+    async def run():
+        try:
+            await run_batch(app, jobs, args.output, args.concurrency)
+        finally:
+            await app.llm_scheduler.close()
+
+    asyncio.run(run())
+
+
+if __name__ == "__main__":
+    main()
@@ -1,30 +1,92 @@
-from aiogram import Dispatcher
+"""
+The bot, set up on first access
+
+`app`, `dp` and `bot` are created by the factories below the first time they
+are imported from this module, so importing it - e.g. to run the webhook
+server, whose main process only needs `bot` - doesn't build the rest.
+"""
+
+import os
+
 from dotenv import load_dotenv
 
-from bot_lib import (
-    BotConfig,
-    setup_dispatcher,
-)
-from bot_lib.demo import create_bot, run_bot
-from bot_lib.plugins import GptPlugin
+load_dotenv()
 
-from fairytale_bot.fairytale_settings import FairytaleSettingsHandler
-from fairytale_bot.lib import MainApp, MainHandler
-from fairytale_bot.user_settings import UserSettingsHandler
+GPT_PLUGIN = "bot_lib.plugins:GptPlugin"
 
 
-plugins = [GptPlugin]
-app = MainApp(plugins=plugins)
-bot_config = BotConfig(app=app)
+def create_app(plugins=None):
+    """
+    :param plugins: plugin classes, by default GptPlugin created on first use
+    :return: MainApp
+    """
+    from fairytale_bot.lib import MainApp
+    from fairytale_bot.plugins import LazyPlugin
 
-# set up dispatcher
-dp = Dispatcher()
+    if plugins is None:
+        plugins = [LazyPlugin(GPT_PLUGIN, "gpt")]
+    return MainApp(plugins=plugins)
 
-handlers = [MainHandler(), UserSettingsHandler(), FairytaleSettingsHandler()]
-setup_dispatcher(dp, bot_config, extra_handlers=handlers)
 
-load_dotenv()
-bot = create_bot()
+def create_dispatcher(app):
+    """
+    :param app: MainApp
+    :return: aiogram Dispatcher with the bot handlers
+    """
+    from aiogram import Dispatcher
+    from bot_lib import BotConfig, setup_dispatcher
+
+    from fairytale_bot.fairytale_settings import FairytaleSettingsHandler
+    from fairytale_bot.lib import MainHandler
+    from fairytale_bot.metrics import MetricsMiddleware, start_metrics_server
+    from fairytale_bot.user_settings import UserSettingsHandler
+
+    bot_config = BotConfig(app=app)
+    dp = Dispatcher()
+
+    handlers = [MainHandler(), UserSettingsHandler(), FairytaleSettingsHandler()]
+    setup_dispatcher(dp, bot_config, extra_handlers=handlers)
+    dp.message.middleware(MetricsMiddleware(app.metrics))
+
+    # serve prometheus metrics on localhost if the port is set
+    @dp.startup()
+    async def start_metrics():
+        port = os.getenv("FAIRYTALE_METRICS_PORT")
+        if port:
+            await start_metrics_server(app.metrics, int(port))
+
+    # have ready-made stories before the first /randomize
+    @dp.startup()
+    async def warm_structure_pools():
+        app.warm_structure_pools()
+
+    return dp
+
+
+def create_bot():
+    from bot_lib import demo
+
+    return demo.create_bot()
+
+
+def _get(name: str):
+    if name not in globals():
+        if name == "app":
+            globals()["app"] = create_app()
+        elif name == "dp":
+            globals()["dp"] = create_dispatcher(_get("app"))
+        else:
+            globals()["bot"] = create_bot()
+    return globals()[name]
+
+
+def __getattr__(name: str):
+    if name in ("app", "dp", "bot"):
+        return _get(name)
+    raise AttributeError(f"module {__name__!r} has no attribute {name!r}")
+
 
 if __name__ == "__main__":
-    run_bot(dp, bot)
+    from bot_lib.demo import run_bot
+
+    run_bot(_get("dp"), _get("bot"))
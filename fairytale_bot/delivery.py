@@ -0,0 +1,168 @@
+import asyncio
+import re
+from collections import OrderedDict
+from typing import AsyncGenerator, Awaitable, Callable, Iterable, List, TypeVar
+
+from aiogram import Bot
+from aiogram.exceptions import TelegramRetryAfter
+from aiogram.types import InputFile, Message
+from aiogram.types.input_file import DEFAULT_CHUNK_SIZE
+from loguru import logger
+
+from fairytale_bot.rate_limit import TokenBucket
+
+T = TypeVar("T")
+
+TELEGRAM_MESSAGE_LIMIT = 4096
+SENTENCE_END_PATTERN = re.compile(r"(?<=[.!?…])\s+")
+
+
+def split_message(text: str, limit: int = TELEGRAM_MESSAGE_LIMIT) -> List[str]:
+    """
+    Split the text into messages under the limit
+    Cuts at a paragraph break, a sentence end or a space, whichever is
+    the latest in the second half of the message
+    :param text:
+    :param limit:
+    :return:
+    """
+    pieces = []
+    while len(text) > limit:
+        window = text[:limit]
+        cut = window.rfind("\n\n")
+        if cut < limit // 2:
+            sentence_ends = [m.start() for m in SENTENCE_END_PATTERN.finditer(window)]
+            cut = sentence_ends[-1] if sentence_ends else -1
+        if cut < limit // 2:
+            cut = window.rfind(" ")
+        if cut <= 0:
+            cut = limit
+        pieces.append(text[:cut].rstrip())
+        text = text[cut:].lstrip()
+    if text or not pieces:
+        pieces.append(text)
+    return pieces
+
+
+class ChatPacer:
+    """
+    Paces the messages to stay under the Telegram flood limits
+
+    About one message per second per chat, 20 per minute per group,
+    30 per second for the whole bot. Short bursts are allowed.
+    """
+
+    def __init__(
+        self,
+        chat_rate: float = 1.0,
+        group_rate: float = 20 / 60,
+        burst: int = 3,
+        rate: float = 30.0,
+        max_chats: int = 10_000,
+    ):
+        self.chat_rate = chat_rate
+        self.group_rate = group_rate
+        self.burst = burst
+        self.max_chats = max_chats
+        self._bucket = TokenBucket(rate, rate)
+        self._chat_buckets: "OrderedDict[int, TokenBucket]" = OrderedDict()
+
+    def _get_chat_bucket(self, chat_id: int) -> TokenBucket:
+        bucket = self._chat_buckets.get(chat_id)
+        if bucket is None:
+            # group and channel ids are negative
+            rate = self.group_rate if chat_id < 0 else self.chat_rate
+            bucket = self._chat_buckets[chat_id] = TokenBucket(rate, self.burst)
+            while len(self._chat_buckets) > self.max_chats:
+                self._chat_buckets.popitem(last=False)
+        self._chat_buckets.move_to_end(chat_id)
+        return bucket
+
+    async def wait(self, chat_id: int):
+        """
+        Wait until a message can be sent to the chat
+        :param chat_id:
+        :return:
+        """
+        while True:
+            chat_bucket = self._get_chat_bucket(chat_id)
+            delay = max(chat_bucket.time_until(), self._bucket.time_until())
+            if delay <= 0:
+                chat_bucket.try_acquire()
+                self._bucket.try_acquire()
+                return
+            await asyncio.sleep(delay)
+
+
+async def send_paced(
+    call: Callable[[], Awaitable[T]], chat_id: int, pacer: ChatPacer = None
+) -> T:
+    """
+    Make a Telegram call within the flood limits, retrying once if told to wait
+    :param call: coroutine factory making the call
+    :param chat_id:
+    :param pacer: None to send right away
+    :return:
+    """
+    if pacer is not None:
+        await pacer.wait(chat_id)
+    try:
+        return await call()
+    except TelegramRetryAfter as e:
+        logger.warning(f"Flood limit in chat {chat_id}, retrying in {e.retry_after}s")
+        await asyncio.sleep(e.retry_after)
+        return await call()
+
+
+async def send_text(
+    message: Message, text: str, pacer: ChatPacer = None, **kwargs
+) -> List[Message]:
+    """
+    Answer the message with the text, split into as many messages as needed
+    :param message:
+    :param text:
+    :param pacer:
+    :param kwargs: passed to message.answer
+    :return: the sent messages
+    """
+    sent = []
+    for piece in split_message(text):
+        sent.append(
+            await send_paced(
+                lambda: message.answer(piece, **kwargs), message.chat.id, pacer
+            )
+        )
+    return sent
+
+
+class StreamedFile(InputFile):
+    """
+    File uploaded from text chunks as they are produced
+
+    The chunks are generated again on every read, so the file is never
+    held in memory as a whole.
+    """
+
+    def __init__(
+        self,
+        make_chunks: Callable[[], Iterable[str]],
+        filename: str,
+        chunk_size: int = DEFAULT_CHUNK_SIZE,
+    ):
+        """
+        :param make_chunks: returns a fresh iterator over the text of the file
+        :param filename:
+        :param chunk_size: size of the uploaded chunks, in bytes
+        """
+        super().__init__(filename=filename, chunk_size=chunk_size)
+        self.make_chunks = make_chunks
+
+    async def read(self, bot: Bot) -> AsyncGenerator[bytes, None]:
+        buffer = bytearray()
+        for text in self.make_chunks():
+            buffer += text.encode()
+            if len(buffer) >= self.chunk_size:
+                yield bytes(buffer)
+                buffer.clear()
+        if buffer:
+            yield bytes(buffer)
@@ -1,13 +1,15 @@
-import random
-from collections import defaultdict
 from pathlib import Path
 
 from aiogram.types import Message
 
 from bot_lib import App, Handler
 
+from fairytale_bot.resource_registry import ResourceRegistry
+from fairytale_bot.session import SessionField
+from fairytale_bot.storage import StateStoreMixin
 
-class FairytaleSettings(App):
+
+class FairytaleSettings(StateStoreMixin, App):
     """
     Fairytale configuration
 
@@ -19,74 +21,109 @@ class FairytaleSettings(App):
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
 
-        # todo: use a generalized storage solution to stora and access all data
-        self.morals = {}
-        self.topics = {}
-        self.authors = defaultdict(lambda: self.DEFAULT_AUTHOR_STYLE)
+        self.morals = SessionField(self.sessions, "moral")
+        self.topics = SessionField(self.sessions, "topic")
+        self.authors = SessionField(
+            self.sessions, "author", default_factory=lambda: self.DEFAULT_AUTHOR_STYLE
+        )
+
+    # don't give the same user any of their last K random picks
+    RESOURCE_NO_REPEAT = 5
+    RESOURCE_RELOAD_INTERVAL = 5.0  # seconds
 
-    def _load_resource(self, resource_name: str):
+    def _load_resources(self):
         """
-        Load a resource from the resources directory
-        :param resource_name:
+        Set up the resource registry, the files are read on first use
         :return:
         """
-        return (self.resources_path / resource_name).read_text().strip()
-
-    def _load_resources(self):
+        self.resources = ResourceRegistry(
+            self.resources_path, reload_interval=self.RESOURCE_RELOAD_INTERVAL
+        )
+        self.resources.register_combined(
+            "all_authors", ["random_authors", "random_fairytale_authors"]
+        )
+
+    @property
+    def random_authors(self):
+        return self.resources.entries("random_authors")
+
+    @property
+    def random_morals(self):
+        return self.resources.entries("random_morals")
+
+    @property
+    def random_plots(self):
+        return self.resources.entries("random_plots")
+
+    @property
+    def random_locations(self):
+        return self.resources.entries("random_locations")
+
+    @property
+    def random_fairytale_authors(self):
+        return self.resources.entries("random_fairytale_authors")
+
+    def on_story_settings_changed(self, user: str):
         """
-        Load all resources
+        Called when the topic, moral or author of the user changes
+        :param user:
         :return:
         """
-        self.random_authors = self._load_resource("random_authors.txt").splitlines()
-        self.random_morals = self._load_resource("random_morals.txt").splitlines()
-        self.random_plots = self._load_resource("random_plots.txt").splitlines()
-        self.random_locations = self._load_resource("random_locations.txt").splitlines()
-        self.random_fairytale_authors = self._load_resource(
-            "random_fairytale_authors.txt"
-        ).splitlines()
 
     def set_moral(self, topic: str, user: str):
         self.morals[user] = topic
+        self.on_story_settings_changed(user)
 
     def get_moral(self, user: str):
         return self.morals.get(user)
 
     def set_topic(self, topic: str, user: str):
-        self.morals[user] = topic
+        self.topics[user] = topic
+        self.on_story_settings_changed(user)
 
     def get_topic(self, user: str):
-        return self.morals.get(user)
+        return self.topics.get(user)
 
     def set_author(self, author: str, user: str):
         self.authors[user] = author
+        self.on_story_settings_changed(user)
 
     def get_author(self, user: str):
         return self.authors.get(user)
 
-    def get_random_moral(self):
+    def get_random_moral(self, user: str = None):
         """
-        Get a random topic from a predefined list
+        Get a random moral from a predefined list
+        :param user: avoid repeating the user's recent morals
         :return:
         """
-        return random.choice(self.random_morals)
+        return self.resources.sample(
+            "random_morals", user, avoid_last=self.RESOURCE_NO_REPEAT
+        )
 
-    def get_random_topic(self):
+    def get_random_topic(self, user: str = None):
         """
         Get a random topic from a predefined list
+        :param user: avoid repeating the user's recent plots and locations
         :return:
         """
-        plot = random.choice(self.random_plots)
-        location = random.choice(self.random_locations)
+        plot = self.resources.sample(
+            "random_plots", user, avoid_last=self.RESOURCE_NO_REPEAT
+        )
+        location = self.resources.sample(
+            "random_locations", user, avoid_last=self.RESOURCE_NO_REPEAT
+        )
         return f"{plot} in {location}"
 
-    def get_random_author(self, fairytale_only: bool = False):
+    def get_random_author(self, fairytale_only: bool = False, user: str = None):
         """
         Get a random author from a predefined list
+        :param fairytale_only:
+        :param user: avoid repeating the user's recent authors
         :return:
         """
-        if fairytale_only:
-            return random.choice(self.random_fairytale_authors)
-        return random.choice(self.random_authors + self.random_fairytale_authors)
+        name = "random_fairytale_authors" if fairytale_only else "all_authors"
+        return self.resources.sample(name, user, avoid_last=self.RESOURCE_NO_REPEAT)
 
 
 class FairytaleSettingsHandler(Handler):
@@ -104,21 +141,21 @@ class FairytaleSettingsHandler(Handler):
     async def set_random_topic(self, message: Message, app: FairytaleSettings):
         """Set a random topic for the fairytale."""
         user = self.get_user(message)
-        topic = app.get_random_topic()
+        topic = app.get_random_topic(user=user)
         app.set_topic(topic, user)
         await message.answer(f"Random topic set to {topic}")
 
     async def set_random_moral(self, message: Message, app: FairytaleSettings):
         """Set a random moral for the fairytale."""
         user = self.get_user(message)
-        moral = app.get_random_moral()
+        moral = app.get_random_moral(user=user)
         app.set_moral(moral, user)
         await message.answer(f"Random moral set to {moral}")
 
     async def set_random_author(self, message: Message, app: FairytaleSettings):
         """Set a random author for the fairytale."""
         user = self.get_user(message)
-        author = app.get_random_author()
+        author = app.get_random_author(user=user)
         app.set_author(author, user)
         await message.answer(f"Random author set to {author}")
 
@@ -0,0 +1,118 @@
+import asyncio
+import random
+from typing import AsyncIterator
+
+from fairytale_bot.prompt_budget import CHARS_PER_TOKEN
+from fairytale_bot.prompt_cache import PrefixCache
+from fairytale_bot.structure_parser import STORY_DELIMITER
+
+
+class FakeLLMError(Exception):
+    """Simulated provider error, looks like a 429 to the rate limiter"""
+
+    status_code = 429
+
+
+class FakeGptPlugin:
+    """
+    Local stand-in for GptPlugin - no network, configurable speed and failures
+
+    Answers structure prompts with a valid story structure, prompts for the
+    structure and the first part with both, and anything else with filler
+    text of up to max_tokens words.
+    """
+
+    name = "gpt"
+
+    STRUCTURE = (
+        "[exposition]\n"
+        "- The hero lives a quiet life\n"
+        "- A stranger brings news\n"
+        "- The hero sets out\n"
+        "[climax]\n"
+        "- The hero faces the villain\n"
+        "- All seems lost\n"
+        "- The hero finds the courage\n"
+        "[resolution]\n"
+        "- The villain is defeated\n"
+        "- The hero returns home\n"
+        "- Everyone learns the moral\n"
+    )
+    WORDS = (
+        "once upon a time there lived a brave little fox in a deep dark forest".split()
+    )
+
+    def __init__(
+        self,
+        latency: float = 0.5,
+        tokens_per_second: float = 50,
+        error_rate: float = 0.0,
+        max_words: int = 150,
+        prefill_tokens_per_second: float = None,
+    ):
+        """
+        :param latency: seconds before the first token
+        :param tokens_per_second: of the completion
+        :param error_rate:
+        :param max_words: of the completion
+        :param prefill_tokens_per_second: if set, reading the prompt takes time
+            too, except for a prefix sent recently - like a local server
+            reusing its cache
+        """
+        self.latency = latency
+        self.tokens_per_second = tokens_per_second
+        self.error_rate = error_rate
+        self.max_words = max_words
+        self.prefill_tokens_per_second = prefill_tokens_per_second
+        self.prefix_cache = PrefixCache()
+        self.calls = 0
+        self.errors = 0
+
+    def _make_completion(self, prompt: str, max_tokens: int = None) -> str:
+        if STORY_DELIMITER in prompt:
+            return self.STRUCTURE + STORY_DELIMITER + "\n" + self._make_text(max_tokens)
+        if prompt.strip().endswith("STRUCTURE:"):
+            return self.STRUCTURE
+        return self._make_text(max_tokens)
+
+    def _make_text(self, max_tokens: int = None) -> str:
+        n_words = min(max_tokens or self.max_words, self.max_words)
+        words = random.choices(self.WORDS, k=n_words)
+        # sentences of 10 words
+        return " ".join(
+            " ".join(words[i : i + 10]).capitalize() + "."
+            for i in range(0, n_words, 10)
+        )
+
+    async def _start(self, prompt: str, model: str):
+        self.calls += 1
+        latency = self.latency
+        if self.prefill_tokens_per_second:
+            cached = self.prefix_cache.match(model, prompt)
+            self.prefix_cache.add(model, prompt)
+            new_tokens = (len(prompt) - len(cached)) / CHARS_PER_TOKEN
+            latency += new_tokens / self.prefill_tokens_per_second
+        await asyncio.sleep(latency)
+        if random.random() < self.error_rate:
+            self.errors += 1
+            raise FakeLLMError("Simulated LLM error")
+
+    async def complete_text(
+        self, text: str, model: str = None, max_tokens: int = None, **kwargs
+    ) -> str:
+        await self._start(text, model)
+        completion = self._make_completion(text, max_tokens)
+        await asyncio.sleep(len(completion.split()) / self.tokens_per_second)
+        return completion
+
+    async def stream_text(
+        self, text: str, model: str = None, max_tokens: int = None, **kwargs
+    ) -> AsyncIterator[str]:
+        await self._start(text, model)
+        words = self._make_completion(text, max_tokens).split(" ")
+        # send a chunk every ~20ms, like the real APIs do
+        chunk_size = max(1, int(self.tokens_per_second * 0.02))
+        for i in range(0, len(words), chunk_size):
+            chunk = words[i : i + chunk_size]
+            await asyncio.sleep(len(chunk) / self.tokens_per_second)
+            yield ("" if i == 0 else " ") + " ".join(chunk)
@@ -1,16 +1,55 @@
-from collections import defaultdict
-from functools import wraps
+import asyncio
+import copy
+import json
+import os
+import time
+from contextlib import aclosing
+from functools import cached_property, wraps
 from textwrap import dedent
+from typing import AsyncIterator
 
 from aiogram import Bot
 from aiogram.enums import ChatAction
+from aiogram.exceptions import TelegramBadRequest
 from aiogram.types import Message
-from aiogram.utils.markdown import hbold
+from aiogram.utils.markdown import hbold, html_decoration
 from dotenv import load_dotenv
 from loguru import logger
 from bot_lib import App, Handler, HandlerDisplayMode
 
+from fairytale_bot.alternatives import AlternativesCache
+from fairytale_bot.archive import StoryArchive
+from fairytale_bot.delivery import (
+    ChatPacer,
+    StreamedFile,
+    send_paced,
+    send_text,
+    split_message,
+)
 from fairytale_bot.fairytale_settings import FairytaleSettings
+from fairytale_bot.fake_llm import FakeGptPlugin
+from fairytale_bot.llm_router import LLMRouter, OpenAIBackend, PluginBackend
+from fairytale_bot.metrics import MetricsRegistry, current_handler
+from fairytale_bot.prefetch import PrefetchScheduler
+from fairytale_bot.prompt_budget import PromptBudget, count_tokens
+from fairytale_bot.prompt_cache import ChatPrompt, PrefixCache
+from fairytale_bot.quota import QuotaEngine, QuotaExceeded, Reservation
+from fairytale_bot.rate_limit import (
+    LLMScheduler,
+    RateLimitExceeded,
+    SchedulerOverloaded,
+)
+from fairytale_bot.response_cache import ResponseCache, ResponseCacheMode
+from fairytale_bot.session import SessionField
+from fairytale_bot.structure_cache import StructureCache
+from fairytale_bot.structure_parser import (
+    STORY_DELIMITER,
+    FusedStoryParser,
+    extract_story_parts,
+    parse_story_structure,
+)
+from fairytale_bot.structure_pool import StructurePool
+from fairytale_bot.user_locks import SingleFlight, UserLocks
 from fairytale_bot.user_settings import UserSettings, StoryCompression
 
 load_dotenv()
@@ -43,12 +82,65 @@ class MainApp(UserSettings, FairytaleSettings):
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
 
-        # todo: use a generalized storage solution to stora and access all data
-        self.usage = defaultdict(int)
-        self.story_structures = {}
-        self.story_stages = defaultdict(int)
-        self.stories = defaultdict(list)  # one story per user - current
-        self.story_archive = defaultdict(list)  # all stories per user
+        self.sessions.on_evict = self._on_session_evicted
+        # token-weighted usage per window, see reserve_usage
+        self.quota = QuotaEngine(
+            self.sessions, self.USAGE_WINDOW, flush_interval=self.QUOTA_FLUSH_INTERVAL
+        )
+        self.story_structures = SessionField(self.sessions, "structure")
+        self.story_stages = SessionField(self.sessions, "stage", default_factory=int)
+        # one story per user - current
+        self.stories = SessionField(self.sessions, "story", default_factory=list)
+        # compressed form of each story part, computed once when it's added
+        self.story_fragments = SessionField(
+            self.sessions, "fragments", default_factory=list
+        )
+        self.story_summaries = SessionField(
+            self.sessions, "summaries", default_factory=list
+        )
+        self._summary_tasks = set()
+        # all finished stories per user, compressed on disk
+        self.story_archive = StoryArchive(
+            self.ARCHIVE_DB_PATH
+            or os.getenv("FAIRYTALE_ARCHIVE_DB")
+            or self.STATE_DB_PATH
+            or os.getenv("FAIRYTALE_STATE_DB")
+            or ":memory:"
+        )
+
+        self.prefetcher = PrefetchScheduler(
+            max_concurrency=self.PREFETCH_MAX_CONCURRENCY
+        )
+        # spare versions of the last story part for /regenerate
+        self.alternatives = AlternativesCache()
+
+        self.structure_cache = StructureCache(
+            max_size=self.STRUCTURE_CACHE_SIZE,
+            ttl=self.STRUCTURE_CACHE_TTL,
+            variants=self.STRUCTURE_CACHE_VARIANTS,
+            cache_dir=os.getenv("FAIRYTALE_STRUCTURE_CACHE_DIR"),
+        )
+        self.structure_pools = {}  # (model, max_tokens) -> StructurePool
+        self.response_cache = ResponseCache(
+            max_size=self.RESPONSE_CACHE_SIZE,
+            ttl=self.RESPONSE_CACHE_TTL,
+            similarity_threshold=self.RESPONSE_CACHE_SIMILARITY,
+            index_similar=ResponseCacheMode.SIMILAR
+            in (self.DEFAULT_RESPONSE_CACHE, self.PREMIUM_RESPONSE_CACHE),
+        )
+        self.llm_scheduler = LLMScheduler(
+            max_queue=self.LLM_MAX_QUEUE,
+            # set by the webhook worker processes, they share the account
+            model_limit_share=float(os.getenv("FAIRYTALE_MODEL_LIMIT_SHARE", "1")),
+        )
+        self.metrics = MetricsRegistry()
+        # estimates the prompt tokens the providers can serve from their cache
+        self.prefix_cache = PrefixCache()
+        # keeps the sends under the Telegram flood limits
+        self.chat_pacer = ChatPacer() if self.PACE_TELEGRAM_SENDS else None
+        # one story part generation per user at a time
+        self.user_locks = UserLocks()
+        self.story_part_calls = SingleFlight()
 
         self._load_resources()
 
@@ -58,40 +150,90 @@ class MainApp(UserSettings, FairytaleSettings):
         :param user:
         :return:
         """
+        session = self.sessions.get(user)
+        if session is not None:
+            self._archive_story(user, session.pop_story())
+            self.sessions.save(user, session)
+        self.prefetcher.invalidate(user)
+        self.alternatives.invalidate(user)
+
+    def _archive_story(self, user: str, story: dict):
+        if not story["story"]:
+            return
         current_story = {
-            "topic": self.topics.pop(user, None),
-            "moral": self.morals.pop(user, None),
-            "author": self.authors.pop(user, None),
-            "structure": self.story_structures.pop(user, None),
-            "stage": self.story_stages.pop(user, None),
-            "story": self.stories.pop(user, None),
+            key: story[key]
+            for key in ("topic", "moral", "author", "structure", "stage", "story")
         }
-        if current_story["story"]:
-            self.story_archive[user].append(current_story)
+        self.story_archive.add(user, current_story)
+
+    def _on_session_evicted(self, user: str, session):
+        """
+        Keep the story of an idle user that was only kept in memory
+        :param user:
+        :param session:
+        :return:
+        """
+        self._archive_story(user, session.pop_story())
+
+    # SQLite db for the story archive, the state db is used if not set
+    ARCHIVE_DB_PATH = None
+
+    def on_story_settings_changed(self, user: str):
+        self.prefetcher.invalidate(user)
+        self.alternatives.invalidate(user)
 
     def get_user_limit(self, user: str):
         """
         Get the usage limit for a user
         :param user:
-        :return:
+        :return: story parts per usage window
         """
-        return self.DEFAULT_USER_LIMIT
+        return self.user_limits[user]
+
+    # seconds between the writes of the changed usage counters
+    QUOTA_FLUSH_INTERVAL = 5.0
 
-    def count_user_usage(self, user: str):
+    def reserve_usage(self, user: str) -> Reservation:
         """
-        Count the usage for a user
+        Hold the usage of a full story part until it's delivered
+        Usage is counted in tokens, the limit is user_limit full-length parts
         :param user:
+        :return: reservation to commit with commit_usage
+        :raises QuotaExceeded:
+        """
+        max_tokens = self.max_tokens_per_user[user]
+        return self.quota.reserve(
+            user, max_tokens, self.get_user_limit(user) * max_tokens
+        )
+
+    def commit_usage(self, reservation: Reservation, user: str, story_stage_index: int):
+        """
+        Count the tokens of the story part instead of the reserved amount
+        Nothing is counted if no part was added for the stage - the story was
+        already complete, reset meanwhile or the part was dropped
+        :param reservation:
+        :param user:
+        :param story_stage_index: the stage the part was generated for
         :return:
         """
-        self.usage[user] += 1
+        story = self.stories[user]
+        if story_stage_index >= min(self.story_stages[user], len(story)):
+            reservation.release()
+            return
+        text = story[story_stage_index]
+        reservation.commit(count_tokens(text, self.model_per_user[user]))
+
+    def is_admin(self, user: str):
+        admins = os.getenv("FAIRYTALE_ADMINS", "")
+        return user in {admin.strip() for admin in admins.split(",") if admin.strip()}
 
     def get_user_usage(self, user: str):
         """
         Get the usage for a user
         :param user:
-        :return:
+        :return: full-length story parts used in the current window
         """
-        return self.usage[user]
+        return round(self.quota.used(user) / self.max_tokens_per_user[user], 1)
 
     def generate_random_topic(self, user: str):
         """
@@ -180,6 +322,10 @@ class MainApp(UserSettings, FairytaleSettings):
         """
     )
     STORY_STRUCTURE_MAX_TOKENS = 1000
+    STRUCTURE_CACHE_SIZE = 1000
+    STRUCTURE_CACHE_TTL = 7 * 24 * 3600  # seconds
+    # number of different structures to keep for the same settings
+    STRUCTURE_CACHE_VARIANTS = 3
 
     async def generate_story_structure(
         self,
@@ -199,18 +345,230 @@ class MainApp(UserSettings, FairytaleSettings):
             or not self.get_author(user)
         ):
             raise ValueError("The topic, moral or author are not set.")
-        topic = self.get_topic(user)
-        moral = self.get_moral(user)
-        author = self.get_author(user)
-        model = self.model_per_user[user]
+        return await self._generate_story_structure(
+            topic=self.get_topic(user),
+            moral=self.get_moral(user),
+            author=self.get_author(user),
+            model=self.model_per_user[user],
+            user=user,
+        )
 
+    async def _generate_story_structure(
+        self, topic: str, moral: str, author: str, model: str, user: str = None
+    ):
+        """
+        Generate a story structure, or get one from the cache
+        :param topic:
+        :param moral:
+        :param author:
+        :param model:
+        :param user: the user waiting for it, None for background generation
+        :return:
+        """
         prompt = self.story_structure_template.format(
             topic=topic, moral=moral, author=author
         )
-        story_structure = await self.gpt.complete_text(
-            prompt, model=model, max_tokens=self.STORY_STRUCTURE_MAX_TOKENS
+        budget = PromptBudget(
+            model, max_completion_tokens=self.STORY_STRUCTURE_MAX_TOKENS
+        )
+        if not budget.fits(prompt):
+            raise ValueError("The topic, moral or author are too long.")
+
+        cache_key = self.structure_cache.make_key(prompt, model)
+        cached_structure = self.structure_cache.get(cache_key)
+        self.metrics.record_cache("structure", hit=cached_structure is not None)
+        if cached_structure is not None:
+            return copy.deepcopy(cached_structure)
+
+        story_structure = await self.complete_text(
+            prompt, model=model, max_tokens=self.STORY_STRUCTURE_MAX_TOKENS, user=user
+        )
+        story_structure = self._parse_story_structure(story_structure)
+        self.structure_cache.put(cache_key, story_structure)
+        return copy.deepcopy(story_structure)
+
+    story_structure_with_first_part_template = dedent(
+        """
+        Generate the stucture or a story 
+        with a specified topic and moral
+        and in a style of a specified author.
+        Then write a line with {delimiter} and the first part of the story,
+        for the first step of the structure.
+        
+        TOPIC:
+        {topic}
+        MORAL:
+        {moral}
+        AUTHOR:
+        {author}
+        
+        OUTPUT FORMAT:
+            [exposition]
+            - step 1
+            - step 2
+            - step 3
+            [climax]
+            - step 1
+            - step 2
+            - step 3
+            [resolution]
+            - step 1
+            - step 2
+            - step 3
+            {delimiter}
+            The first part of the story.
+        
+        STRUCTURE:
+        """
+    )
+    # /randomize writes the structure and the first part in one LLM call
+    FUSE_STRUCTURE_AND_FIRST_PART = False
+
+    async def _stream_structure_and_first_part(self, user: str) -> AsyncIterator[str]:
+        """
+        Generate the story structure and stream the first part in one call
+        The structure is set as soon as the first part begins. Nothing is
+        yielded if the structure was cached or the model wrote no first part.
+        :param user:
+        :return:
+        """
+        topic, moral, author = (
+            self.get_topic(user),
+            self.get_moral(user),
+            self.get_author(user),
+        )
+        model = self.model_per_user[user]
+        max_tokens = self.max_tokens_per_user[user]
+        # the structure is cached under the prompt of the separate call
+        cache_key = self.structure_cache.make_key(
+            self.story_structure_template.format(
+                topic=topic, moral=moral, author=author
+            ),
+            model,
+        )
+        cached_structure = self.structure_cache.get(cache_key)
+        self.metrics.record_cache("structure", hit=cached_structure is not None)
+        if cached_structure is not None:
+            self.set_story_structure(user, copy.deepcopy(cached_structure))
+            return
+
+        prompt = self.story_structure_with_first_part_template.format(
+            topic=topic, moral=moral, author=author, delimiter=STORY_DELIMITER
+        )
+        budget = PromptBudget(
+            model, max_completion_tokens=self.STORY_STRUCTURE_MAX_TOKENS + max_tokens
+        )
+        if not budget.fits(prompt):
+            raise ValueError("The topic, moral or author are too long.")
+
+        parser = FusedStoryParser()
+
+        def set_structure():
+            story_structure = parser.structure.result()
+            self._validate_story_structure(story_structure)
+            self.structure_cache.put(cache_key, story_structure)
+            self.set_story_structure(user, copy.deepcopy(story_structure))
+
+        async for chunk in self.stream_text(
+            prompt,
+            model=model,
+            max_tokens=self.STORY_STRUCTURE_MAX_TOKENS + max_tokens,
+            user=user,
+        ):
+            was_in_story = parser.in_story
+            text = parser.feed(chunk)
+            if parser.in_story and not was_in_story:
+                set_structure()
+            if text:
+                yield text
+        if not parser.in_story:
+            parser.close()
+            set_structure()
+
+    # keep ready-made random stories so that /randomize answers instantly
+    STRUCTURE_POOL_SIZE = 0  # disabled
+    STRUCTURE_POOL_LOW_WATER = 2
+    STRUCTURE_POOL_MAX_CONCURRENCY = 2
+    # also generate the first part of the pooled stories
+    STRUCTURE_POOL_FIRST_PART = False
+
+    async def _make_story_bundle(self, model: str, max_tokens: int):
+        """
+        Generate random story settings with a structure and, optionally, the first part
+        :param model:
+        :param max_tokens:
+        :return:
+        """
+        bundle = {
+            "moral": self.get_random_moral(),
+            "topic": self.get_random_topic(),
+            "author": self.get_random_author(),
+        }
+        bundle["structure"] = await self._generate_story_structure(
+            topic=bundle["topic"],
+            moral=bundle["moral"],
+            author=bundle["author"],
+            model=model,
+        )
+        if self.STRUCTURE_POOL_FIRST_PART:
+            prompt = self._format_story_prompt(
+                bundle["structure"]["raw"], [], bundle["structure"]["all_parts"][0]
+            )
+            bundle["first_part"] = await self.complete_text(
+                prompt, model=model, max_tokens=max_tokens
+            )
+        return bundle
+
+    def _get_structure_pool(self, model: str, max_tokens: int) -> StructurePool:
+        pool = self.structure_pools.get((model, max_tokens))
+        if pool is None:
+            pool = StructurePool(
+                lambda: self._make_story_bundle(model, max_tokens),
+                size=self.STRUCTURE_POOL_SIZE,
+                low_water=self.STRUCTURE_POOL_LOW_WATER,
+                max_concurrency=self.STRUCTURE_POOL_MAX_CONCURRENCY,
+            )
+            self.structure_pools[(model, max_tokens)] = pool
+        return pool
+
+    def warm_structure_pools(self):
+        """
+        Start filling the story bundle pools of all the plans
+        Needs a running event loop - called on the dispatcher startup
+        :return:
+        """
+        if not self.STRUCTURE_POOL_SIZE:
+            return
+        for tier in self.sessions.tiers.values():
+            self._get_structure_pool(tier.model, tier.max_tokens).refill()
+
+    def pop_story_bundle(self, user: str):
+        """
+        Take a ready-made random story for the user's plan
+        :param user:
+        :return: the bundle or None if the pool is empty or disabled
+        """
+        if not self.STRUCTURE_POOL_SIZE:
+            return None
+        pool = self._get_structure_pool(
+            self.model_per_user[user], self.max_tokens_per_user[user]
         )
-        return self._parse_story_structure(story_structure)
+        return pool.pop()
+
+    def use_story_bundle(self, user: str, bundle: dict):
+        """
+        Set the story settings and structure from a ready-made bundle
+        :param user:
+        :param bundle:
+        :return:
+        """
+        self.set_moral(bundle["moral"], user)
+        self.set_topic(bundle["topic"], user)
+        self.set_author(bundle["author"], user)
+        self.set_story_structure(user=user, story_structure=bundle["structure"])
+        if bundle.get("first_part") is not None:
+            # served by generate_next_story_part as if it was prefetched
+            self.prefetcher.put(user, 0, bundle["first_part"])
 
     def set_story_structure(self, user: str, story_structure: dict):
         """
@@ -220,6 +578,8 @@ class MainApp(UserSettings, FairytaleSettings):
         :return:
         """
         self.story_structures[user] = story_structure
+        self.prefetcher.invalidate(user)
+        self.alternatives.invalidate(user)
 
     @staticmethod
     def _extract_story_parts(story_structure: str):
@@ -228,8 +588,7 @@ class MainApp(UserSettings, FairytaleSettings):
         :param story_structure:
         :return:
         """
-        lines = story_structure.splitlines()
-        return [line for line in lines if line.strip().startswith("-")]
+        return extract_story_parts(story_structure)
 
     def _parse_story_structure(self, story_structure_text: str):
         """
@@ -237,30 +596,7 @@ class MainApp(UserSettings, FairytaleSettings):
         :param story_structure_text:
         :return:
         """
-        # step 1: strip unnecessary parts
-
-        headers = ["exposition", "climax", "resolution"]
-        story_structure = {
-            "raw": story_structure_text,
-            "exposition": [],
-            "climax": [],
-            "resolution": [],
-            "all_parts": [],
-        }
-        if all(header in story_structure_text for header in headers):
-
-            import re
-
-            parts = re.split("|".join(headers), story_structure_text)
-            for header, part in zip(headers, parts[1:]):
-                story_structure[header] = self._extract_story_parts(part)
-                story_structure["all_parts"].extend(story_structure[header])
-        else:
-            # just get all the lines
-            story_structure["all_parts"] = self._extract_story_parts(
-                story_structure_text
-            )
-
+        story_structure = parse_story_structure(story_structure_text)
         self._validate_story_structure(story_structure)
         return story_structure
 
@@ -294,32 +630,137 @@ class MainApp(UserSettings, FairytaleSettings):
         """
     )
 
-    def _build_story_summary(
-        self,
-        story_parts: list,
-        compression: StoryCompression = StoryCompression.FEW_LINES_PER_PART,
+    story_summary_template = dedent(
+        """
+        Summarize this part of a story in 2-3 sentences.
+        Keep the names of the characters and the key events.
+
+        STORY PART:
+        {story_part}
+
+        SUMMARY:
+        """
+    )
+    STORY_SUMMARY_MAX_TOKENS = 100
+    # summaries are cheap - don't spend the premium model on them
+    STORY_SUMMARY_MODEL = UserSettings.DEFAULT_MODEL
+
+    @staticmethod
+    def _compress_story_part(story_part: str):
+        """
+        Compress a story part to its first few sentences
+        :param story_part:
+        :return:
+        """
+        sentences = story_part.split(".", 3)
+        return ".".join(sentences[:3])
+
+    def _get_story_fragments(self, user: str):
+        """
+        Get the compressed story parts, compressing the missing ones
+        :param user:
+        :return:
+        """
+        story_parts = self.stories[user]
+        fragments = self.story_fragments[user]
+        if len(fragments) < len(story_parts):
+            fragments = fragments + [
+                self._compress_story_part(part)
+                for part in story_parts[len(fragments) :]
+            ]
+            self.story_fragments[user] = fragments
+        return fragments
+
+    def _get_story_summary_parts(
+        self, user: str, compression: StoryCompression, n_parts: int = None
     ):
         """
-        Build a summary of the story
-        :param story_parts:
+        Get the parts of the story summary
+        :param user:
         :param compression:
-        :return:
+        :param n_parts: summarize only the first n parts, default: all
+        :return: the summary parts and the compressed version of each of them
         """
+        story_parts = self.stories[user][:n_parts]
         if not story_parts:
-            return ""
+            return [], []
+        fragments = self._get_story_fragments(user)[: len(story_parts) - 1]
+        if compression == StoryCompression.LLM_SUMMARY:
+            # fall back to the first lines until the summary is ready
+            summaries = self.story_summaries[user]
+            fragments = [
+                summaries[i] if i < len(summaries) and summaries[i] else fragment
+                for i, fragment in enumerate(fragments)
+            ]
+        # add the last part as is
+        compressed_parts = [fragment + "..." for fragment in fragments]
+        compressed_parts.append(story_parts[-1])
+
         if compression == StoryCompression.COMPLETE_STORY:
-            return "\n".join(story_parts)
-        elif compression == StoryCompression.FEW_LINES_PER_PART:
-            result = ""
-            for part in story_parts[:-1]:
-                sentences = part.split(".")
-                result += ". ".join(sentences[:3]) + "...\n"
-            result += story_parts[-1]  # add the last part as is
-            return result
+            return list(story_parts), compressed_parts
+        elif compression in (
+            StoryCompression.FEW_LINES_PER_PART,
+            StoryCompression.LLM_SUMMARY,
+        ):
+            return compressed_parts, compressed_parts
         elif compression == StoryCompression.LAST_PART_ONLY:
-            return story_parts[-1]
+            return [story_parts[-1]], [story_parts[-1]]
         raise ValueError(f"Invalid compression: {compression}")
 
+    def _build_story_summary(
+        self,
+        user: str,
+        compression: StoryCompression = StoryCompression.FEW_LINES_PER_PART,
+        budget: PromptBudget = None,
+        available_tokens: int = None,
+        n_parts: int = None,
+    ):
+        """
+        Build a summary of the story from the cached compressed parts
+        :param user:
+        :param compression:
+        :param budget: if set, older parts are compressed or dropped to fit
+        :param available_tokens: tokens left for the summary in the budget
+        :param n_parts: summarize only the first n parts, default: all
+        :return: the summary parts, oldest first
+        """
+        parts, compressed_parts = self._get_story_summary_parts(
+            user, compression, n_parts
+        )
+        if budget is not None:
+            parts = budget.fit_parts(parts, compressed_parts, available_tokens)
+        return parts
+
+    async def _summarize_story_part(self, user: str, index: int, story_part: str):
+        """
+        Summarize a story part with gpt and cache the summary
+        :param user:
+        :param index: index of the part in the story
+        :param story_part:
+        :return:
+        """
+        prompt = self.story_summary_template.format(story_part=story_part)
+        try:
+            summary = await self.complete_text(
+                prompt,
+                model=self.STORY_SUMMARY_MODEL,
+                max_tokens=self.STORY_SUMMARY_MAX_TOKENS,
+            )
+        except Exception as e:
+            logger.warning(f"Failed to summarize the story part for {user}: {e}")
+            return
+        story_parts = self.stories[user]
+        # the story could have been reset while we were waiting
+        if index >= len(story_parts) or story_parts[index] != story_part:
+            return
+        summaries = self.story_summaries[user]
+        summaries = summaries + [None] * (len(story_parts) - len(summaries))
+        summaries[index] = summary.strip()
+        self.story_summaries[user] = summaries
+
+    # older story parts are compressed or dropped to keep the prompt under this
+    STORY_PROMPT_TOKEN_BUDGET = 3000
+
     def _build_story_prompt(self, user: str, story_stage_index: int):
         """
         Build the story prompt
@@ -328,23 +769,288 @@ class MainApp(UserSettings, FairytaleSettings):
         """
         story_structure = self.story_structures[user]
         story_stage = story_structure["all_parts"][story_stage_index]
+        budget = PromptBudget(
+            self.model_per_user[user],
+            max_completion_tokens=self.max_tokens_per_user[user],
+            target=self.STORY_PROMPT_TOKEN_BUDGET,
+        )
+        empty_prompt = self._format_story_prompt(
+            story_structure["raw"], [], story_stage
+        )
         story_so_far = self._build_story_summary(
-            self.stories[user], compression=self.compression_per_user[user]
+            user,
+            compression=self.compression_per_user[user],
+            budget=budget,
+            available_tokens=budget.max_prompt_tokens - budget.count(empty_prompt),
+            # the story before this stage - the stage may be regenerated
+            n_parts=story_stage_index,
         )
-        return self.story_generation_template.format(
-            structure=story_structure["raw"],
-            story=story_so_far,
-            stage=story_stage,
+        return self._format_story_prompt(
+            story_structure["raw"], story_so_far, story_stage
         )
 
+    def _format_story_prompt(
+        self, structure: str, story_parts: list, stage: str
+    ) -> ChatPrompt:
+        """
+        Lay out the story prompt with the parts that don't change first
+        The instructions, the structure and all the parts but the latest stay
+        the same for the rest of the story - they are the cacheable prefix.
+        The latest part (compressed in the next prompts) and the stage follow.
+        :param structure:
+        :param story_parts: the story so far, oldest first
+        :param stage:
+        :return:
+        """
+        head, tail = self.story_generation_template.split("{story}")
+        prefix = [head.format(structure=structure)]
+        prefix.extend(part + "\n" for part in story_parts[:-1])
+        latest_part = story_parts[-1] if story_parts else ""
+        return ChatPrompt(prefix, latest_part + tail.format(stage=stage))
+
     STORY_BEGINNING = hbold("Here comes a majestic fairytale!\n\n")
 
-    async def generate_next_story_part(self, user: str):
+    # stream story parts to the user as they are generated
+    STREAM_STORY_PARTS = True
+    # generate the next part in the background as soon as the previous is sent
+    PREFETCH_STORY_PARTS = False
+    PREFETCH_MAX_CONCURRENCY = 4
+
+    # wait between the messages to the same chat instead of getting flood errors
+    PACE_TELEGRAM_SENDS = True
+
+    # max number of LLM requests waiting for the model rate limit
+    LLM_MAX_QUEUE = 1000
+
+    async def _schedule_llm_call(
+        self,
+        call,
+        prompt: str,
+        model: str,
+        max_tokens: int,
+        user: str = None,
+    ):
         """
-        Generate the next story part
+        Run the LLM call within the user and model rate limits
+        :param call: coroutine factory making the call
+        :param prompt:
+        :param model:
+        :param max_tokens:
+        :param user: the user waiting for the call, None for background calls
+        :return:
+        """
+        if user is None:
+            priority = self.llm_scheduler.BACKGROUND_PRIORITY
+        else:
+            self.llm_scheduler.check_user(user, self.get_user_requests_per_minute(user))
+            if self.is_premium(user):
+                priority = self.llm_scheduler.PREMIUM_PRIORITY
+            else:
+                priority = self.llm_scheduler.DEFAULT_PRIORITY
+
+        labels = self._llm_labels(model, user)
+        queued_at = time.perf_counter()
+
+        async def timed_call():
+            self.metrics.llm_queue_wait.observe(
+                time.perf_counter() - queued_at, **labels
+            )
+            return await call()
+
+        return await self.llm_scheduler.submit(
+            timed_call,
+            model=model,
+            tokens=count_tokens(prompt, model) + max_tokens,
+            priority=priority,
+        )
+
+    async def complete_text(
+        self, prompt: str, model: str, max_tokens: int, user: str = None
+    ) -> str:
+        """
+        Complete the prompt with gpt
+        :param prompt:
+        :param model:
+        :param max_tokens:
+        :param user: the user waiting for the result, None for background calls
+        :return:
+        """
+        started = time.perf_counter()
+        try:
+            result = await self._schedule_llm_call(
+                lambda: self.llm_router.complete_text(
+                    prompt, model=model, max_tokens=max_tokens
+                ),
+                prompt,
+                model=model,
+                max_tokens=max_tokens,
+                user=user,
+            )
+        except Exception:
+            self.metrics.llm_errors.inc(**self._llm_labels(model, user))
+            raise
+        self._record_llm_call(prompt, result, model, user, started)
+        return result
+
+    def _llm_labels(self, model: str, user: str = None):
+        if user is None:
+            compression = "none"
+        else:
+            compression = self.compression_per_user[user].name
+        return {
+            "handler": current_handler.get(),
+            "model": model,
+            "compression": compression,
+        }
+
+    def _record_llm_call(
+        self,
+        prompt: str,
+        completion: str,
+        model: str,
+        user: str,
+        started: float,
+        first_token_at: float = None,
+    ):
+        """
+        Record the latency and token usage of an LLM call
+        :param prompt:
+        :param completion:
+        :param model:
         :param user:
+        :param started: time.perf_counter() when the call was made
+        :param first_token_at: time.perf_counter() when the first token arrived
+        :return:
+        """
+        finished = time.perf_counter()
+        labels = self._llm_labels(model, user)
+        prompt_tokens = count_tokens(prompt, model)
+        completion_tokens = count_tokens(completion, model)
+        self.metrics.llm_duration.observe(finished - started, **labels)
+        self.metrics.llm_time_to_first_token.observe(
+            (first_token_at or finished) - started, **labels
+        )
+        self.metrics.prompt_tokens.inc(prompt_tokens, **labels)
+        self.metrics.completion_tokens.inc(completion_tokens, **labels)
+        prefix_ratio = 0.0
+        if isinstance(prompt, ChatPrompt) and prompt_tokens:
+            prefix_ratio = count_tokens(prompt.prefix, model) / prompt_tokens
+        self.metrics.prompt_prefix_ratio.observe(prefix_ratio, **labels)
+        cached_tokens = count_tokens(self.prefix_cache.match(model, prompt), model)
+        self.prefix_cache.add(model, prompt)
+        self.metrics.cached_prompt_tokens.inc(cached_tokens, **labels)
+        logger.info(
+            f"LLM call: model={model}"
+            f" prompt_tokens={prompt_tokens}"
+            f" cached_tokens={cached_tokens}"
+            f" prefix_ratio={prefix_ratio:.2f}"
+            f" completion_tokens={completion_tokens}"
+            f" duration={finished - started:.2f}s"
+        )
+
+    @cached_property
+    def _openai_client(self):
+        try:
+            from openai import AsyncOpenAI
+        except ImportError:
+            logger.warning("openai is not installed, streaming is disabled")
+            return None
+        try:
+            return AsyncOpenAI()
+        except Exception as e:  # no api key
+            logger.warning(f"OpenAI client is not available: {e}")
+            return None
+
+    # send requests slower than the backend's p95 to a second provider too,
+    # off by default - a hedged request can cost twice
+    LLM_HEDGE_REQUESTS = False
+
+    @cached_property
+    def llm_router(self) -> LLMRouter:
+        return LLMRouter(self._make_llm_backends(), hedge=self.LLM_HEDGE_REQUESTS)
+
+    def _make_llm_backends(self):
+        """
+        The LLM providers to route between
+        FAIRYTALE_LLM_PROVIDERS adds OpenAI-compatible providers, a json list of
+        {"name", "base_url", "api_key_env", "models": {our model: their model}}
+        FAIRYTALE_LOCAL_LLM=1 adds the local stand-in, for development
+        A fake gpt is used alone, tests and benchmarks don't call the providers
         :return:
         """
+        models = {
+            model: model
+            for model in (
+                self.DEFAULT_MODEL,
+                self.PREMIUM_MODEL,
+                self.STORY_SUMMARY_MODEL,
+            )
+        }
+        gpt = getattr(self, "gpt", None)
+        if isinstance(gpt, FakeGptPlugin):
+            return [PluginBackend("gpt", gpt, models, provider="local")]
+        backends = []
+        if gpt is not None:
+            # GptPlugin calls the OpenAI API as well
+            backends.append(PluginBackend("gpt", gpt, models, provider="openai"))
+        if self._openai_client is not None:
+            backends.append(OpenAIBackend("openai", self._openai_client, models))
+        for provider in json.loads(os.getenv("FAIRYTALE_LLM_PROVIDERS", "[]")):
+            from openai import AsyncOpenAI
+
+            client = AsyncOpenAI(
+                base_url=provider["base_url"],
+                api_key=os.getenv(provider["api_key_env"]),
+            )
+            backends.append(OpenAIBackend(provider["name"], client, provider["models"]))
+        if os.getenv("FAIRYTALE_LOCAL_LLM"):
+            backends.append(PluginBackend("local", FakeGptPlugin(), models))
+        return backends
+
+    async def stream_text(
+        self, prompt: str, model: str, max_tokens: int, user: str = None
+    ) -> AsyncIterator[str]:
+        """
+        Complete the prompt with gpt, yielding the text as it is generated
+        Falls back to a single chunk if streaming is not available
+        :param prompt:
+        :param model:
+        :param max_tokens:
+        :param user: the user waiting for the result, None for background calls
+        :return:
+        """
+        if not self.llm_router.candidates(model, streaming=True):
+            yield await self.complete_text(
+                prompt, model=model, max_tokens=max_tokens, user=user
+            )
+            return
+        started = time.perf_counter()
+        first_token_at = None
+        stream = await self._schedule_llm_call(
+            lambda: self.llm_router.stream_text(
+                prompt, model=model, max_tokens=max_tokens
+            ),
+            prompt,
+            model=model,
+            max_tokens=max_tokens,
+            user=user,
+        )
+        chunks = []
+        async for chunk in stream:
+            if first_token_at is None:
+                first_token_at = time.perf_counter()
+            chunks.append(chunk)
+            yield chunk
+        self._record_llm_call(
+            prompt, "".join(chunks), model, user, started, first_token_at
+        )
+
+    def _begin_story_part(self, user: str):
+        """
+        Check that the next story part can be generated
+        :param user:
+        :return: stage index, text to put before the part, whether to generate
+        """
         story_stage_index = self.story_stages[user]
         # check if story is already started
         result = ""
@@ -360,7 +1066,7 @@ class MainApp(UserSettings, FairytaleSettings):
                     "Use /randomize to generate them."
                     "Or set them manually using /set_topic, /set_moral, /set_author"
                 )
-                return result
+                return story_stage_index, result, False
             result += self.STORY_BEGINNING
 
         elif story_stage_index >= len(self.story_structures[user]["all_parts"]):
@@ -368,21 +1074,298 @@ class MainApp(UserSettings, FairytaleSettings):
             result += "Use /begin or /randomize to start over"
             # todo: keep telling the story if the user really wants to?
             result += "Psst.. /sequel command is in development. Don't tell anyone!"
-            return result
+            return story_stage_index, result, False
+        return story_stage_index, result, True
 
-        # generate using gpt
+    async def _generate_story_part_text(self, user: str, story_stage_index: int):
+        """
+        Generate the text of a story part, using the prefetched one if available
+        :param user:
+        :param story_stage_index:
+        :return:
+        """
+        prefetched = await self.prefetcher.pop(user, story_stage_index)
+        self.metrics.record_cache("prefetch", hit=prefetched is not None)
+        if prefetched is not None:
+            return prefetched
         prompt = self._build_story_prompt(user, story_stage_index)
+        cached = self._get_cached_story_part(user, prompt)
+        if cached is not None:
+            return cached
         # todo: use langchain instead of gpt to auto-enable the tracking etc...
-        result += await self.gpt.complete_text(
+        story_part = await self.complete_text(
             prompt,
             model=self.model_per_user[user],
             max_tokens=self.max_tokens_per_user[user],
+            user=user,
         )
+        self._cache_story_part(user, prompt, story_part)
+        return story_part
+
+    # story parts of identical prompts - see get_response_cache_mode for tiers
+    RESPONSE_CACHE_SIZE = 2000
+    RESPONSE_CACHE_TTL = 24 * 3600  # seconds
+    # min cosine similarity of the prompts for the SIMILAR mode
+    RESPONSE_CACHE_SIMILARITY = 0.95
 
-        # add the response to the story
+    def _get_cached_story_part(self, user: str, prompt: str):
+        mode = self.get_response_cache_mode(user)
+        if mode == ResponseCacheMode.OFF:
+            return None
+        story_part = self.response_cache.get(
+            prompt,
+            model=self.model_per_user[user],
+            max_tokens=self.max_tokens_per_user[user],
+            mode=mode,
+        )
+        self.metrics.record_cache("response", hit=story_part is not None)
+        return story_part
+
+    def _cache_story_part(self, user: str, prompt: str, story_part: str):
+        if self.get_response_cache_mode(user) == ResponseCacheMode.OFF:
+            return
+        self.response_cache.put(
+            prompt,
+            model=self.model_per_user[user],
+            max_tokens=self.max_tokens_per_user[user],
+            response=story_part,
+        )
+
+    def schedule_prefetch(self, user: str):
+        """
+        Start generating the next story part in the background
+        :param user:
+        :return:
+        """
+        if not self.PREFETCH_STORY_PARTS or user not in self.story_structures:
+            return
+        story_stage_index = self.story_stages[user]
+        if story_stage_index >= len(self.story_structures[user]["all_parts"]):
+            return
+        # build the prompt now - the story may change before the task starts
+        prompt = self._build_story_prompt(user, story_stage_index)
+        model = self.model_per_user[user]
+        max_tokens = self.max_tokens_per_user[user]
+        self.prefetcher.schedule(
+            user,
+            story_stage_index,
+            lambda: self.complete_text(prompt, model=model, max_tokens=max_tokens),
+        )
+
+    def _add_story_part(self, user: str, story_part: str, story_stage_index: int):
+        """
+        Add the generated part to the story and move to the next stage
+        :param user:
+        :param story_part:
+        :param story_stage_index: the stage the part was generated for
+        :return: whether the part was added
+        """
+        if self.story_stages[user] != story_stage_index:
+            # the story was reset or changed while we were generating
+            logger.warning(f"Dropping an outdated story part for {user}")
+            return False
         self.story_stages[user] += 1
-        self.stories[user].append(result)
-        return result
+        story_parts = self.stories[user] + [story_part]
+        self.stories[user] = story_parts
+        self.alternatives.invalidate(user)
+        self._on_story_part_added(user, story_stage_index, story_part)
+        return True
+
+    def _on_story_part_added(self, user: str, index: int, story_part: str):
+        self._get_story_fragments(user)
+        if self.compression_per_user[user] == StoryCompression.LLM_SUMMARY:
+            task = asyncio.create_task(
+                self._summarize_story_part(user, index, story_part)
+            )
+            self._summary_tasks.add(task)
+            task.add_done_callback(self._summary_tasks.discard)
+
+    # versions of the story part generated at once by /regenerate
+    REGENERATE_CANDIDATES = 3
+
+    def has_story_part_alternative(self, user: str) -> bool:
+        """
+        Whether /regenerate can swap the last part without a new generation
+        :param user:
+        :return:
+        """
+        return self.alternatives.has(user, self.story_stages[user] - 1)
+
+    async def regenerate_story_part(self, user: str):
+        """
+        Replace the last story part with another version
+        Spares are generated in the background along with the new version,
+        so the next /regenerate is an instant swap
+        Swapping in a spare is free - it was charged when generated, a new
+        version is charged like any other story part
+        :param user:
+        :return: the new story part, None if there's nothing to regenerate
+        :raises QuotaExceeded: if there's no spare and no quota left
+        """
+        async with self.user_locks.lock(user):
+            story_stage_index = self.story_stages[user] - 1
+            if story_stage_index < 0 or len(self.stories[user]) <= story_stage_index:
+                return None
+            story_part = await self.alternatives.pop(user, story_stage_index)
+            self.metrics.record_cache("alternatives", hit=story_part is not None)
+            if story_part is None:
+                story_part = await self._generate_story_part_versions(
+                    user, story_stage_index
+                )
+            if story_stage_index == 0:
+                story_part = self.STORY_BEGINNING + story_part
+            self._replace_story_part(user, story_part, story_stage_index)
+            return story_part
+
+    async def _generate_story_part_versions(self, user: str, story_stage_index: int):
+        """
+        Generate a new version of a story part and start the spares
+        :param user:
+        :param story_stage_index:
+        :return: the new version
+        :raises QuotaExceeded:
+        """
+        with self.reserve_usage(user) as reservation:
+            prompt = self._build_story_prompt(user, story_stage_index)
+            model = self.model_per_user[user]
+            max_tokens = self.max_tokens_per_user[user]
+
+            async def generate_spare():
+                # spares are charged when generated, swapping one in is free
+                with self.reserve_usage(user) as spare_reservation:
+                    spare = await self.complete_text(
+                        prompt, model=model, max_tokens=max_tokens
+                    )
+                    spare_reservation.commit(count_tokens(spare, model))
+                    return spare
+
+            # the spares are background calls - the user waits only for one
+            self.alternatives.generate(
+                user,
+                story_stage_index,
+                generate_spare,
+                n=self.REGENERATE_CANDIDATES - 1,
+            )
+            story_part = await self.complete_text(
+                prompt, model=model, max_tokens=max_tokens, user=user
+            )
+            reservation.commit(count_tokens(story_part, model))
+            return story_part
+
+    def _replace_story_part(self, user: str, story_part: str, story_stage_index: int):
+        """
+        Replace a story part, dropping everything derived from the old one
+        :param user:
+        :param story_part:
+        :param story_stage_index:
+        :return:
+        """
+        self.stories[user] = self.stories[user][:story_stage_index] + [story_part]
+        self.story_stages[user] = story_stage_index + 1
+        self.story_fragments[user] = self.story_fragments[user][:story_stage_index]
+        self.story_summaries[user] = self.story_summaries[user][:story_stage_index]
+        # the prefetched next part continues the old version
+        self.prefetcher.invalidate(user)
+        self._on_story_part_added(user, story_stage_index, story_part)
+
+    def is_generating_story_part(self, user: str):
+        return self.user_locks.is_locked(user)
+
+    async def generate_next_story_part(
+        self, user: str, generate_structure: bool = False
+    ):
+        """
+        Generate the next story part
+        Concurrent calls for the same user share one generation
+        :param user:
+        :param generate_structure: see stream_next_story_part
+        :return:
+        """
+        if generate_structure:
+            return "".join(
+                [
+                    chunk
+                    async for chunk in self.stream_next_story_part(
+                        user, generate_structure=True
+                    )
+                ]
+            )
+        return await self.story_part_calls.run(
+            user, lambda: self._generate_next_story_part(user)
+        )
+
+    async def _generate_next_story_part(self, user: str):
+        async with self.user_locks.lock(user):
+            story_stage_index, result, ready = self._begin_story_part(user)
+            if not ready:
+                return result
+
+            # generate using gpt
+            result += await self._generate_story_part_text(user, story_stage_index)
+
+            # add the response to the story
+            self._add_story_part(user, result, story_stage_index)
+            return result
+
+    async def stream_next_story_part(
+        self, user: str, generate_structure: bool = False
+    ) -> AsyncIterator[str]:
+        """
+        Generate the next story part, yielding the text as it is generated
+        The part is added to the story only once the generation is complete
+        :param user:
+        :param generate_structure: if the story has no structure yet, generate
+            it in the same LLM call as the first part
+        :return:
+        """
+        async with self.user_locks.lock(user):
+            story_stage_index, result, ready = self._begin_story_part(user)
+            if result:
+                yield result
+            if not ready:
+                return
+
+            chunks = [result]
+            if generate_structure and user not in self.story_structures:
+                async with aclosing(
+                    self._stream_structure_and_first_part(user)
+                ) as stream:
+                    async for chunk in stream:
+                        chunks.append(chunk)
+                        yield chunk
+                if len(chunks) > 1:
+                    self._add_story_part(user, "".join(chunks), story_stage_index)
+                    return
+                # the structure alone - the first part is generated as usual
+
+            prefetched = await self.prefetcher.pop(user, story_stage_index)
+            self.metrics.record_cache("prefetch", hit=prefetched is not None)
+            if prefetched is not None:
+                chunks.append(prefetched)
+                yield prefetched
+                self._add_story_part(user, "".join(chunks), story_stage_index)
+                return
+
+            prompt = self._build_story_prompt(user, story_stage_index)
+            cached = self._get_cached_story_part(user, prompt)
+            if cached is not None:
+                chunks.append(cached)
+                yield cached
+                self._add_story_part(user, "".join(chunks), story_stage_index)
+                return
+
+            async for chunk in self.stream_text(
+                prompt,
+                model=self.model_per_user[user],
+                max_tokens=self.max_tokens_per_user[user],
+                user=user,
+            ):
+                chunks.append(chunk)
+                yield chunk
+            self._cache_story_part(user, prompt, "".join(chunks[1:]))
+
+            # add the response to the story
+            self._add_story_part(user, "".join(chunks), story_stage_index)
 
 
 class MainHandler(Handler):
@@ -405,68 +1388,254 @@ class MainHandler(Handler):
 
     async def randomize_handler(self, message: Message, app: MainApp, bot: Bot):
         user = self.get_user(message)
+        # check usage before the story is reset or anything is generated
+        try:
+            reservation = app.reserve_usage(user)
+        except QuotaExceeded as e:
+            await message.answer(self._usage_limit_message(e))
+            return
+        # the first part is generated under this reservation
+        with reservation:
+            # a new structure means a new story - archive the current one
+            app.reset(user)
 
-        moral = app.get_random_moral()
-        app.set_moral(moral, user)
-        topic = app.get_random_topic()
-        app.set_topic(topic, user)
-        author = app.get_random_author()
-        app.set_author(author, user)
-        response_text = dedent(
-            f"""
-            Moral set to {moral}
-            Topic set to {topic}
-            Author set to {author}
-            """
-        )
-        await message.answer(response_text)
-        story_structure = await app.generate_story_structure(
-            # topic, moral, author,
-            user
-        )
-        # precalc
-        app.set_story_structure(user=user, story_structure=story_structure)
-        # start generating the story right away - why wait?
-        temp_message_text = "Generating the next part of the story..."
-        # send typing action
-        temp_message = await message.answer(temp_message_text)
-        await self.generate_next_story_part_handler(message, app, bot)
-        await temp_message.delete()
+            bundle = app.pop_story_bundle(user)
+            if bundle is not None:
+                app.use_story_bundle(user, bundle)
+                response_text = dedent(
+                    f"""
+                    Moral set to {bundle["moral"]}
+                    Topic set to {bundle["topic"]}
+                    Author set to {bundle["author"]}
+                    """
+                )
+                await message.answer(response_text)
+                await self.generate_next_story_part_handler(
+                    message, app, bot, reservation=reservation
+                )
+                return
+
+            moral = app.get_random_moral(user=user)
+            app.set_moral(moral, user)
+            topic = app.get_random_topic(user=user)
+            app.set_topic(topic, user)
+            author = app.get_random_author(user=user)
+            app.set_author(author, user)
+            response_text = dedent(
+                f"""
+                Moral set to {moral}
+                Topic set to {topic}
+                Author set to {author}
+                """
+            )
+            await message.answer(response_text)
+            if app.FUSE_STRUCTURE_AND_FIRST_PART:
+                # one LLM call: the part is shown as soon as the structure is done
+                await self.generate_next_story_part_handler(
+                    message, app, bot, generate_structure=True, reservation=reservation
+                )
+                return
+            try:
+                story_structure = await app.generate_story_structure(
+                    # topic, moral, author,
+                    user
+                )
+            except (RateLimitExceeded, SchedulerOverloaded) as e:
+                await message.answer(self._rate_limit_message(e))
+                return
+            # precalc
+            app.set_story_structure(user=user, story_structure=story_structure)
+            # start generating the story right away - why wait?
+            temp_message_text = "Generating the next part of the story..."
+            # send typing action
+            temp_message = await message.answer(temp_message_text)
+            await self.generate_next_story_part_handler(
+                message, app, bot, reservation=reservation
+            )
+            await temp_message.delete()
 
     async def generate_next_story_part_handler(
-        self, message: Message, app: MainApp, bot: Bot
+        self,
+        message: Message,
+        app: MainApp,
+        bot: Bot,
+        generate_structure: bool = False,
+        reservation: Reservation = None,
     ):
         """
         Generate the next story part
+        :param generate_structure: generate the structure in the same LLM call,
+            for a new story
+        :param reservation: usage already reserved by the caller, e.g. /randomize
         """
         user = self.get_user(message)
-        # check usage
+        if app.is_generating_story_part(user):
+            # the previous command is still running and will send the part
+            await message.answer("Still writing the previous part, hold on...")
+            return
+        # hold the user before the first await - a /continue sent meanwhile
+        # is turned away by the check above
+        with app.user_locks.hold(user):
+            # check usage
+            if reservation is None:
+                try:
+                    reservation = app.reserve_usage(user)
+                except QuotaExceeded as e:
+                    await message.answer(self._usage_limit_message(e))
+                    return
 
-        # todo: if this is the first part
-        #  - notify the user of the parameters of the generation
+            # todo: if this is the first part
+            #  - notify the user of the parameters of the generation
 
-        # todo: add emoji - 'generating' - ⌛ - extract id from message via debug
-        # temp_message_text = "Generating the next part of the story..."
-        # temp_message = await message.answer(temp_message_text)
+            # todo: add emoji - 'generating' - ⌛ - extract id from message via debug
+            # temp_message_text = "Generating the next part of the story..."
+            # temp_message = await message.answer(temp_message_text)
 
-        chat_id = message.chat.id
-        # set bot typing effect
-        await bot.send_chat_action(chat_id=chat_id, action=ChatAction.TYPING)
-        try:
-            response_text = ""
-            response_text += await app.generate_next_story_part(user)
+            chat_id = message.chat.id
+            story_stage_index = app.story_stages[user]
+            try:
+                # set bot typing effect
+                await bot.send_chat_action(chat_id=chat_id, action=ChatAction.TYPING)
+                if app.STREAM_STORY_PARTS:
+                    await self._stream_story_part(
+                        message, app, user, generate_structure
+                    )
+                else:
+                    response_text = ""
+                    response_text += await app.generate_next_story_part(
+                        user, generate_structure=generate_structure
+                    )
 
-            response_text += "\n\n/continue ..."
-            await message.answer(response_text)
-            app.count_user_usage(user)
-        except Exception as e:
-            error_message = "Failed, sorry :("
-            await message.answer(error_message)
+                    response_text += self.CONTINUE_SUFFIX
+                    await send_text(message, response_text, app.chat_pacer)
+                app.commit_usage(reservation, user, story_stage_index)
+                app.schedule_prefetch(user)
+            except (RateLimitExceeded, SchedulerOverloaded) as e:
+                await message.answer(self._rate_limit_message(e))
+            except Exception as e:
+                logger.exception(e)
+                error_message = "Failed, sorry :("
+                await message.answer(error_message)
+            finally:
+                reservation.release()
         # await temp_message.delete()
         # unset bot typing effect
         # todo: test if i need to do that?
         # bot.send_chat_action(message.chat.id, action=ChatAction.)
 
+    USAGE_LIMIT_MESSAGE = (
+        "You have used all your stories. Use /upgrade to get more of them."
+    )
+
+    def _usage_limit_message(self, error: QuotaExceeded):
+        if error.retry_after is None:
+            return self.USAGE_LIMIT_MESSAGE
+        minutes = error.retry_after / 60
+        if minutes < 60:
+            wait = f"{minutes:.0f} minutes"
+        elif minutes < 48 * 60:
+            wait = f"{minutes / 60:.0f} hours"
+        else:
+            wait = f"{minutes / (24 * 60):.0f} days"
+        return f"{self.USAGE_LIMIT_MESSAGE}\nOr come back in {wait}."
+
+    @staticmethod
+    def _rate_limit_message(error: Exception):
+        if isinstance(error, RateLimitExceeded):
+            return f"Not so fast! Please try again in {error.retry_after:.0f} seconds."
+        return "The storyteller is busy right now, please try again in a minute."
+
+    CONTINUE_SUFFIX = "\n\n/continue ..."
+    # telegram throttles frequent edits of the same message
+    STREAM_EDIT_INTERVAL = 1.0  # seconds
+
+    async def _stream_story_part(
+        self,
+        message: Message,
+        app: MainApp,
+        user: str,
+        generate_structure: bool = False,
+    ):
+        """
+        Send the story part as soon as the first text arrives
+        and keep editing the message while the rest is generated
+        Text over the Telegram limit goes on in the next message
+        """
+        chunks = []
+        sent_messages = []
+        sent_texts = []
+        last_edit = 0.0
+        async with aclosing(
+            app.stream_next_story_part(user, generate_structure=generate_structure)
+        ) as stream:
+            async for chunk in stream:
+                chunks.append(chunk)
+                now = time.monotonic()
+                if sent_messages and now - last_edit < self.STREAM_EDIT_INTERVAL:
+                    continue
+                text = "".join(chunks)
+                if not text.strip():
+                    continue
+                await self._show_pieces(
+                    message, app, split_message(text), sent_messages, sent_texts
+                )
+                last_edit = now
+
+        text = "".join(chunks) + self.CONTINUE_SUFFIX
+        await self._show_pieces(
+            message, app, split_message(text), sent_messages, sent_texts
+        )
+
+    @staticmethod
+    async def _show_pieces(
+        message: Message,
+        app: MainApp,
+        pieces: list,
+        sent_messages: list,
+        sent_texts: list,
+    ):
+        """
+        Edit the sent messages to show the pieces, sending the new ones
+        """
+        for i, piece in enumerate(pieces):
+            if i == len(sent_messages):
+                sent_message = await send_paced(
+                    lambda: message.answer(piece), message.chat.id, app.chat_pacer
+                )
+                sent_messages.append(sent_message)
+                sent_texts.append(piece)
+            # telegram ignores the surrounding whitespace and rejects edits
+            # that don't change the text
+            elif piece.strip() != sent_texts[i].strip():
+                try:
+                    await send_paced(
+                        lambda: sent_messages[i].edit_text(piece),
+                        message.chat.id,
+                        app.chat_pacer,
+                    )
+                except TelegramBadRequest as e:
+                    if "message is not modified" not in e.message:
+                        raise
+                sent_texts[i] = piece
+
+    async def stats_handler(self, message: Message, app: MainApp):
+        """Show the latency and token stats (admins only)"""
+        user = self.get_user(message)
+        if not app.is_admin(user):
+            await message.answer("This command is for admins only.")
+            return
+        await send_text(
+            message,
+            app.metrics.summary()
+            + "\nLLM backends:\n"
+            + app.llm_router.summary()
+            + "\n"
+            + app.response_cache.summary(),
+            app.chat_pacer,
+        )
+
+    commands["stats_handler"] = "stats"
+
     async def reset_handler(self, message: Message, app: MainApp):
         user = self.get_user(message)
         app.reset(user)
@@ -475,6 +1644,40 @@ class MainHandler(Handler):
 
     commands["reset_handler"] = "reset"
 
+    async def regenerate_handler(self, message: Message, app: MainApp, bot: Bot):
+        """Regenerate the last part of the story"""
+        user = self.get_user(message)
+        if not app.stories[user]:
+            await message.answer("There's nothing to regenerate yet. Use /continue")
+            return
+        if app.is_generating_story_part(user):
+            await message.answer("Still writing the previous part, hold on...")
+            return
+        with app.user_locks.hold(user):
+            try:
+                await bot.send_chat_action(
+                    chat_id=message.chat.id, action=ChatAction.TYPING
+                )
+                response_text = await app.regenerate_story_part(user)
+                if response_text is None:
+                    await message.answer(
+                        "There's nothing to regenerate yet. Use /continue"
+                    )
+                    return
+                await send_text(
+                    message, response_text + self.CONTINUE_SUFFIX, app.chat_pacer
+                )
+                app.schedule_prefetch(user)
+            except QuotaExceeded as e:
+                await message.answer(self._usage_limit_message(e))
+            except (RateLimitExceeded, SchedulerOverloaded) as e:
+                await message.answer(self._rate_limit_message(e))
+            except Exception as e:
+                logger.exception(e)
+                await message.answer("Failed, sorry :(")
+
+    commands["regenerate_handler"] = "regenerate"
+
     # @staticmethod
     # def strip_command(text: str):
     #     if text.startswith("/"):
@@ -483,23 +1686,88 @@ class MainHandler(Handler):
     #             return parts[1].strip()
     #         return ""
 
-    async def archive_handler(self, message: Message, app: MainApp):
+    ARCHIVE_PAGE_SIZE = 10
+
+    async def archive_handler(self, message: Message, app: MainApp, bot: Bot):
+        """
+        /archive [page N] - list the archived stories
+        /archive i - get the i-th story as a file
+        /archive all - get all the stories as one file
+        """
         user = self.get_user(message)
         # await self._extract_message_text(message) - support voice messages?
         text = self.strip_command(message.text)
         if text and text.isdigit():
-            index = int(text) - 1
-            story = app.story_archive[user][index]
-            story_text = "\n\n".join(story["story"])
-            await self._send_as_file(
-                chat_id=message.chat.id,
-                text=story_text,
-                filename=f"story_{text}.txt",
+            story = app.story_archive.get(user, int(text))
+            if story is None:
+                await message.answer(f"There's no story {text} in your archive.")
+                return
+
+            def story_chunks():
+                for part in story["story"]:
+                    yield part + "\n\n"
+
+            await self._send_file(
+                bot, message, app, StreamedFile(story_chunks, f"story_{text}.txt")
             )
-        else:
-            N = len(app.story_archive[user])
-            response_text = (
-                f"Your archive contains {N} stories. "
-                "Use /archive i to view the i-th story."
+            return
+
+        if text == "all":
+            if not app.story_archive.count(user):
+                await message.answer("Your archive is empty.")
+                return
+
+            def archive_chunks():
+                # one story in memory at a time
+                for index, story in app.story_archive.iter_stories(user):
+                    yield f"{index}. {story.get('topic') or 'Untitled'}\n\n"
+                    for part in story["story"] or []:
+                        yield part + "\n\n"
+
+            await self._send_file(
+                bot, message, app, StreamedFile(archive_chunks, "stories.txt")
             )
-            await message.answer(response_text)
+            return
+
+        page = 1
+        if text.startswith("page"):
+            page_text = text[len("page") :].strip()
+            if not page_text.isdigit() or int(page_text) < 1:
+                await message.answer("Use /archive page N to see the N-th page.")
+                return
+            page = int(page_text)
+        N = app.story_archive.count(user)
+        pages = max(1, -(-N // self.ARCHIVE_PAGE_SIZE))
+        if page > pages:
+            await message.answer(f"There's no page {page}, your archive has {pages}.")
+            return
+        stories = app.story_archive.list(
+            user,
+            offset=(page - 1) * self.ARCHIVE_PAGE_SIZE,
+            limit=self.ARCHIVE_PAGE_SIZE,
+        )
+        response_text = (
+            f"Your archive contains {N} stories. "
+            "Use /archive i to view the i-th story."
+        )
+        if stories:
+            response_text += f"\n\nPage {page}/{pages}:\n" + "\n".join(
+                html_decoration.quote(
+                    f"{story['index']}. {story['title']}"
+                    + (f" ({story['author']})" if story["author"] else "")
+                )
+                for story in stories
+            )
+        if page < pages:
+            response_text += f"\n\nNext page: /archive page {page + 1}"
+        await send_text(message, response_text, app.chat_pacer)
+
+    @staticmethod
+    async def _send_file(bot: Bot, message: Message, app: MainApp, file: StreamedFile):
+        await send_paced(
+            lambda: bot.send_document(chat_id=message.chat.id, document=file),
+            message.chat.id,
+            app.chat_pacer,
+        )
+
+    commands["archive_handler"] = "archive"
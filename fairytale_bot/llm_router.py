@@ -0,0 +1,372 @@
+import asyncio
+import time
+from collections import deque
+from typing import AsyncIterator, Awaitable, Callable, Dict, List, Optional
+
+from loguru import logger
+
+from fairytale_bot.prompt_cache import to_messages
+
+
+class NoBackendAvailable(Exception):
+    """No healthy backend serves the requested model"""
+
+
+class LLMBackend:
+    """
+    A provider of completions
+
+    `models` maps the model names used by the bot (gpt-3.5-turbo, gpt-4)
+    to the names of the equivalent models of this provider.
+    `provider` is who serves the requests, the name by default - backends of
+    the same provider share its outages and rate limits.
+    """
+
+    supports_streaming = False
+
+    def __init__(self, name: str, models: Dict[str, str], provider: str = None):
+        self.name = name
+        self.models = models
+        self.provider = provider or name
+
+    async def complete_text(self, prompt: str, model: str, max_tokens: int) -> str:
+        raise NotImplementedError
+
+    async def stream_text(
+        self, prompt: str, model: str, max_tokens: int
+    ) -> AsyncIterator[str]:
+        raise NotImplementedError
+        yield
+
+
+class PluginBackend(LLMBackend):
+    """
+    Backend calling a bot_lib style plugin: GptPlugin or the local FakeGptPlugin
+    """
+
+    def __init__(self, name: str, plugin, models: Dict[str, str], provider=None):
+        super().__init__(name, models, provider)
+        self.plugin = plugin
+        self.supports_streaming = hasattr(plugin, "stream_text")
+
+    async def complete_text(self, prompt: str, model: str, max_tokens: int) -> str:
+        return await self.plugin.complete_text(
+            prompt, model=model, max_tokens=max_tokens
+        )
+
+    async def stream_text(
+        self, prompt: str, model: str, max_tokens: int
+    ) -> AsyncIterator[str]:
+        async for chunk in self.plugin.stream_text(
+            prompt, model=model, max_tokens=max_tokens
+        ):
+            yield chunk
+
+
+class OpenAIBackend(LLMBackend):
+    """
+    Backend calling an OpenAI-compatible chat completions API
+    """
+
+    supports_streaming = True
+
+    def __init__(self, name: str, client, models: Dict[str, str], provider=None):
+        """
+        :param name:
+        :param client: openai.AsyncOpenAI, base_url can point to any compatible API
+        :param models:
+        :param provider:
+        """
+        super().__init__(name, models, provider)
+        self.client = client
+
+    async def complete_text(self, prompt: str, model: str, max_tokens: int) -> str:
+        response = await self.client.chat.completions.create(
+            model=model,
+            messages=to_messages(prompt),
+            max_tokens=max_tokens,
+        )
+        return response.choices[0].message.content
+
+    async def stream_text(
+        self, prompt: str, model: str, max_tokens: int
+    ) -> AsyncIterator[str]:
+        response = await self.client.chat.completions.create(
+            model=model,
+            messages=to_messages(prompt),
+            max_tokens=max_tokens,
+            stream=True,
+        )
+        async for chunk in response:
+            if chunk.choices and chunk.choices[0].delta.content:
+                yield chunk.choices[0].delta.content
+
+
+class BackendStats:
+    """
+    Rolling latency and error rate of a backend, with a circuit breaker
+
+    The breaker opens after `failure_threshold` consecutive failures and
+    lets a single trial call through after `cooldown` seconds.
+    """
+
+    def __init__(
+        self, window: int = 100, failure_threshold: int = 5, cooldown: float = 30.0
+    ):
+        self.latencies = deque(maxlen=window)
+        # time to the first chunk of streamed calls
+        self.stream_latencies = deque(maxlen=window)
+        self.outcomes = deque(maxlen=window)  # True for errors
+        self.failure_threshold = failure_threshold
+        self.cooldown = cooldown
+        self.consecutive_failures = 0
+        self.opened_at: Optional[float] = None
+        self._trial_in_flight = False
+
+    @property
+    def error_rate(self) -> float:
+        return sum(self.outcomes) / len(self.outcomes) if self.outcomes else 0.0
+
+    def quantile(self, q: float, streaming: bool = False) -> Optional[float]:
+        latencies = self.stream_latencies if streaming else self.latencies
+        if not latencies:
+            return None
+        latencies = sorted(latencies)
+        return latencies[min(len(latencies) - 1, int(len(latencies) * q))]
+
+    @property
+    def is_open(self) -> bool:
+        return self.opened_at is not None
+
+    def allows_request(self) -> bool:
+        if self.opened_at is None:
+            return True
+        if self._trial_in_flight:
+            return False
+        return time.monotonic() - self.opened_at >= self.cooldown
+
+    def record_start(self):
+        if self.opened_at is not None:
+            self._trial_in_flight = True
+
+    def record_success(self, latency: float, streaming: bool = False):
+        (self.stream_latencies if streaming else self.latencies).append(latency)
+        self.outcomes.append(False)
+        self.consecutive_failures = 0
+        self.opened_at = None
+        self._trial_in_flight = False
+
+    def record_failure(self):
+        self.outcomes.append(True)
+        self.consecutive_failures += 1
+        self._trial_in_flight = False
+        if self.opened_at is not None or (
+            self.consecutive_failures >= self.failure_threshold
+        ):
+            # (re)open - a failed trial waits for another cooldown
+            self.opened_at = time.monotonic()
+
+    def record_cancel(self):
+        self._trial_in_flight = False
+
+
+class LLMRouter:
+    """
+    Sends each request to the fastest healthy backend serving the model
+
+    Backends are ranked by their rolling median latency. Failed requests fail
+    over to the next backend. With hedging on, a request that runs longer
+    than the p95 of its backend is hedged: the next backend gets the same
+    request and the first answer wins. Either way the next backend is of
+    another provider - the same provider is likely down or slow as well.
+    """
+
+    def __init__(
+        self,
+        backends: List[LLMBackend],
+        hedge: bool = False,
+        hedge_quantile: float = 0.95,
+        hedge_min_samples: int = 20,
+        **stats_kwargs,
+    ):
+        """
+        :param backends:
+        :param hedge: send slow requests to a second backend
+        :param hedge_quantile: latency quantile after which to hedge
+        :param hedge_min_samples: calls to see before the quantile is trusted
+        :param stats_kwargs: see BackendStats
+        """
+        self.backends = backends
+        self.hedge = hedge
+        self.hedge_quantile = hedge_quantile
+        self.hedge_min_samples = hedge_min_samples
+        self.stats = {
+            backend.name: BackendStats(**stats_kwargs) for backend in backends
+        }
+
+    def candidates(self, model: str, streaming: bool = False) -> List[LLMBackend]:
+        """
+        Healthy backends serving the model, fastest first
+        :param model:
+        :param streaming: only backends that can stream
+        :return:
+        """
+        backends = [
+            backend
+            for backend in self.backends
+            if model in backend.models
+            and (backend.supports_streaming or not streaming)
+            and self.stats[backend.name].allows_request()
+        ]
+        # the backends without stats yet go first, to get some
+        return sorted(
+            backends,
+            key=lambda backend: self.stats[backend.name].quantile(0.5, streaming) or 0,
+        )
+
+    def _hedge_delay(self, backend: LLMBackend, streaming: bool) -> Optional[float]:
+        stats = self.stats[backend.name]
+        latencies = stats.stream_latencies if streaming else stats.latencies
+        if not self.hedge or len(latencies) < self.hedge_min_samples:
+            return None
+        return stats.quantile(self.hedge_quantile, streaming)
+
+    async def _call(
+        self, backend: LLMBackend, call: Callable[[], Awaitable], streaming: bool
+    ):
+        stats = self.stats[backend.name]
+        stats.record_start()
+        started = time.perf_counter()
+        try:
+            result = await call()
+        except asyncio.CancelledError:
+            stats.record_cancel()
+            raise
+        except Exception as e:
+            stats.record_failure()
+            logger.warning(f"LLM backend {backend.name} failed: {e!r}")
+            raise
+        stats.record_success(time.perf_counter() - started, streaming)
+        return result
+
+    async def _route(
+        self,
+        model: str,
+        make_call: Callable[[LLMBackend, str], Awaitable],
+        discard: Callable = None,
+        streaming: bool = False,
+    ):
+        """
+        Run the call on the best backend, hedging and failing over
+        :param model:
+        :param make_call: (backend, backend model name) -> coroutine
+        :param discard: cleans up the result of a call that lost the race
+        :param streaming:
+        :return:
+        """
+        candidates = self.candidates(model, streaming)
+        if not candidates:
+            raise NoBackendAvailable(f"No healthy backend serves {model}")
+        # the fastest backend of each provider
+        queue, providers = deque(), set()
+        for backend in candidates:
+            if backend.provider not in providers:
+                providers.add(backend.provider)
+                queue.append(backend)
+        running: Dict[asyncio.Task, LLMBackend] = {}
+        last_error = None
+
+        def start_next():
+            backend = queue.popleft()
+            call = lambda: make_call(backend, backend.models[model])
+            task = asyncio.create_task(self._call(backend, call, streaming))
+            running[task] = backend
+
+        start_next()
+        try:
+            while running:
+                timeout = None
+                if queue and len(running) == 1:
+                    backend = next(iter(running.values()))
+                    timeout = self._hedge_delay(backend, streaming)
+                done, _ = await asyncio.wait(
+                    running, timeout=timeout, return_when=asyncio.FIRST_COMPLETED
+                )
+                if not done:
+                    backend = queue[0]
+                    logger.info(f"Hedging a slow {model} request to {backend.name}")
+                    start_next()
+                    continue
+                for task in done:
+                    running.pop(task)
+                    if task.exception() is None:
+                        return task.result()
+                    last_error = task.exception()
+                if not running and queue:
+                    start_next()
+            raise last_error
+        finally:
+            for task in running:
+                task.cancel()
+                if discard is not None:
+                    task.add_done_callback(
+                        lambda task: task.cancelled()
+                        or task.exception()
+                        or discard(task.result())
+                    )
+
+    async def complete_text(self, prompt: str, model: str, max_tokens: int) -> str:
+        return await self._route(
+            model,
+            lambda backend, backend_model: backend.complete_text(
+                prompt, model=backend_model, max_tokens=max_tokens
+            ),
+        )
+
+    async def stream_text(
+        self, prompt: str, model: str, max_tokens: int
+    ) -> AsyncIterator[str]:
+        """
+        Start streaming a completion, hedging and failing over until the first chunk
+        :param prompt:
+        :param model:
+        :param max_tokens:
+        :return: async iterator over the text chunks
+        """
+
+        async def start(backend: LLMBackend, backend_model: str):
+            stream = backend.stream_text(
+                prompt, model=backend_model, max_tokens=max_tokens
+            )
+            try:
+                first_chunk = await anext(stream)
+            except StopAsyncIteration:
+                first_chunk = ""
+            return first_chunk, stream
+
+        def discard(result):
+            asyncio.ensure_future(result[1].aclose())
+
+        first_chunk, stream = await self._route(model, start, discard, streaming=True)
+
+        async def chain():
+            yield first_chunk
+            async for chunk in stream:
+                yield chunk
+
+        return chain()
+
+    def summary(self) -> str:
+        lines = []
+        for backend in self.backends:
+            stats = self.stats[backend.name]
+            p50, p95 = stats.quantile(0.5), stats.quantile(0.95)
+            ttft = stats.quantile(0.5, streaming=True)
+            lines.append(
+                f"  {backend.name}: n={len(stats.outcomes)}"
+                f" p50={p50 or 0:.2f}s p95={p95 or 0:.2f}s"
+                f" first chunk p50={ttft or 0:.2f}s"
+                f" errors={stats.error_rate:.0%}"
+                + (" (circuit open)" if stats.is_open else "")
+            )
+        return "\n".join(lines)
@@ -0,0 +1,239 @@
+import bisect
+import time
+from contextvars import ContextVar
+from typing import Dict, Iterable, Optional, Tuple
+
+from loguru import logger
+
+# name of the handler processing the current update, set by MetricsMiddleware
+current_handler: ContextVar[str] = ContextVar("current_handler", default="none")
+
+DEFAULT_BUCKETS = (0.05, 0.1, 0.25, 0.5, 1, 2.5, 5, 10, 20, 30, 60)
+RATIO_BUCKETS = (0.1, 0.2, 0.3, 0.4, 0.5, 0.6, 0.7, 0.8, 0.9, 1.0)
+Labels = Tuple[Tuple[str, str], ...]
+
+
+def _labels_key(labels: dict) -> Labels:
+    return tuple(sorted((key, str(value)) for key, value in labels.items()))
+
+
+def _format_labels(labels: Labels, extra: Iterable[Tuple[str, str]] = ()) -> str:
+    labels = list(labels) + list(extra)
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+
+class Counter:
+    def __init__(self, name: str, description: str):
+        self.name = name
+        self.description = description
+        self.values: Dict[Labels, float] = {}
+
+    def inc(self, amount: float = 1, **labels):
+        key = _labels_key(labels)
+        self.values[key] = self.values.get(key, 0) + amount
+
+    def get(self, **labels) -> float:
+        return self.values.get(_labels_key(labels), 0)
+
+    def render(self):
+        yield f"# HELP {self.name} {self.description}"
+        yield f"# TYPE {self.name} counter"
+        for labels, value in self.values.items():
+            yield f"{self.name}{_format_labels(labels)} {value}"
+
+
+class Histogram:
+    def __init__(self, name: str, description: str, buckets=DEFAULT_BUCKETS):
+        self.name = name
+        self.description = description
+        self.buckets = tuple(buckets)
+        # labels -> [bucket counts..., +Inf count], sum
+        self.counts: Dict[Labels, list] = {}
+        self.sums: Dict[Labels, float] = {}
+
+    def observe(self, value: float, **labels):
+        key = _labels_key(labels)
+        if key not in self.counts:
+            self.counts[key] = [0] * (len(self.buckets) + 1)
+            self.sums[key] = 0.0
+        self.counts[key][bisect.bisect_left(self.buckets, value)] += 1
+        self.sums[key] += value
+
+    def count(self, labels: Labels) -> int:
+        return sum(self.counts.get(labels, ()))
+
+    def quantile(self, q: float, labels: Labels) -> Optional[float]:
+        """
+        Estimate the quantile as the upper bound of the bucket it falls in
+        :param q:
+        :param labels:
+        :return:
+        """
+        counts = self.counts.get(labels)
+        if not counts:
+            return None
+        rank = q * sum(counts)
+        seen = 0
+        for bound, count in zip(self.buckets + (float("inf"),), counts):
+            seen += count
+            if seen >= rank:
+                return bound
+        return float("inf")
+
+    def render(self):
+        yield f"# HELP {self.name} {self.description}"
+        yield f"# TYPE {self.name} histogram"
+        for labels, counts in self.counts.items():
+            cumulative = 0
+            for bound, count in zip(self.buckets + ("+Inf",), counts):
+                cumulative += count
+                bucket = _format_labels(labels, [("le", str(bound))])
+                yield f"{self.name}_bucket{bucket} {cumulative}"
+            yield f"{self.name}_sum{_format_labels(labels)} {self.sums[labels]}"
+            yield f"{self.name}_count{_format_labels(labels)} {cumulative}"
+
+
+class MetricsRegistry:
+    """
+    Prometheus-style metrics of the bot
+    """
+
+    def __init__(self):
+        self.handler_duration = Histogram(
+            "fairytale_handler_duration_seconds", "Handler wall time"
+        )
+        self.handler_errors = Counter(
+            "fairytale_handler_errors_total", "Handler exceptions"
+        )
+        self.llm_duration = Histogram(
+            "fairytale_llm_duration_seconds", "LLM call total time"
+        )
+        self.llm_time_to_first_token = Histogram(
+            "fairytale_llm_time_to_first_token_seconds", "LLM time to first token"
+        )
+        self.llm_queue_wait = Histogram(
+            "fairytale_llm_queue_wait_seconds", "Time waiting for the rate limiter"
+        )
+        self.llm_errors = Counter("fairytale_llm_errors_total", "Failed LLM calls")
+        self.prompt_tokens = Counter(
+            "fairytale_llm_prompt_tokens_total", "Prompt tokens sent"
+        )
+        self.completion_tokens = Counter(
+            "fairytale_llm_completion_tokens_total", "Completion tokens received"
+        )
+        self.prompt_prefix_ratio = Histogram(
+            "fairytale_llm_prompt_prefix_ratio",
+            "Share of the prompt tokens in the stable, cacheable prefix",
+            buckets=RATIO_BUCKETS,
+        )
+        self.cached_prompt_tokens = Counter(
+            "fairytale_llm_cached_prompt_tokens_total",
+            "Prompt tokens in a prefix sent recently, by the local estimate",
+        )
+        self.cache_requests = Counter(
+            "fairytale_cache_requests_total", "Cache lookups by cache and result"
+        )
+
+    @property
+    def metrics(self):
+        return [value for value in vars(self).values() if hasattr(value, "render")]
+
+    def render(self) -> str:
+        lines = []
+        for metric in self.metrics:
+            lines.extend(metric.render())
+        return "\n".join(lines) + "\n"
+
+    def record_cache(self, cache: str, hit: bool):
+        self.cache_requests.inc(cache=cache, result="hit" if hit else "miss")
+
+    def summary(self) -> str:
+        """
+        Human-readable summary for the /stats command
+        :return:
+        """
+        lines = ["Handlers:"]
+        for labels in self.handler_duration.counts:
+            lines.append(self._format_histogram(self.handler_duration, labels))
+        lines.append("LLM calls:")
+        for labels in self.llm_duration.counts:
+            lines.append(self._format_histogram(self.llm_duration, labels))
+        lines.append("Time to first token:")
+        for labels in self.llm_time_to_first_token.counts:
+            lines.append(self._format_histogram(self.llm_time_to_first_token, labels))
+        lines.append("Tokens:")
+        for labels, value in self.prompt_tokens.values.items():
+            completion = self.completion_tokens.values.get(labels, 0)
+            cached = self.cached_prompt_tokens.values.get(labels, 0)
+            lines.append(
+                f"  {_format_labels(labels)}: prompt={value:.0f} completion={completion:.0f}"
+                f" cached={cached:.0f}"
+            )
+        lines.append("Cacheable prompt prefix:")
+        for labels, total in self.prompt_prefix_ratio.sums.items():
+            n = self.prompt_prefix_ratio.count(labels)
+            lines.append(f"  {_format_labels(labels)}: n={n} mean={total / n:.2f}")
+        lines.append("Caches:")
+        for labels, value in self.cache_requests.values.items():
+            lines.append(f"  {_format_labels(labels)}: {value:.0f}")
+        return "\n".join(lines)
+
+    @staticmethod
+    def _format_histogram(histogram: Histogram, labels: Labels) -> str:
+        return (
+            f"  {_format_labels(labels)}: n={histogram.count(labels)}"
+            f" p50<={histogram.quantile(0.5, labels)}s"
+            f" p95<={histogram.quantile(0.95, labels)}s"
+        )
+
+
+class MetricsMiddleware:
+    """
+    aiogram middleware measuring the wall time of every handler
+    """
+
+    def __init__(self, registry: MetricsRegistry):
+        self.registry = registry
+
+    async def __call__(self, handler, event, data):
+        handler_object = data.get("handler")
+        callback = getattr(handler_object, "callback", None)
+        name = getattr(callback, "__name__", "unknown")
+        token = current_handler.set(name)
+        start = time.perf_counter()
+        try:
+            return await handler(event, data)
+        except Exception:
+            self.registry.handler_errors.inc(handler=name)
+            raise
+        finally:
+            self.registry.handler_duration.observe(
+                time.perf_counter() - start, handler=name
+            )
+            current_handler.reset(token)
+
+
+async def start_metrics_server(
+    registry: MetricsRegistry, port: int, host: str = "127.0.0.1"
+):
+    """
+    Serve the metrics at http://host:port/metrics
+    :param registry:
+    :param port:
+    :param host:
+    :return: the runner, call `await runner.cleanup()` to stop the server
+    """
+    from aiohttp import web
+
+    async def metrics_view(request):
+        return web.Response(text=registry.render(), content_type="text/plain")
+
+    app = web.Application()
+    app.router.add_get("/metrics", metrics_view)
+    runner = web.AppRunner(app)
+    await runner.setup()
+    await web.TCPSite(runner, host, port).start()
+    logger.info(f"Serving metrics at http://{host}:{port}/metrics")
+    return runner
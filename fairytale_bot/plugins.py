@@ -0,0 +1,40 @@
+import importlib
+
+from loguru import logger
+
+
+class LazyPlugin:
+    """
+    Stands in for a bot_lib plugin until its first use
+
+    App instantiates the plugin classes it's given, so this is passed in place
+    of the class: calling it returns the stand-in, and the plugin module is
+    imported and the plugin created on the first attribute access.
+    """
+
+    def __init__(self, path: str, name: str):
+        """
+        :param path: "module:ClassName" of the plugin
+        :param name: the app attribute to set, the plugin's own name
+        """
+        self.path = path
+        self.name = name
+        self._plugin = None
+
+    def __call__(self):
+        return self
+
+    @property
+    def plugin(self):
+        if self._plugin is None:
+            module_name, class_name = self.path.split(":")
+            plugin_class = getattr(importlib.import_module(module_name), class_name)
+            self._plugin = plugin_class()
+            logger.info(f"Created the {self.name} plugin on first use")
+        return self._plugin
+
+    def __getattr__(self, item):
+        # private and dunder lookups (copy, pickle) mustn't create the plugin
+        if item.startswith("_"):
+            raise AttributeError(item)
+        return getattr(self.plugin, item)
@@ -0,0 +1,117 @@
+import asyncio
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, Optional
+
+from loguru import logger
+
+
+class PrefetchScheduler:
+    """
+    Generate story parts in the background before the user asks for them
+
+    Results are kept in a bounded per-user cache keyed by the story stage.
+    A global semaphore caps the number of concurrent background generations.
+    """
+
+    def __init__(
+        self,
+        max_concurrency: int = 4,
+        max_pending: int = 100,
+        max_parts_per_user: int = 2,
+        max_users: int = 10_000,
+    ):
+        self.max_pending = max_pending
+        self.max_parts_per_user = max_parts_per_user
+        self.max_users = max_users
+        self._semaphore = asyncio.Semaphore(max_concurrency)
+        # user -> stage -> task, the finished tasks are the cache
+        self._tasks: "OrderedDict[str, Dict[int, asyncio.Task]]" = OrderedDict()
+
+    @property
+    def pending(self) -> int:
+        return sum(
+            not task.done() for tasks in self._tasks.values() for task in tasks.values()
+        )
+
+    def schedule(self, user: str, stage: int, generate: Callable[[], Awaitable[str]]):
+        """
+        Start generating a story part in the background
+        :param user:
+        :param stage: index of the story stage being generated
+        :param generate: coroutine factory producing the story part
+        :return: whether the generation was scheduled
+        """
+        user_tasks = self._tasks.get(user, {})
+        if stage in user_tasks:
+            return False
+        if self.pending >= self.max_pending:
+            logger.debug(f"Prefetch queue is full, skipping {user}")
+            return False
+
+        task = asyncio.create_task(self._run(generate))
+        user_tasks[stage] = task
+        self._tasks[user] = user_tasks
+        self._tasks.move_to_end(user)
+        self._evict(user)
+        return True
+
+    def put(self, user: str, stage: int, story_part: str):
+        """
+        Add an already generated story part
+        :param user:
+        :param stage:
+        :param story_part:
+        :return:
+        """
+        future = asyncio.get_running_loop().create_future()
+        future.set_result(story_part)
+        user_tasks = self._tasks.get(user, {})
+        user_tasks[stage] = future
+        self._tasks[user] = user_tasks
+        self._tasks.move_to_end(user)
+        self._evict(user)
+
+    async def _run(self, generate: Callable[[], Awaitable[str]]) -> str:
+        async with self._semaphore:
+            return await generate()
+
+    def _evict(self, user: str):
+        user_tasks = self._tasks[user]
+        while len(user_tasks) > self.max_parts_per_user:
+            stage = min(user_tasks)
+            user_tasks.pop(stage).cancel()
+        while len(self._tasks) > self.max_users:
+            _, tasks = self._tasks.popitem(last=False)
+            for task in tasks.values():
+                task.cancel()
+
+    async def pop(self, user: str, stage: int) -> Optional[str]:
+        """
+        Get the prefetched story part, waiting for it if it is still in flight
+        :param user:
+        :param stage:
+        :return: the story part or None if it was not prefetched
+        """
+        user_tasks = self._tasks.get(user)
+        if not user_tasks or stage not in user_tasks:
+            return None
+        task = user_tasks.pop(stage)
+        if not user_tasks:
+            self._tasks.pop(user, None)
+        # don't await the task directly - cancellation would propagate to us
+        await asyncio.wait({task})
+        if task.cancelled():
+            return None
+        if task.exception() is not None:
+            logger.warning(f"Prefetch failed for {user}: {task.exception()}")
+            return None
+        return task.result()
+
+    def invalidate(self, user: str):
+        """
+        Cancel all background generations and drop the cached parts for the user
+        :param user:
+        :return:
+        """
+        for task in self._tasks.pop(user, {}).values():
+            task.cancel()
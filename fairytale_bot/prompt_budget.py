@@ -0,0 +1,110 @@
+import math
+from functools import lru_cache
+from typing import Callable, List, Optional
+
+from loguru import logger
+
+# context window sizes, in tokens
+MODEL_CONTEXT_WINDOWS = {
+    "gpt-3.5-turbo": 16385,
+    "gpt-4": 8192,
+    "gpt-4-turbo": 128000,
+    "gpt-4o": 128000,
+    "gpt-4o-mini": 128000,
+}
+DEFAULT_CONTEXT_WINDOW = 4096
+# rough estimate for english text, used when tiktoken is not available
+CHARS_PER_TOKEN = 4
+
+
+@lru_cache(maxsize=None)
+def get_tokenizer(model: str) -> Callable[[str], int]:
+    """
+    Get a token counting function for the model, loaded once per model
+    Falls back to a character-based estimate if tiktoken is not available
+    :param model:
+    :return:
+    """
+    try:
+        import tiktoken
+
+        try:
+            encoding = tiktoken.encoding_for_model(model)
+        except KeyError:
+            encoding = tiktoken.get_encoding("cl100k_base")
+    except Exception as e:
+        # not installed or failed to download the encoding
+        logger.warning(f"Using approximate token counts for {model}: {e!r}")
+        return lambda text: math.ceil(len(text) / CHARS_PER_TOKEN)
+    return lambda text: len(encoding.encode(text, disallowed_special=()))
+
+
+def count_tokens(text: str, model: str) -> int:
+    return get_tokenizer(model)(text)
+
+
+def get_context_window(model: str) -> int:
+    return MODEL_CONTEXT_WINDOWS.get(model, DEFAULT_CONTEXT_WINDOW)
+
+
+class PromptBudget:
+    """
+    Token budget for a single prompt
+
+    The prompt has to fit in the context window of the model together with
+    the completion, and optionally in a smaller target budget to save money.
+    """
+
+    def __init__(
+        self, model: str, max_completion_tokens: int, target: Optional[int] = None
+    ):
+        self.model = model
+        self.max_completion_tokens = max_completion_tokens
+        self.max_prompt_tokens = get_context_window(model) - max_completion_tokens
+        if target is not None:
+            self.max_prompt_tokens = min(self.max_prompt_tokens, target)
+
+    def count(self, text: str) -> int:
+        return count_tokens(text, self.model)
+
+    def fits(self, text: str) -> bool:
+        return self.count(text) <= self.max_prompt_tokens
+
+    def fit_parts(
+        self,
+        parts: List[str],
+        compressed_parts: List[str],
+        available_tokens: int,
+    ) -> List[str]:
+        """
+        Fit the story parts in the available tokens
+        Older parts are replaced with the compressed version first,
+        then dropped. The last part is never dropped.
+        :param parts: story parts, oldest first
+        :param compressed_parts: compressed version of each part
+        :param available_tokens:
+        :return: the parts that fit
+        """
+        result = list(parts)
+        tokens = [self.count(part) for part in result]
+        total = sum(tokens)
+        # compress, oldest first
+        for i in range(len(result) - 1):
+            if total <= available_tokens:
+                return result
+            if compressed_parts[i] == result[i]:
+                continue
+            compressed_tokens = self.count(compressed_parts[i])
+            total += compressed_tokens - tokens[i]
+            result[i], tokens[i] = compressed_parts[i], compressed_tokens
+        # drop, oldest first
+        dropped = 0
+        while total > available_tokens and dropped < len(result) - 1:
+            total -= tokens[dropped]
+            dropped += 1
+        if total > available_tokens:
+            logger.warning(
+                f"The last story part doesn't fit the prompt budget: "
+                f"{total} > {available_tokens} tokens"
+            )
+        return result[dropped:]
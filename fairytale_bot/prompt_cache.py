@@ -0,0 +1,98 @@
+import hashlib
+import time
+from collections import OrderedDict
+from typing import Dict, Iterable, List, Tuple
+
+
+class ChatPrompt(str):
+    """
+    Prompt made of a stable prefix and a volatile suffix
+
+    The text is the prefix followed by the suffix, so it works wherever a
+    plain prompt does. Chat backends send the prefix as the system message and
+    the suffix as the user message. Providers cache the prompt prefixes they
+    have seen recently, so a prefix that stays the same between calls is
+    cheaper and faster to process. The prefix is kept as segments that only
+    grow at the end while the story goes on: instructions and structure,
+    then the finalized parts.
+    """
+
+    def __new__(cls, prefix_segments: Iterable[str], suffix: str):
+        prefix_segments = tuple(prefix_segments)
+        prompt = super().__new__(cls, "".join(prefix_segments) + suffix)
+        prompt.segments = prefix_segments
+        prompt.prefix_length = len(prompt) - len(suffix)
+        return prompt
+
+    @property
+    def prefix(self) -> str:
+        return self[: self.prefix_length]
+
+    @property
+    def suffix(self) -> str:
+        return self[self.prefix_length :]
+
+
+def to_messages(prompt: str) -> List[Dict[str, str]]:
+    """
+    Chat messages of the prompt: the prefix of a ChatPrompt as the system message
+    :param prompt:
+    :return:
+    """
+    if isinstance(prompt, ChatPrompt) and prompt.prefix_length:
+        return [
+            {"role": "system", "content": prompt.prefix},
+            {"role": "user", "content": prompt.suffix},
+        ]
+    return [{"role": "user", "content": prompt}]
+
+
+class PrefixCache:
+    """
+    Local stand-in for the prompt caching of the providers
+
+    Remembers the prompt prefixes sent to each model for `ttl` seconds and
+    tells how much of a new prompt they cover, at the granularity of the
+    ChatPrompt segments. Unlike the providers, there is no minimum length.
+    """
+
+    def __init__(self, ttl: float = 600, max_size: int = 10_000):
+        self.ttl = ttl
+        self.max_size = max_size
+        self._seen: "OrderedDict[Tuple[str, bytes], float]" = OrderedDict()
+
+    @staticmethod
+    def _keys(model: str, prompt: ChatPrompt) -> List[Tuple[str, bytes]]:
+        """Keys of the prefixes of the prompt, shortest first"""
+        keys = []
+        digest = hashlib.blake2b(digest_size=16)
+        for segment in prompt.segments:
+            digest.update(segment.encode())
+            keys.append((model, digest.copy().digest()))
+        return keys
+
+    def match(self, model: str, prompt: str) -> str:
+        """
+        :param model:
+        :param prompt:
+        :return: the longest prefix of the prompt seen recently, may be empty
+        """
+        if not isinstance(prompt, ChatPrompt):
+            return ""
+        now = time.monotonic()
+        keys = self._keys(model, prompt)
+        for n in range(len(keys), 0, -1):
+            seen = self._seen.get(keys[n - 1])
+            if seen is not None and now - seen < self.ttl:
+                return "".join(prompt.segments[:n])
+        return ""
+
+    def add(self, model: str, prompt: str):
+        if not isinstance(prompt, ChatPrompt):
+            return
+        now = time.monotonic()
+        for key in self._keys(model, prompt):
+            self._seen[key] = now
+            self._seen.move_to_end(key)
+        while len(self._seen) > self.max_size:
+            self._seen.popitem(last=False)
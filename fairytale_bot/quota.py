@@ -0,0 +1,277 @@
+import asyncio
+import atexit
+import time
+from collections import OrderedDict, deque
+from datetime import datetime, timezone
+from typing import Callable, List, Optional
+
+from loguru import logger
+
+from fairytale_bot.session import SessionStore
+
+DAY = 24 * 3600
+
+
+class QuotaExceeded(Exception):
+    """The user has used up their plan for the current window"""
+
+    def __init__(self, used: int, limit: int, retry_after: Optional[float]):
+        super().__init__(f"Quota exceeded: {used}/{limit}")
+        self.used = used
+        self.limit = limit
+        # seconds until enough usage leaves the window, None if it never will
+        self.retry_after = retry_after
+
+
+class SlidingWindow:
+    """
+    The last `period` seconds, counted in `buckets` steps
+    """
+
+    def __init__(self, period: float, buckets: int = 30):
+        self.period = period
+        self.buckets = buckets
+        self.step = period / buckets
+
+    def bucket(self, now: float) -> int:
+        return int(now // self.step)
+
+    def oldest_bucket(self, now: float) -> int:
+        return self.bucket(now) - self.buckets + 1
+
+    def expires_at(self, bucket: int) -> float:
+        """Time when the usage of the bucket leaves the window"""
+        return (bucket + self.buckets) * self.step
+
+
+class CalendarWindow:
+    """
+    The current day, week (from Monday) or month, in UTC
+    """
+
+    UNITS = ("day", "week", "month")
+
+    def __init__(self, unit: str = "month"):
+        if unit not in self.UNITS:
+            raise ValueError(f"Unknown calendar window: {unit}")
+        self.unit = unit
+
+    def bucket(self, now: float) -> int:
+        if self.unit == "day":
+            return int(now // DAY)
+        if self.unit == "week":
+            # 1970-01-01 is a Thursday
+            return (int(now // DAY) + 3) // 7
+        date = datetime.fromtimestamp(now, timezone.utc)
+        return date.year * 12 + date.month - 1
+
+    def oldest_bucket(self, now: float) -> int:
+        return self.bucket(now)
+
+    def expires_at(self, bucket: int) -> float:
+        if self.unit == "day":
+            return (bucket + 1) * DAY
+        if self.unit == "week":
+            return ((bucket + 1) * 7 - 3) * DAY
+        year, month = divmod(bucket + 1, 12)
+        return datetime(year, month + 1, 1, tzinfo=timezone.utc).timestamp()
+
+
+class _Usage:
+    """Usage of one user: amounts per bucket, oldest first, and their total"""
+
+    __slots__ = ("buckets", "total", "reserved")
+
+    def __init__(self, buckets: List[List[int]] = ()):
+        self.buckets = deque([bucket, amount] for bucket, amount in buckets)
+        self.total = sum(amount for _, amount in self.buckets)
+        self.reserved = 0
+
+    def expire(self, oldest_bucket: int):
+        while self.buckets and self.buckets[0][0] < oldest_bucket:
+            self.total -= self.buckets.popleft()[1]
+
+    def add(self, bucket: int, amount: int):
+        if self.buckets and self.buckets[-1][0] == bucket:
+            self.buckets[-1][1] += amount
+        else:
+            self.buckets.append([bucket, amount])
+        self.total += amount
+
+    def dump(self) -> List[List[int]]:
+        return [list(item) for item in self.buckets]
+
+
+class Reservation:
+    """
+    Quota held for an in-flight generation
+
+    Committing records the actual usage, releasing (or leaving the with block
+    without committing) gives the quota back.
+    """
+
+    __slots__ = ("engine", "user", "amount", "active")
+
+    def __init__(self, engine: "QuotaEngine", user: str, amount: int):
+        self.engine = engine
+        self.user = user
+        self.amount = amount
+        self.active = True
+
+    def commit(self, amount: Optional[int] = None):
+        """
+        :param amount: the actual usage, the reserved amount by default
+        :return:
+        """
+        if not self.active:
+            return
+        self.release()
+        self.engine.record(self.user, self.amount if amount is None else amount)
+
+    def release(self):
+        if not self.active:
+            return
+        self.active = False
+        self.engine._get(self.user).reserved -= self.amount
+
+    def __enter__(self) -> "Reservation":
+        return self
+
+    def __exit__(self, *exc_info):
+        self.release()
+
+
+class QuotaEngine:
+    """
+    Per-user usage quotas over a sliding or calendar window
+
+    Usage is kept in memory as amounts per window bucket with a running total,
+    so checking a quota is O(1). In-flight generations reserve their maximum
+    usage up front, so concurrent requests can't overrun the quota together.
+    Changed counters are written to the users' sessions in batches, every
+    flush_interval seconds, never on the request path.
+    """
+
+    def __init__(
+        self,
+        sessions: SessionStore,
+        window,
+        flush_interval: float = 5.0,
+        max_users: int = 100_000,
+        clock: Callable[[], float] = time.time,
+    ):
+        """
+        :param sessions: the counters are persisted in the session usage field
+        :param window: SlidingWindow or CalendarWindow
+        :param flush_interval: seconds between writes of the changed counters
+        :param max_users: counters kept in memory, least recently used are dropped
+        :param clock: wall clock - calendar windows and stored buckets outlive the process
+        """
+        self.sessions = sessions
+        self.window = window
+        self.flush_interval = flush_interval
+        self.max_users = max_users
+        self.clock = clock
+
+        self._usage: "OrderedDict[str, _Usage]" = OrderedDict()
+        self._dirty = set()
+        self._flush_task: Optional[asyncio.Task] = None
+        if sessions.store.persistent:
+            # registered after the store, so it runs before the store is closed
+            atexit.register(self.flush)
+
+    def _get(self, user: str) -> _Usage:
+        usage = self._usage.get(user)
+        if usage is None:
+            stored = getattr(self.sessions.get(user), "usage", None)
+            # lifetime counts from before the windows start afresh
+            usage = _Usage(stored if isinstance(stored, list) else ())
+            self._usage[user] = usage
+            if len(self._usage) > self.max_users:
+                self._drop_oldest(keep=user)
+        else:
+            self._usage.move_to_end(user)
+        usage.expire(self.window.oldest_bucket(self.clock()))
+        return usage
+
+    def _drop_oldest(self, keep: str):
+        for user, usage in self._usage.items():
+            if not usage.reserved and user != keep:
+                break
+        else:
+            return
+        if user in self._dirty:
+            self._save(user, usage)
+            self._dirty.discard(user)
+        del self._usage[user]
+
+    def used(self, user: str) -> int:
+        return self._get(user).total
+
+    def reserve(self, user: str, amount: int, limit: int) -> Reservation:
+        """
+        Hold `amount` of the user's quota until the reservation is committed
+        :param user:
+        :param amount: the most the call can use
+        :param limit: of the user's plan
+        :return:
+        :raises QuotaExceeded: if the amount doesn't fit in the quota
+        """
+        usage = self._get(user)
+        if usage.total + usage.reserved + amount > limit:
+            raise QuotaExceeded(
+                usage.total, limit, self._retry_after(usage, amount, limit)
+            )
+        usage.reserved += amount
+        return Reservation(self, user, amount)
+
+    def _retry_after(self, usage: _Usage, amount: int, limit: int) -> Optional[float]:
+        available = limit - usage.reserved - amount
+        total = usage.total
+        for bucket, bucket_amount in usage.buckets:
+            total -= bucket_amount
+            if total <= available:
+                return max(0.0, self.window.expires_at(bucket) - self.clock())
+        return None
+
+    def record(self, user: str, amount: int):
+        usage = self._get(user)
+        usage.add(self.window.bucket(self.clock()), amount)
+        self._mark_dirty(user)
+
+    def reset(self, user: str):
+        usage = self._get(user)
+        usage.buckets.clear()
+        usage.total = 0
+        self._mark_dirty(user)
+
+    def _mark_dirty(self, user: str):
+        self._dirty.add(user)
+        try:
+            asyncio.get_running_loop()
+        except RuntimeError:
+            # no event loop (scripts, tests) - nothing to block, write now
+            self.flush()
+            return
+        if self._flush_task is None or self._flush_task.done():
+            self._flush_task = asyncio.create_task(self._flush_later())
+
+    async def _flush_later(self):
+        await asyncio.sleep(self.flush_interval)
+        try:
+            self.flush()
+        except Exception as e:
+            logger.exception(f"Failed to flush the usage counters: {e}")
+
+    def _save(self, user: str, usage: _Usage):
+        session = self.sessions.get_or_create(user)
+        session.usage = usage.dump()
+        self.sessions.save(user, session)
+
+    def flush(self):
+        """Write the changed counters to the sessions"""
+        dirty, self._dirty = self._dirty, set()
+        for user in dirty:
+            usage = self._usage.get(user)
+            if usage is not None:
+                self._save(user, usage)
@@ -0,0 +1,205 @@
+import asyncio
+import heapq
+import itertools
+import random
+import time
+from collections import OrderedDict
+from typing import Awaitable, Callable, Dict, Optional, Tuple, TypeVar
+
+from loguru import logger
+
+T = TypeVar("T")
+
+# requests per minute, tokens per minute
+MODEL_RATE_LIMITS = {
+    "gpt-3.5-turbo": (3500, 160_000),
+    "gpt-4": (500, 10_000),
+}
+DEFAULT_MODEL_RATE_LIMIT = (500, 10_000)
+
+
+class RateLimitExceeded(Exception):
+    """The user sends requests faster than their plan allows"""
+
+    def __init__(self, retry_after: float):
+        super().__init__(f"Rate limit exceeded, retry in {retry_after:.0f}s")
+        self.retry_after = retry_after
+
+
+class SchedulerOverloaded(Exception):
+    """Too many requests are waiting for the LLM"""
+
+
+class TokenBucket:
+    """
+    Token bucket: holds up to `capacity` tokens, refilled at `rate` tokens per second
+    """
+
+    def __init__(self, rate: float, capacity: float):
+        self.rate = rate
+        self.capacity = capacity
+        self.tokens = capacity
+        self.updated = time.monotonic()
+
+    def _refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.capacity, self.tokens + (now - self.updated) * self.rate)
+        self.updated = now
+
+    def time_until(self, amount: float = 1) -> float:
+        """Seconds until `amount` tokens are available"""
+        self._refill()
+        # requests larger than the bucket are let through once it's full
+        amount = min(amount, self.capacity)
+        if self.tokens >= amount:
+            return 0.0
+        return (amount - self.tokens) / self.rate
+
+    def try_acquire(self, amount: float = 1) -> bool:
+        if self.time_until(amount) > 0:
+            return False
+        self.tokens -= amount
+        return True
+
+
+def is_rate_limit_error(error: Exception) -> bool:
+    """Check if the error is a 429 from the LLM provider"""
+    if getattr(error, "status_code", None) == 429:
+        return True
+    return type(error).__name__ == "RateLimitError"
+
+
+class LLMScheduler:
+    """
+    Schedules LLM calls within the per-user and per-model rate limits
+
+    Per-user limits are checked right away and fail fast with RateLimitExceeded.
+    Per-model limits (requests and tokens per minute) are shared by everyone:
+    requests wait in a priority queue (lower number first) until the model
+    budget allows them, or fail with SchedulerOverloaded if the queue is full.
+    Calls that hit a 429 anyway are retried with jittered exponential backoff.
+    Processes sharing the provider account should split the per-model limits
+    between them with model_limit_share.
+    """
+
+    PREMIUM_PRIORITY = 0
+    DEFAULT_PRIORITY = 1
+    BACKGROUND_PRIORITY = 2
+
+    def __init__(
+        self,
+        max_queue: int = 1000,
+        max_retries: int = 3,
+        backoff_base: float = 1.0,
+        backoff_max: float = 30.0,
+        max_users: int = 100_000,
+        model_limit_share: float = 1.0,
+    ):
+        self.max_queue = max_queue
+        self.max_retries = max_retries
+        self.backoff_base = backoff_base
+        self.backoff_max = backoff_max
+        self.max_users = max_users
+        self.model_limit_share = model_limit_share
+
+        self._user_buckets: "OrderedDict[str, TokenBucket]" = OrderedDict()
+        self._model_buckets: Dict[str, Tuple[TokenBucket, TokenBucket]] = {}
+        self._queues: Dict[str, list] = {}  # model -> heap of waiting requests
+        self._dispatchers: Dict[str, asyncio.Task] = {}
+        self._counter = itertools.count()
+
+    @property
+    def queue_size(self) -> int:
+        return sum(len(queue) for queue in self._queues.values())
+
+    def check_user(self, user: str, requests_per_minute: float):
+        """
+        Take one request from the user's budget
+        :param user:
+        :param requests_per_minute:
+        :return:
+        """
+        bucket = self._user_buckets.get(user)
+        if bucket is None or bucket.capacity != requests_per_minute:
+            # the plan could have changed
+            bucket = TokenBucket(requests_per_minute / 60, requests_per_minute)
+            self._user_buckets[user] = bucket
+        self._user_buckets.move_to_end(user)
+        while len(self._user_buckets) > self.max_users:
+            self._user_buckets.popitem(last=False)
+        if not bucket.try_acquire():
+            raise RateLimitExceeded(bucket.time_until())
+
+    def _get_model_buckets(self, model: str):
+        if model not in self._model_buckets:
+            rpm, tpm = MODEL_RATE_LIMITS.get(model, DEFAULT_MODEL_RATE_LIMIT)
+            rpm, tpm = rpm * self.model_limit_share, tpm * self.model_limit_share
+            self._model_buckets[model] = (
+                TokenBucket(rpm / 60, rpm),
+                TokenBucket(tpm / 60, tpm),
+            )
+        return self._model_buckets[model]
+
+    async def _wait_turn(self, model: str, tokens: int, priority: int):
+        if self.queue_size >= self.max_queue:
+            raise SchedulerOverloaded("Too many requests are waiting for the LLM")
+        future = asyncio.get_running_loop().create_future()
+        queue = self._queues.setdefault(model, [])
+        heapq.heappush(queue, (priority, next(self._counter), tokens, future))
+        dispatcher = self._dispatchers.get(model)
+        if dispatcher is None or dispatcher.done():
+            self._dispatchers[model] = asyncio.create_task(self._dispatch(model))
+        await future
+
+    async def _dispatch(self, model: str):
+        queue = self._queues[model]
+        requests, tokens = self._get_model_buckets(model)
+        while queue:
+            _, _, amount, future = queue[0]
+            if future.done():  # the caller was cancelled
+                heapq.heappop(queue)
+                continue
+            wait = max(requests.time_until(1), tokens.time_until(amount))
+            if wait > 0:
+                await asyncio.sleep(wait)
+                continue
+            heapq.heappop(queue)
+            requests.try_acquire(1)
+            tokens.try_acquire(amount)
+            future.set_result(None)
+
+    async def submit(
+        self,
+        call: Callable[[], Awaitable[T]],
+        model: str,
+        tokens: int,
+        priority: int = DEFAULT_PRIORITY,
+    ) -> T:
+        """
+        Run the LLM call when the model budget allows it
+        :param call: coroutine factory making the call
+        :param model:
+        :param tokens: estimated prompt + completion tokens
+        :param priority: lower runs first
+        :return: the result of the call
+        """
+        attempt = 0
+        while True:
+            await self._wait_turn(model, tokens, priority)
+            try:
+                return await call()
+            except Exception as e:
+                if not is_rate_limit_error(e) or attempt >= self.max_retries:
+                    raise
+                delay = self._backoff(attempt)
+                logger.warning(f"{model} rate limited, retrying in {delay:.1f}s")
+                attempt += 1
+                await asyncio.sleep(delay)
+
+    def _backoff(self, attempt: int) -> float:
+        # "full jitter" - spreads the retries of concurrent requests
+        return random.uniform(0, min(self.backoff_max, self.backoff_base * 2**attempt))
+
+    async def close(self):
+        for dispatcher in self._dispatchers.values():
+            dispatcher.cancel()
@@ -0,0 +1,182 @@
+import bisect
+import itertools
+import random
+import time
+from collections import OrderedDict, deque
+from pathlib import Path
+from typing import Dict, List, Optional, Sequence
+
+from loguru import logger
+
+# "entry | weight" sets the weight of an entry, the default is 1
+WEIGHT_SEPARATOR = " | "
+
+
+class ResourcePool:
+    """
+    Entries to sample from, with optional weights
+
+    Unweighted sampling is O(1), weighted is O(log n) over precomputed
+    cumulative weights.
+    """
+
+    def __init__(self, entries: Sequence[str], weights: Sequence[float] = None):
+        self.entries = list(entries)
+        self.weights = list(weights) if weights is not None else None
+        self._cumulative = None
+        if self.weights is not None and len(set(self.weights)) > 1:
+            self._cumulative = list(itertools.accumulate(self.weights))
+
+    def __len__(self):
+        return len(self.entries)
+
+    def sample_index(self, rng: random.Random = random) -> int:
+        if self._cumulative is None:
+            return rng.randrange(len(self.entries))
+        point = rng.random() * self._cumulative[-1]
+        return bisect.bisect_right(self._cumulative, point)
+
+    @classmethod
+    def from_text(cls, text: str) -> "ResourcePool":
+        entries = []
+        weights = []
+        for line in text.splitlines():
+            line = line.strip()
+            if not line:
+                continue
+            entry, separator, weight = line.rpartition(WEIGHT_SEPARATOR)
+            try:
+                weights.append(float(weight) if separator else 1.0)
+                entries.append(entry if separator else line)
+            except ValueError:  # " | " is part of the entry
+                weights.append(1.0)
+                entries.append(line)
+        return cls(entries, weights)
+
+    @classmethod
+    def combine(cls, pools: Sequence["ResourcePool"]) -> "ResourcePool":
+        entries = [entry for pool in pools for entry in pool.entries]
+        weights = [
+            weight for pool in pools for weight in (pool.weights or [1.0] * len(pool))
+        ]
+        return cls(entries, weights)
+
+
+class ResourceRegistry:
+    """
+    Lazily loaded resource files, reloaded when they change on disk
+
+    A resource is a text file with one entry per line. Files are read on
+    first use; afterwards their modification time is checked at most every
+    reload_interval seconds. Combined pools are built once and rebuilt only
+    when one of their files changes.
+    """
+
+    def __init__(
+        self,
+        path: Path,
+        reload_interval: float = 5.0,
+        max_users: int = 100_000,
+    ):
+        """
+        :param path: directory with the resource files
+        :param reload_interval: seconds between checks for changed files
+        :param max_users: users whose recent picks are remembered
+        """
+        self.path = Path(path)
+        self.reload_interval = reload_interval
+        self.max_users = max_users
+        self._pools: Dict[str, ResourcePool] = {}
+        self._mtimes: Dict[str, float] = {}
+        self._checked: Dict[str, float] = {}
+        self._combined: Dict[str, List[str]] = {}  # name -> resource names
+        self._versions: Dict[str, int] = {}
+        self._combined_versions: Dict[str, tuple] = {}
+        # (user, pool name) -> recent indices and the pool version they're from
+        self._recent: "OrderedDict[tuple, tuple]" = OrderedDict()
+
+    def register_combined(self, name: str, resources: List[str]):
+        """
+        Define a pool made of several resources
+        :param name:
+        :param resources: names of the resource files
+        :return:
+        """
+        self._combined[name] = resources
+        self._pools.pop(name, None)
+
+    def get(self, name: str) -> ResourcePool:
+        """
+        Get the pool, loading or reloading it if needed
+        :param name: resource file name without .txt, or a combined pool name
+        :return:
+        """
+        if name in self._combined:
+            return self._get_combined(name)
+        now = time.monotonic()
+        if name in self._pools and now - self._checked[name] < self.reload_interval:
+            return self._pools[name]
+        self._checked[name] = now
+        path = self.path / f"{name}.txt"
+        mtime = path.stat().st_mtime
+        if self._mtimes.get(name) != mtime:
+            if name in self._pools:
+                logger.info(f"Reloading resource {name}")
+            self._pools[name] = ResourcePool.from_text(path.read_text())
+            self._mtimes[name] = mtime
+            self._versions[name] = self._versions.get(name, 0) + 1
+        return self._pools[name]
+
+    def _get_combined(self, name: str) -> ResourcePool:
+        parts = [self.get(resource) for resource in self._combined[name]]
+        versions = tuple(self._versions[resource] for resource in self._combined[name])
+        if self._combined_versions.get(name) != versions:
+            self._pools[name] = ResourcePool.combine(parts)
+            self._combined_versions[name] = versions
+        return self._pools[name]
+
+    def entries(self, name: str) -> List[str]:
+        return self.get(name).entries
+
+    def sample(
+        self,
+        name: str,
+        user: Optional[str] = None,
+        avoid_last: int = 0,
+        rng: random.Random = random,
+    ) -> str:
+        """
+        Pick a random entry
+        :param name: resource or combined pool name
+        :param user: remember the picks of this user
+        :param avoid_last: don't repeat the user's last K picks from this pool
+        :param rng:
+        :return:
+        """
+        pool = self.get(name)
+        if user is None or avoid_last <= 0:
+            return pool.entries[pool.sample_index(rng)]
+
+        key = (user, name)
+        version = self._combined_versions.get(name, self._versions.get(name))
+        recent = self._recent.get(key)
+        # the indices of a reloaded pool point to other entries
+        if recent is None or recent[0].maxlen != avoid_last or recent[1] != version:
+            recent = (deque(maxlen=avoid_last), version)
+        self._recent[key] = recent
+        self._recent.move_to_end(key)
+        while len(self._recent) > self.max_users:
+            self._recent.popitem(last=False)
+        order = recent[0]
+        # K is small, and the picks can repeat when the pool is smaller
+        seen = set(order)
+
+        # rejection sampling: cheap as long as K is small compared to the pool
+        index = pool.sample_index(rng)
+        if len(pool) > len(seen):
+            for _ in range(100):
+                if index not in seen:
+                    break
+                index = pool.sample_index(rng)
+        order.append(index)
+        return pool.entries[index]
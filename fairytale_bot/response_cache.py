@@ -0,0 +1,219 @@
+import hashlib
+import heapq
+import math
+import time
+from collections import Counter, OrderedDict
+from enum import Enum
+from typing import Dict, List, Optional, Set, Tuple
+
+from fairytale_bot.prompt_budget import count_tokens
+
+# $ per 1k prompt and completion tokens, to report the money saved
+MODEL_PRICES = {
+    "gpt-3.5-turbo": (0.0005, 0.0015),
+    "gpt-4": (0.03, 0.06),
+}
+
+# entries sharing one of the smallest feature hashes of the prompt are compared
+SKETCH_SIZE = 8
+# the candidates sharing the most of the sketch are verified
+MAX_CANDIDATES = 16
+
+
+class ResponseCacheMode(Enum):
+    OFF = 0
+    EXACT = 1  # same prompt, model and max tokens
+    SIMILAR = 2  # also nearly the same prompt
+
+
+def _feature_hash(feature: str) -> int:
+    digest = hashlib.blake2b(feature.encode(), digest_size=8).digest()
+    return int.from_bytes(digest, "big")
+
+
+def embed(text: str) -> Dict[int, float]:
+    """
+    Local text embedding: hashed word unigrams and bigrams, L2-normalized
+    :param text:
+    :return: sparse vector, feature hash -> weight
+    """
+    words = text.lower().split()
+    counts = Counter(_feature_hash(word) for word in words)
+    counts.update(_feature_hash(" ".join(pair)) for pair in zip(words, words[1:]))
+    norm = math.sqrt(sum(count * count for count in counts.values())) or 1.0
+    return {feature: count / norm for feature, count in counts.items()}
+
+
+def cosine_similarity(a: Dict[int, float], b: Dict[int, float]) -> float:
+    if len(a) > len(b):
+        a, b = b, a
+    return sum(weight * b.get(feature, 0.0) for feature, weight in a.items())
+
+
+def sketch(vector: Dict[int, float]) -> List[int]:
+    """
+    Bottom-k MinHash sketch: nearly identical texts share most of it
+    :param vector:
+    :return:
+    """
+    return heapq.nsmallest(SKETCH_SIZE, vector)
+
+
+class _Entry:
+    __slots__ = ("created", "response", "scope", "vector", "sketch")
+
+    def __init__(self, response: str, scope: tuple, vector, sketch):
+        self.created = time.time()
+        self.response = response
+        self.scope = scope  # (model, max tokens)
+        self.vector = vector
+        self.sketch = sketch
+
+
+class ResponseCache:
+    """
+    Cache of LLM responses, by exact prompt or by a nearly identical one
+
+    Exact lookups are a dict access by the prompt hash, model and max tokens.
+    Every entry is also added to a local similarity index: the MinHash
+    sketch of the prompt embedding finds the candidates, which are verified
+    by cosine similarity. Least recently used entries are evicted first.
+    Embedding the prompts costs a millisecond or so per entry, so the index
+    is only built with index_similar.
+    """
+
+    def __init__(
+        self,
+        max_size: int = 2000,
+        ttl: float = 24 * 3600,
+        similarity_threshold: float = 0.95,
+        prices: Dict[str, Tuple[float, float]] = None,
+        index_similar: bool = True,
+    ):
+        self.index_similar = index_similar
+        self.max_size = max_size
+        self.ttl = ttl
+        self.similarity_threshold = similarity_threshold
+        self.prices = MODEL_PRICES if prices is None else prices
+        self._entries: "OrderedDict[str, _Entry]" = OrderedDict()
+        # (scope, feature hash) -> keys of the entries with it in the sketch
+        self._index: Dict[tuple, Set[str]] = {}
+        self.hits = 0
+        self.similar_hits = 0
+        self.misses = 0
+        self.evictions = 0
+        self.saved_tokens = 0
+        self.saved_cost = 0.0
+
+    def __len__(self):
+        return len(self._entries)
+
+    @staticmethod
+    def make_key(prompt: str, model: str, max_tokens: int) -> str:
+        digest = hashlib.sha256(prompt.encode()).hexdigest()
+        return f"{model}:{max_tokens}:{digest}"
+
+    def get(
+        self,
+        prompt: str,
+        model: str,
+        max_tokens: int,
+        mode: ResponseCacheMode = ResponseCacheMode.EXACT,
+    ) -> Optional[str]:
+        """
+        Get the cached response for the prompt
+        :param prompt:
+        :param model:
+        :param max_tokens:
+        :param mode: EXACT or SIMILAR
+        :return: the response or None
+        """
+        if mode == ResponseCacheMode.OFF:
+            return None
+        key = self.make_key(prompt, model, max_tokens)
+        entry = self._get_fresh(key)
+        if entry is None and mode == ResponseCacheMode.SIMILAR and self.index_similar:
+            key = self._find_similar(prompt, (model, max_tokens))
+            entry = key and self._get_fresh(key)
+            if entry is not None:
+                self.similar_hits += 1
+        if entry is None:
+            self.misses += 1
+            return None
+        self.hits += 1
+        self._entries.move_to_end(key)
+        self._count_saved(prompt, entry)
+        return entry.response
+
+    def _count_saved(self, prompt: str, entry: _Entry):
+        model = entry.scope[0]
+        prompt_tokens = count_tokens(prompt, model)
+        completion_tokens = count_tokens(entry.response, model)
+        prompt_price, completion_price = self.prices.get(model, (0.0, 0.0))
+        self.saved_tokens += prompt_tokens + completion_tokens
+        self.saved_cost += (
+            prompt_tokens * prompt_price + completion_tokens * completion_price
+        ) / 1000
+
+    def _get_fresh(self, key: str) -> Optional[_Entry]:
+        entry = self._entries.get(key)
+        if entry is not None and time.time() - entry.created >= self.ttl:
+            self._remove(key)
+            self.evictions += 1
+            return None
+        return entry
+
+    def _find_similar(self, prompt: str, scope: tuple) -> Optional[str]:
+        vector = embed(prompt)
+        # the shared prompt template puts many entries in the same buckets
+        shared = Counter()
+        for feature in sketch(vector):
+            shared.update(self._index.get((scope, feature), ()))
+        best_key, best_similarity = None, self.similarity_threshold
+        for key, _ in shared.most_common(MAX_CANDIDATES):
+            similarity = cosine_similarity(vector, self._entries[key].vector)
+            if similarity >= best_similarity:
+                best_key, best_similarity = key, similarity
+        return best_key
+
+    def put(self, prompt: str, model: str, max_tokens: int, response: str):
+        """
+        Cache the response
+        :param prompt:
+        :param model:
+        :param max_tokens:
+        :param response:
+        :return:
+        """
+        key = self.make_key(prompt, model, max_tokens)
+        if key in self._entries:
+            self._remove(key)
+        scope = (model, max_tokens)
+        vector, features = None, ()
+        if self.index_similar:
+            vector = embed(prompt)
+            features = sketch(vector)
+        self._entries[key] = _Entry(response, scope, vector, features)
+        for feature in features:
+            self._index.setdefault((scope, feature), set()).add(key)
+        while len(self._entries) > self.max_size:
+            self._remove(next(iter(self._entries)))
+            self.evictions += 1
+
+    def _remove(self, key: str):
+        entry = self._entries.pop(key)
+        for feature in entry.sketch:
+            keys = self._index[(entry.scope, feature)]
+            keys.discard(key)
+            if not keys:
+                del self._index[(entry.scope, feature)]
+
+    def summary(self) -> str:
+        requests = self.hits + self.misses
+        hit_rate = self.hits / requests if requests else 0.0
+        return (
+            f"Response cache: {len(self)} entries, hits={self.hits}"
+            f" ({self.similar_hits} similar) misses={self.misses}"
+            f" hit rate={hit_rate:.0%} evictions={self.evictions}"
+            f" saved {self.saved_tokens} tokens, ${self.saved_cost:.2f}"
+        )
@@ -0,0 +1,320 @@
+import time
+from collections import OrderedDict
+from collections.abc import MutableMapping
+from typing import Any, Callable, Dict, Iterator, Optional, Set
+
+from fairytale_bot.storage import StateStore
+
+# the field is not set - the default or the tier default is used
+_UNSET = object()
+
+
+class Tier:
+    """
+    Settings shared by all the users of a plan
+    """
+
+    __slots__ = ("name", "max_tokens", "compression", "model", "user_limit")
+
+    def __init__(
+        self, name: str, max_tokens: int, compression, model: str, user_limit: int
+    ):
+        self.name = name
+        self.max_tokens = max_tokens
+        self.compression = compression
+        self.model = model
+        self.user_limit = user_limit
+
+
+class Session:
+    """
+    All the state of one user
+
+    Unset fields hold a shared sentinel, so a session only costs the slots
+    of the fields that differ from the defaults.
+    """
+
+    __slots__ = (
+        # the plan, and overrides of its settings
+        "tier",
+        "max_tokens",
+        "compression",
+        "model",
+        "user_limit",
+        "usage",
+        # the current story
+        "moral",
+        "topic",
+        "author",
+        "structure",
+        "stage",
+        "story",
+        "fragments",
+        "summaries",
+        "last_seen",
+    )
+    FIELDS = __slots__[:-1]
+    TIER_FIELDS = ("max_tokens", "compression", "model", "user_limit")
+    STORY_FIELDS = (
+        "moral",
+        "topic",
+        "author",
+        "structure",
+        "stage",
+        "story",
+        "fragments",
+        "summaries",
+    )
+
+    def __init__(self):
+        for field in self.FIELDS:
+            setattr(self, field, _UNSET)
+        self.last_seen = 0.0
+
+    def set_tier(self, tier: str):
+        """
+        Move to a plan, dropping the overrides of the previous one
+        :param tier:
+        :return:
+        """
+        self.tier = tier
+        for field in self.TIER_FIELDS:
+            setattr(self, field, _UNSET)
+
+    def pop_story(self) -> Dict[str, Any]:
+        """
+        Clear the current story
+        :return: the story fields, None for the unset ones
+        """
+        story = {}
+        for field in self.STORY_FIELDS:
+            value = getattr(self, field)
+            story[field] = None if value is _UNSET else value
+            setattr(self, field, _UNSET)
+        return story
+
+    def to_dict(self) -> Dict[str, Any]:
+        return {
+            field: getattr(self, field)
+            for field in self.FIELDS
+            if getattr(self, field) is not _UNSET
+        }
+
+    @classmethod
+    def from_dict(cls, data: Dict[str, Any]) -> "Session":
+        session = cls()
+        for field, value in data.items():
+            setattr(session, field, value)
+        return session
+
+
+class SessionStore:
+    """
+    Per-user sessions, created on the first write
+
+    Sessions are kept in memory in least recently used order. Sessions idle
+    for longer than idle_ttl are dropped from memory: with a persistent state
+    store they are loaded again on the next access. Otherwise on_evict is
+    called with them first and only the story is dropped - the plan and its
+    overrides have nowhere else to live. Up to max_idle of those are kept,
+    the least recently used are dropped for good.
+    """
+
+    NAMESPACE = "sessions"
+
+    def __init__(
+        self,
+        store: StateStore,
+        idle_ttl: Optional[float] = None,
+        on_evict: Callable[[str, Session], None] = None,
+        max_idle: int = 100_000,
+    ):
+        """
+        :param store: where the sessions are persisted
+        :param idle_ttl: seconds without access before a session is evicted
+        :param on_evict: called with the evicted sessions that aren't persisted
+        :param max_idle: evicted sessions kept without a persistent store
+        """
+        self.store = store
+        self.idle_ttl = idle_ttl
+        self.on_evict = on_evict
+        self.max_idle = max_idle
+        self.tiers: Dict[str, Tier] = {}
+        self.default_tier: Optional[str] = None
+        self._sessions: "OrderedDict[str, Session]" = OrderedDict()
+        # evicted sessions without a story, when there's no persistent store
+        self._idle: "OrderedDict[str, Session]" = OrderedDict()
+        self.evictions = 0
+
+    def __len__(self):
+        return len(self._sessions)
+
+    def add_tier(self, tier: Tier, default: bool = False):
+        self.tiers[tier.name] = tier
+        if default or self.default_tier is None:
+            self.default_tier = tier.name
+
+    def get_tier(self, session: Optional[Session]) -> Tier:
+        if session is None or session.tier is _UNSET:
+            return self.tiers[self.default_tier]
+        return self.tiers[session.tier]
+
+    def get(self, user: str) -> Optional[Session]:
+        """
+        Get the session of the user, without creating it
+        :param user:
+        :return: the session or None if the user has none
+        """
+        session = self._sessions.get(user)
+        if session is None and user in self._idle:
+            session = self._sessions[user] = self._idle.pop(user)
+        if session is None and self.store.persistent:
+            data = self.store.get(self.NAMESPACE, user)
+            if data is not None:
+                session = self._sessions[user] = Session.from_dict(data)
+        if session is not None:
+            self._touch(user, session)
+        return session
+
+    def get_or_create(self, user: str) -> Session:
+        session = self.get(user)
+        if session is None:
+            session = self._sessions[user] = Session()
+            self._touch(user, session)
+        return session
+
+    def save(self, user: str, session: Session):
+        """
+        Persist the session after it was changed
+        :param user:
+        :param session:
+        :return:
+        """
+        if self.store.persistent:
+            self.store.set(self.NAMESPACE, user, session.to_dict())
+
+    def delete(self, user: str):
+        self._sessions.pop(user, None)
+        self._idle.pop(user, None)
+        self.store.delete(self.NAMESPACE, user)
+
+    def users(self) -> Set[str]:
+        users = set(self._sessions)
+        users.update(self._idle)
+        if self.store.persistent:
+            users.update(self.store.keys(self.NAMESPACE))
+        return users
+
+    def _touch(self, user: str, session: Session):
+        now = time.monotonic()
+        session.last_seen = now
+        self._sessions.move_to_end(user)
+        if self.idle_ttl is None:
+            return
+        # the least recently used sessions are first
+        while self._sessions:
+            oldest_user, oldest = next(iter(self._sessions.items()))
+            if oldest_user == user or now - oldest.last_seen < self.idle_ttl:
+                break
+            self._evict(oldest_user)
+
+    def _evict(self, user: str):
+        session = self._sessions.pop(user)
+        self.evictions += 1
+        if self.store.persistent:
+            self.store.evict(self.NAMESPACE, user)
+            return
+        if self.on_evict is not None:
+            self.on_evict(user, session)
+        session.pop_story()
+        if session.to_dict():
+            self._idle[user] = session
+            while len(self._idle) > self.max_idle:
+                self._idle.popitem(last=False)
+
+
+class SessionField(MutableMapping):
+    """
+    Dict-like view of one session field, by user
+
+    Reading a missing key returns the default without creating a session.
+    Like StoredDict, values must be re-assigned to be persisted.
+    """
+
+    def __init__(
+        self,
+        sessions: SessionStore,
+        field: str,
+        default_factory: Optional[Callable[[], Any]] = None,
+        tier_default: bool = False,
+        encode: Optional[Callable[[Any], Any]] = None,
+        decode: Optional[Callable[[Any], Any]] = None,
+    ):
+        """
+        :param sessions:
+        :param field: name of the Session slot
+        :param default_factory: default for users without the field
+        :param tier_default: the default is the setting of the user's tier
+        :param encode: to a json-serializable value
+        :param decode:
+        """
+        self.sessions = sessions
+        self.field = field
+        self.default_factory = default_factory
+        self.tier_default = tier_default
+        self._encode = encode
+        self._decode = decode
+
+    def _get_raw(self, user: str) -> Any:
+        session = self.sessions.get(user)
+        if session is None:
+            return _UNSET
+        return getattr(session, self.field)
+
+    def __getitem__(self, user: str) -> Any:
+        value = self._get_raw(user)
+        if value is not _UNSET:
+            return value if self._decode is None else self._decode(value)
+        if self.tier_default:
+            return getattr(self.sessions.get_tier(self.sessions.get(user)), self.field)
+        if self.default_factory is None:
+            raise KeyError(user)
+        return self.default_factory()
+
+    def __setitem__(self, user: str, value: Any):
+        if self._encode is not None:
+            value = self._encode(value)
+        session = self.sessions.get_or_create(user)
+        setattr(session, self.field, value)
+        self.sessions.save(user, session)
+
+    def __delitem__(self, user: str):
+        if user not in self:
+            raise KeyError(user)
+        session = self.sessions.get(user)
+        setattr(session, self.field, _UNSET)
+        self.sessions.save(user, session)
+
+    def __contains__(self, user) -> bool:
+        return self._get_raw(user) is not _UNSET
+
+    def get(self, user: str, default: Any = None) -> Any:
+        value = self._get_raw(user)
+        if value is _UNSET:
+            return default
+        return value if self._decode is None else self._decode(value)
+
+    def pop(self, user: str, default: Any = _UNSET) -> Any:
+        if user not in self:
+            if default is _UNSET:
+                raise KeyError(user)
+            return default
+        value = self[user]
+        del self[user]
+        return value
+
+    def __iter__(self) -> Iterator[str]:
+        return (user for user in self.sessions.users() if user in self)
+
+    def __len__(self) -> int:
+        return sum(1 for _ in self)
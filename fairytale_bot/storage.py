@@ -0,0 +1,319 @@
+import atexit
+import json
+import os
+import sqlite3
+import threading
+from abc import ABC, abstractmethod
+from collections.abc import MutableMapping
+from functools import cached_property
+from typing import Any, Callable, Iterator, List, Optional
+
+from loguru import logger
+
+_MISSING = object()
+
+
+class StateStore(ABC):
+    """
+    Key-value storage for the bot state
+
+    Values are grouped in namespaces (one per kind of state, e.g. "stories")
+    and keyed by user. Values must be json-serializable.
+    """
+
+    # whether the values outlive the process
+    persistent = True
+
+    @abstractmethod
+    def get(self, namespace: str, key: str, default: Any = None) -> Any:
+        pass
+
+    @abstractmethod
+    def set(self, namespace: str, key: str, value: Any):
+        pass
+
+    @abstractmethod
+    def delete(self, namespace: str, key: str):
+        pass
+
+    @abstractmethod
+    def keys(self, namespace: str) -> List[str]:
+        pass
+
+    def flush(self):
+        """Write all pending changes to the backend"""
+
+    def evict(self, namespace: str, key: str):
+        """Drop the value from the in-memory cache, if any - it stays stored"""
+
+    def close(self):
+        self.flush()
+
+    def mapping(self, namespace: str, **kwargs) -> "StoredDict":
+        """
+        Get a dict-like view of a namespace
+        :param namespace:
+        :param kwargs: see StoredDict
+        :return:
+        """
+        return StoredDict(self, namespace, **kwargs)
+
+
+class InMemoryStore(StateStore):
+    """
+    Process-local state store, lost on restart
+    """
+
+    persistent = False
+
+    def __init__(self):
+        self._data = {}
+
+    def get(self, namespace: str, key: str, default: Any = None) -> Any:
+        return self._data.get(namespace, {}).get(key, default)
+
+    def set(self, namespace: str, key: str, value: Any):
+        self._data.setdefault(namespace, {})[key] = value
+
+    def delete(self, namespace: str, key: str):
+        self._data.get(namespace, {}).pop(key, None)
+
+    def keys(self, namespace: str) -> List[str]:
+        return list(self._data.get(namespace, {}))
+
+
+class SqliteStore(StateStore):
+    """
+    SQLite-backed state store with an in-memory cache and write-behind flushing
+
+    Reads are served from the cache, writes only mark the key dirty.
+    A background thread writes dirty keys in batches,
+    every flush_interval seconds or as soon as batch_size keys are dirty.
+    """
+
+    def __init__(self, path: str, batch_size: int = 500, flush_interval: float = 1.0):
+        self.path = path
+        self.batch_size = batch_size
+        self.flush_interval = flush_interval
+
+        self._conn = sqlite3.connect(path, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        self._conn.execute(
+            "CREATE TABLE IF NOT EXISTS state ("
+            " namespace TEXT NOT NULL,"
+            " key TEXT NOT NULL,"
+            " value TEXT NOT NULL,"
+            " PRIMARY KEY (namespace, key)"
+            ") WITHOUT ROWID"
+        )
+        self._conn.commit()
+
+        self._cache = {}  # (namespace, key) -> value or _MISSING
+        self._dirty = {}  # (namespace, key) -> value or _MISSING (deleted)
+        self._db_lock = threading.Lock()
+        self._dirty_lock = threading.Lock()
+        self._flush_requested = threading.Event()
+        self._closed = False
+        self._flusher = threading.Thread(
+            target=self._flush_loop, name="state-store-flusher", daemon=True
+        )
+        self._flusher.start()
+        atexit.register(self.close)
+
+    def get(self, namespace: str, key: str, default: Any = None) -> Any:
+        cache_key = (namespace, key)
+        value = self._cache.get(cache_key, _MISSING)
+        if value is _MISSING and cache_key not in self._cache:
+            value = self._load(namespace, key)
+            self._cache[cache_key] = value
+        return default if value is _MISSING else value
+
+    def _load(self, namespace: str, key: str) -> Any:
+        with self._db_lock:
+            row = self._conn.execute(
+                "SELECT value FROM state WHERE namespace = ? AND key = ?",
+                (namespace, key),
+            ).fetchone()
+        return _MISSING if row is None else json.loads(row[0])
+
+    def set(self, namespace: str, key: str, value: Any):
+        self._cache[(namespace, key)] = value
+        self._mark_dirty((namespace, key), value)
+
+    def delete(self, namespace: str, key: str):
+        self._cache[(namespace, key)] = _MISSING
+        self._mark_dirty((namespace, key), _MISSING)
+
+    def evict(self, namespace: str, key: str):
+        with self._dirty_lock:
+            if (namespace, key) in self._dirty:
+                # not written yet - the cache is the only up-to-date copy
+                return
+        self._cache.pop((namespace, key), None)
+
+    def _mark_dirty(self, cache_key, value):
+        with self._dirty_lock:
+            self._dirty[cache_key] = value
+            batch_ready = len(self._dirty) >= self.batch_size
+        if batch_ready:
+            self._flush_requested.set()
+
+    def keys(self, namespace: str) -> List[str]:
+        self.flush()
+        with self._db_lock:
+            rows = self._conn.execute(
+                "SELECT key FROM state WHERE namespace = ?", (namespace,)
+            ).fetchall()
+        return [row[0] for row in rows]
+
+    def flush(self):
+        if not self._dirty:
+            return
+        with self._db_lock:
+            # swap the buffer so that writers are never blocked by the db
+            with self._dirty_lock:
+                dirty, self._dirty = self._dirty, {}
+            upserts = []
+            deletes = []
+            for (namespace, key), value in dirty.items():
+                if value is _MISSING:
+                    deletes.append((namespace, key))
+                else:
+                    upserts.append((namespace, key, json.dumps(value)))
+            with self._conn:
+                self._conn.executemany(
+                    "INSERT OR REPLACE INTO state (namespace, key, value)"
+                    " VALUES (?, ?, ?)",
+                    upserts,
+                )
+                self._conn.executemany(
+                    "DELETE FROM state WHERE namespace = ? AND key = ?", deletes
+                )
+
+    def _flush_loop(self):
+        while not self._closed:
+            self._flush_requested.wait(self.flush_interval)
+            self._flush_requested.clear()
+            try:
+                self.flush()
+            except Exception as e:
+                logger.exception(f"Failed to flush the state store: {e}")
+
+    def close(self):
+        if self._closed:
+            return
+        self._closed = True
+        self._flush_requested.set()
+        self.flush()
+        with self._db_lock:
+            self._conn.close()
+
+
+class StoredDict(MutableMapping):
+    """
+    Dict-like view of a state store namespace
+
+    Works like a defaultdict when default_factory is set,
+    except that reading a missing key doesn't store the default.
+    Values are written back only on assignment - mutating a value in place
+    (e.g. list.append) is not persisted, re-assign it instead.
+    """
+
+    def __init__(
+        self,
+        store: StateStore,
+        namespace: str,
+        default_factory: Optional[Callable[[], Any]] = None,
+        encode: Optional[Callable[[Any], Any]] = None,
+        decode: Optional[Callable[[Any], Any]] = None,
+    ):
+        self.store = store
+        self.namespace = namespace
+        self.default_factory = default_factory
+        self._encode = encode
+        self._decode = decode
+
+    def _get_raw(self, key: str) -> Any:
+        value = self.store.get(self.namespace, key, _MISSING)
+        if value is not _MISSING and self._decode is not None:
+            value = self._decode(value)
+        return value
+
+    def __getitem__(self, key: str) -> Any:
+        value = self._get_raw(key)
+        if value is not _MISSING:
+            return value
+        if self.default_factory is None:
+            raise KeyError(key)
+        return self.default_factory()
+
+    def __setitem__(self, key: str, value: Any):
+        if self._encode is not None:
+            value = self._encode(value)
+        self.store.set(self.namespace, key, value)
+
+    def __delitem__(self, key: str):
+        if key not in self:
+            raise KeyError(key)
+        self.store.delete(self.namespace, key)
+
+    def __contains__(self, key) -> bool:
+        return self.store.get(self.namespace, key, _MISSING) is not _MISSING
+
+    def get(self, key: str, default: Any = None) -> Any:
+        value = self._get_raw(key)
+        return default if value is _MISSING else value
+
+    def pop(self, key: str, default: Any = _MISSING) -> Any:
+        value = self._get_raw(key)
+        if value is _MISSING:
+            if default is _MISSING:
+                raise KeyError(key)
+            return default
+        self.store.delete(self.namespace, key)
+        return value
+
+    def __iter__(self) -> Iterator[str]:
+        return iter(self.store.keys(self.namespace))
+
+    def __len__(self) -> int:
+        return len(self.store.keys(self.namespace))
+
+
+def create_state_store(path: Optional[str] = None) -> StateStore:
+    """
+    Create a state store: SQLite if the path is set, in-memory otherwise
+    :param path:
+    :return:
+    """
+    if path:
+        logger.info(f"Using SQLite state store at {path}")
+        return SqliteStore(path)
+    return InMemoryStore()
+
+
+class StateStoreMixin:
+    """
+    Shares a single state store between all the app components
+    """
+
+    # path to the SQLite db, in-memory storage is used if not set
+    STATE_DB_PATH: Optional[str] = None
+    # sessions not used for this long are dropped from memory
+    SESSION_IDLE_TTL: Optional[float] = 7 * 24 * 3600  # seconds
+    # idle sessions with a plan kept in memory when there's no state db
+    SESSION_MAX_IDLE = 100_000
+
+    @cached_property
+    def store(self) -> StateStore:
+        path = self.STATE_DB_PATH or os.getenv("FAIRYTALE_STATE_DB")
+        return create_state_store(path)
+
+    @cached_property
+    def sessions(self) -> "SessionStore":
+        from fairytale_bot.session import SessionStore
+
+        return SessionStore(
+            self.store, idle_ttl=self.SESSION_IDLE_TTL, max_idle=self.SESSION_MAX_IDLE
+        )
@@ -0,0 +1,120 @@
+import hashlib
+import json
+import random
+import time
+from collections import OrderedDict
+from pathlib import Path
+from typing import Optional, Union
+
+from loguru import logger
+
+
+class StructureCache:
+    """
+    Cache of parsed story structures, keyed by the prompt and the model
+
+    Keeps the most recently used entries in memory and, optionally, all of them
+    on disk. Each key holds up to `variants` different structures - until all of
+    them are generated the cache reports a miss, then a random one is served,
+    so the same settings still produce different stories.
+    """
+
+    def __init__(
+        self,
+        max_size: int = 1000,
+        ttl: float = 7 * 24 * 3600,
+        variants: int = 1,
+        cache_dir: Union[str, Path, None] = None,
+    ):
+        self.max_size = max_size
+        self.ttl = ttl
+        self.variants = variants
+        self.cache_dir = Path(cache_dir) if cache_dir else None
+        if self.cache_dir:
+            self.cache_dir.mkdir(parents=True, exist_ok=True)
+
+        # key -> list of {"created": timestamp, "structure": structure}
+        self._entries: "OrderedDict[str, list]" = OrderedDict()
+        self.hits = 0
+        self.misses = 0
+        self.evictions = 0
+
+    @staticmethod
+    def make_key(prompt: str, model: str) -> str:
+        normalized = " ".join(prompt.lower().split())
+        return hashlib.sha256(f"{model}\n{normalized}".encode()).hexdigest()
+
+    def _path(self, key: str) -> Path:
+        return self.cache_dir / f"{key}.json"
+
+    def _load(self, key: str) -> list:
+        if key in self._entries:
+            self._entries.move_to_end(key)
+            return self._entries[key]
+        if self.cache_dir is None or not self._path(key).exists():
+            return []
+        try:
+            entries = json.loads(self._path(key).read_text())
+        except (OSError, ValueError) as e:
+            logger.warning(f"Failed to read the cached structure {key}: {e}")
+            return []
+        self._remember(key, entries)
+        return entries
+
+    def _remember(self, key: str, entries: list):
+        self._entries[key] = entries
+        self._entries.move_to_end(key)
+        while len(self._entries) > self.max_size:
+            self._entries.popitem(last=False)
+            self.evictions += 1
+
+    def get(self, key: str) -> Optional[dict]:
+        """
+        Get one of the cached structures
+        :param key:
+        :return: the structure or None if there are not enough variants yet
+        """
+        entries = self._load(key)
+        now = time.time()
+        fresh = [entry for entry in entries if now - entry["created"] < self.ttl]
+        if len(fresh) != len(entries):
+            self.evictions += len(entries) - len(fresh)
+            self._save(key, fresh)
+        if len(fresh) < self.variants:
+            self.misses += 1
+            return None
+        self.hits += 1
+        return random.choice(fresh)["structure"]
+
+    def put(self, key: str, structure: dict):
+        """
+        Add a structure variant
+        :param key:
+        :param structure:
+        :return:
+        """
+        entries = self._load(key) + [{"created": time.time(), "structure": structure}]
+        self._save(key, entries[-self.variants :])
+
+    def _save(self, key: str, entries: list):
+        if not entries:
+            self._entries.pop(key, None)
+        else:
+            self._remember(key, entries)
+        if self.cache_dir is None:
+            return
+        if entries:
+            self._path(key).write_text(json.dumps(entries))
+        else:
+            self._path(key).unlink(missing_ok=True)
+
+    @property
+    def stats(self) -> dict:
+        requests = self.hits + self.misses
+        return {
+            "hits": self.hits,
+            "misses": self.misses,
+            "evictions": self.evictions,
+            "hit_rate": self.hits / requests if requests else 0.0,
+            "size": len(self._entries),
+        }
@@ -0,0 +1,173 @@
+import re
+from typing import List, Optional
+
+STORY_SECTIONS = ("exposition", "climax", "resolution")
+
+# a line that is only a section header, in any of the forms the models use:
+# [Exposition], ## Climax, **Resolution:**, 1. Exposition, II. (climax)
+HEADER_PATTERN = re.compile(
+    r"(?:#{1,6}\s*)?(?:\*\*|__)?\s*(?:(?:\d+|[ivx]+)[.)]\s*)?[\[(]?\s*"
+    r"(" + "|".join(STORY_SECTIONS) + r")"
+    r"\s*[\])]?\s*(?:\*\*|__)?\s*:?\s*(?:\*\*|__)?$",
+    re.IGNORECASE,
+)
+# a numbered list item: 1. step, 1) step
+NUMBERED_ITEM_PATTERN = re.compile(r"\d+[.)]\s+(.+)")
+BULLETS = "-*•+"
+HEADER_MARKUP = "[]()*_#: \t"
+HEADER_MAX_LENGTH = 20
+# the line between the structure and the first part in the fused output
+STORY_DELIMITER = "===STORY==="
+
+
+class StructureParser:
+    """
+    Single-pass story structure parser, can be fed the text as it streams
+
+    Complete lines are scanned once: headers switch the current section,
+    list items become story parts. Items before the first header only go
+    to all_parts.
+    """
+
+    def __init__(self):
+        self._chunks: List[str] = []
+        self.sections = {section: [] for section in STORY_SECTIONS}
+        self.all_parts: List[str] = []
+        self._section: Optional[List[str]] = None
+        self._buffer = ""
+
+    def feed(self, chunk: str) -> List[str]:
+        """
+        Parse the next chunk of the structure
+        :param chunk:
+        :return: story parts completed by this chunk
+        """
+        self._chunks.append(chunk)
+        if "\n" not in chunk:
+            self._buffer += chunk
+            return []
+        text = self._buffer + chunk
+        end = text.rindex("\n")
+        self._buffer = text[end + 1 :]
+        return self._parse(text[:end])
+
+    def close(self) -> List[str]:
+        """
+        Parse the last line
+        :return: story parts completed by it
+        """
+        text, self._buffer = self._buffer, ""
+        return self._parse(text)
+
+    def _parse(self, text: str) -> List[str]:
+        parts = []
+        for line in text.split("\n"):
+            line = line.strip()
+            if not line:
+                continue
+            # most lines are list items - check them without the header pattern
+            first = line[0]
+            if first in BULLETS and line[1:2].isspace():
+                item = line[2:].lstrip()
+            elif first == "-" and line.strip("-"):
+                # a dash needs no space after it: -step
+                item = line[1:].lstrip()
+            elif first.isdigit() and (numbered := NUMBERED_ITEM_PATTERN.match(line)):
+                item = numbered.group(1)
+            else:
+                header = HEADER_PATTERN.match(line)
+                if header:
+                    self._section = self.sections[header.group(1).lower()]
+                continue
+            # a header made into a list item: 1. Exposition, - **Climax**
+            if len(item) <= HEADER_MAX_LENGTH:
+                section = item.strip(HEADER_MARKUP).lower()
+                if section in self.sections:
+                    self._section = self.sections[section]
+                    continue
+            part = "- " + item
+            if self._section is not None:
+                self._section.append(part)
+            parts.append(part)
+        self.all_parts.extend(parts)
+        return parts
+
+    @property
+    def raw(self) -> str:
+        return "".join(self._chunks)
+
+    def result(self) -> dict:
+        return {"raw": self.raw, **self.sections, "all_parts": self.all_parts}
+
+
+class FusedStoryParser:
+    """
+    Splits a streamed structure followed by the first part of the story
+
+    The text before the STORY_DELIMITER line goes to the structure parser,
+    everything after it is the story part and is returned as soon as it's fed.
+    """
+
+    def __init__(self):
+        self.structure = StructureParser()
+        self.in_story = False
+        self._line = ""
+
+    @staticmethod
+    def _is_delimiter(line: str) -> bool:
+        # tolerate "=== STORY ===", "**===STORY===**" and the like
+        return line.strip(" \t*_#").replace(" ", "").upper() == STORY_DELIMITER
+
+    def feed(self, chunk: str) -> str:
+        """
+        :param chunk:
+        :return: the story text in this chunk
+        """
+        if self.in_story:
+            return chunk
+        text = self._line + chunk
+        start = 0
+        while (end := text.find("\n", start)) != -1:
+            if self._is_delimiter(text[start:end]):
+                self.structure.feed(text[:start])
+                self.structure.close()
+                self.in_story = True
+                self._line = ""
+                return text[end + 1 :].lstrip("\n")
+            start = end + 1
+        # only complete lines go to the structure, the delimiter could be split
+        self.structure.feed(text[:start])
+        self._line = text[start:]
+        return ""
+
+    def close(self):
+        """Parse the last line of the structure if the story never began"""
+        if self.in_story:
+            return
+        line, self._line = self._line, ""
+        if self._is_delimiter(line):
+            self.in_story = True
+        else:
+            self.structure.feed(line)
+        self.structure.close()
+
+
+def extract_story_parts(text: str) -> List[str]:
+    """
+    Get all the list items of the text, normalized to "- item"
+    :param text:
+    :return:
+    """
+    return StructureParser()._parse(text)
+
+
+def parse_story_structure(text: str) -> dict:
+    """
+    Parse a complete story structure
+    :param text:
+    :return: dict with the raw text, parts per section and all_parts
+    """
+    parser = StructureParser()
+    parser._parse(text)
+    parser._chunks.append(text)
+    return parser.result()
@@ -0,0 +1,75 @@
+import asyncio
+from collections import deque
+from typing import Awaitable, Callable, Optional
+
+from loguru import logger
+
+
+class StructurePool:
+    """
+    Pool of ready-made story bundles (settings + structure), refilled in the background
+
+    A refill starts when the pool drops below the low-water mark
+    and generates bundles until the pool is full again.
+    """
+
+    def __init__(
+        self,
+        make_bundle: Callable[[], Awaitable[dict]],
+        size: int = 10,
+        low_water: int = 3,
+        max_concurrency: int = 2,
+    ):
+        self.make_bundle = make_bundle
+        self.size = size
+        self.low_water = low_water
+        self.max_concurrency = max_concurrency
+        self._bundles = deque()
+        self._refill_task: Optional[asyncio.Task] = None
+
+    def __len__(self):
+        return len(self._bundles)
+
+    @property
+    def refilling(self) -> bool:
+        return self._refill_task is not None and not self._refill_task.done()
+
+    def pop(self) -> Optional[dict]:
+        """
+        Take a ready bundle, starting a refill if the pool runs low
+        :return: the bundle or None if the pool is empty
+        """
+        bundle = self._bundles.popleft() if self._bundles else None
+        if len(self._bundles) < self.low_water:
+            self.refill()
+        return bundle
+
+    def refill(self):
+        """
+        Start filling the pool in the background, if not already running
+        :return:
+        """
+        if self.refilling or len(self._bundles) >= self.size:
+            return
+        self._refill_task = asyncio.create_task(self._refill())
+
+    async def _refill(self):
+        semaphore = asyncio.Semaphore(self.max_concurrency)
+
+        async def make_bundle():
+            async with semaphore:
+                self._bundles.append(await self.make_bundle())
+
+        missing = self.size - len(self._bundles)
+        results = await asyncio.gather(
+            *(make_bundle() for _ in range(missing)), return_exceptions=True
+        )
+        errors = [result for result in results if isinstance(result, Exception)]
+        if errors:
+            # don't retry right away - the next pop will start a new refill
+            logger.warning(f"Failed to make {len(errors)} story bundles: {errors[0]}")
+
+    async def close(self):
+        if self.refilling:
+            self._refill_task.cancel()
+            await asyncio.wait({self._refill_task})
@@ -0,0 +1,94 @@
+import asyncio
+from contextlib import asynccontextmanager, contextmanager
+from typing import Awaitable, Callable, Dict, Hashable, TypeVar
+
+T = TypeVar("T")
+
+
+class _LockEntry:
+    __slots__ = ("lock", "users")
+
+    def __init__(self):
+        self.lock = asyncio.Lock()
+        self.users = 0  # holding or waiting for the lock
+
+
+class UserLocks:
+    """
+    Per-user async locks
+
+    An entry exists only while someone holds or waits for the lock,
+    so memory depends on the number of active users, not on all users.
+    """
+
+    def __init__(self):
+        self._entries: Dict[Hashable, _LockEntry] = {}
+
+    def __len__(self):
+        return len(self._entries)
+
+    def is_locked(self, user: Hashable) -> bool:
+        return user in self._entries
+
+    def _enter(self, user: Hashable) -> _LockEntry:
+        entry = self._entries.get(user)
+        if entry is None:
+            entry = self._entries[user] = _LockEntry()
+        entry.users += 1
+        return entry
+
+    def _exit(self, user: Hashable, entry: _LockEntry):
+        entry.users -= 1
+        if entry.users == 0:
+            del self._entries[user]
+
+    @asynccontextmanager
+    async def lock(self, user: Hashable):
+        entry = self._enter(user)
+        try:
+            async with entry.lock:
+                yield
+        finally:
+            self._exit(user, entry)
+
+    @contextmanager
+    def hold(self, user: Hashable):
+        """
+        Mark the user as locked right away, without taking the lock
+
+        Entering is synchronous, so a command can check is_locked and hold the
+        user before its first await - a command arriving meanwhile sees it
+        locked. The lock itself is still taken later, by whoever does the work.
+        """
+        entry = self._enter(user)
+        try:
+            yield
+        finally:
+            self._exit(user, entry)
+
+
+class SingleFlight:
+    """
+    Coalesces concurrent calls with the same key into one
+
+    Callers that arrive while a call is in flight get its result
+    instead of starting a new one.
+    """
+
+    def __init__(self):
+        self._calls: Dict[Hashable, asyncio.Future] = {}
+
+    def __len__(self):
+        return len(self._calls)
+
+    def in_flight(self, key: Hashable) -> bool:
+        return key in self._calls
+
+    async def run(self, key: Hashable, call: Callable[[], Awaitable[T]]) -> T:
+        task = self._calls.get(key)
+        if task is None:
+            task = asyncio.ensure_future(call())
+            self._calls[key] = task
+            task.add_done_callback(lambda _: self._calls.pop(key, None))
+        # a cancelled caller shouldn't cancel the call for everyone else
+        return await asyncio.shield(task)
@@ -1,17 +1,22 @@
-from collections import defaultdict
 from enum import Enum
 
 from aiogram.types import Message
 from bot_lib import Handler, App
 
+from fairytale_bot.quota import CalendarWindow
+from fairytale_bot.response_cache import ResponseCacheMode
+from fairytale_bot.session import SessionField, Tier
+from fairytale_bot.storage import StateStoreMixin
+
 
 class StoryCompression(Enum):
     COMPLETE_STORY = 0
     FEW_LINES_PER_PART = 1
     LAST_PART_ONLY = 2
+    LLM_SUMMARY = 3
 
 
-class UserSettings(App):
+class UserSettings(StateStoreMixin, App):
     """
     user settings
     """
@@ -20,32 +25,85 @@ class UserSettings(App):
     DEFAULT_COMPRESSION = StoryCompression.FEW_LINES_PER_PART
     DEFAULT_MODEL = "gpt-3.5-turbo"
     DEFAULT_USER_LIMIT = 10
+    DEFAULT_USER_REQUESTS_PER_MINUTE = 5
+    DEFAULT_TIER = "default"
+    # EXACT or SIMILAR reuses the story parts generated for identical prompts,
+    # off unless a tier opts in - users expect a new story every time
+    DEFAULT_RESPONSE_CACHE = ResponseCacheMode.OFF
 
     def __init__(self, **kwargs):
         super().__init__(**kwargs)
 
-        self.max_tokens_per_user = defaultdict(lambda: self.DEFAULT_MAX_TOKENS)
-        self.compression_per_user = defaultdict(lambda: self.DEFAULT_COMPRESSION)
-        self.model_per_user = defaultdict(lambda: self.DEFAULT_MODEL)
-        self.user_limits = defaultdict(lambda: self.DEFAULT_USER_LIMIT)
+        # the settings of the tiers are shared, sessions only keep overrides
+        self.sessions.add_tier(
+            Tier(
+                self.DEFAULT_TIER,
+                max_tokens=self.DEFAULT_MAX_TOKENS,
+                compression=self.DEFAULT_COMPRESSION,
+                model=self.DEFAULT_MODEL,
+                user_limit=self.DEFAULT_USER_LIMIT,
+            ),
+            default=True,
+        )
+        self.sessions.add_tier(
+            Tier(
+                self.PREMIUM_TIER,
+                max_tokens=self.PREMIUM_MAX_TOKENS,
+                compression=self.PREMIUM_COMPRESSION,
+                model=self.PREMIUM_MODEL,
+                user_limit=self.PREMIUM_USER_LIMIT,
+            )
+        )
+
+        self.max_tokens_per_user = SessionField(
+            self.sessions, "max_tokens", tier_default=True
+        )
+        self.compression_per_user = SessionField(
+            self.sessions,
+            "compression",
+            tier_default=True,
+            encode=lambda compression: compression.name,
+            decode=StoryCompression.__getitem__,
+        )
+        self.model_per_user = SessionField(self.sessions, "model", tier_default=True)
+        self.user_limits = SessionField(self.sessions, "user_limit", tier_default=True)
+        self.tier_per_user = SessionField(
+            self.sessions, "tier", default_factory=lambda: self.DEFAULT_TIER
+        )
+
+    def set_tier(self, user, tier: str):
+        session = self.sessions.get_or_create(user)
+        session.set_tier(tier)
+        self.sessions.save(user, session)
 
     def set_default(self, user):
-        self.max_tokens_per_user[user] = self.DEFAULT_MAX_TOKENS
-        self.compression_per_user[user] = self.DEFAULT_COMPRESSION
-        self.model_per_user[user] = self.DEFAULT_MODEL
-        self.user_limits[user] = self.DEFAULT_USER_LIMIT
+        self.set_tier(user, self.DEFAULT_TIER)
 
     PREMIUM_MAX_TOKENS = 1000
     PREMIUM_COMPRESSION = StoryCompression.COMPLETE_STORY
     PREMIUM_MODEL = "gpt-4"
     PREMIUM_USER_LIMIT = 100
-    # todo: refresh every month?  week?
+    PREMIUM_USER_REQUESTS_PER_MINUTE = 20
+    PREMIUM_TIER = "premium"
+    PREMIUM_RESPONSE_CACHE = ResponseCacheMode.OFF
+    # the user limits refresh every month, SlidingWindow for a rolling period
+    USAGE_WINDOW = CalendarWindow("month")
 
     def set_premium(self, user):
-        self.max_tokens_per_user[user] = self.PREMIUM_MAX_TOKENS
-        self.compression_per_user[user] = self.PREMIUM_COMPRESSION
-        self.model_per_user[user] = self.PREMIUM_MODEL
-        self.user_limits[user] = self.PREMIUM_USER_LIMIT
+        self.set_tier(user, self.PREMIUM_TIER)
+
+    def is_premium(self, user):
+        return self.tier_per_user[user] == self.PREMIUM_TIER
+
+    def get_user_requests_per_minute(self, user):
+        if self.is_premium(user):
+            return self.PREMIUM_USER_REQUESTS_PER_MINUTE
+        return self.DEFAULT_USER_REQUESTS_PER_MINUTE
+
+    def get_response_cache_mode(self, user) -> ResponseCacheMode:
+        if self.is_premium(user):
+            return self.PREMIUM_RESPONSE_CACHE
+        return self.DEFAULT_RESPONSE_CACHE
 
 
 class UserSettingsHandler(Handler):
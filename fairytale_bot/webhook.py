@@ -0,0 +1,401 @@
+"""
+Webhook server mode
+
+Telegram posts updates to an aiohttp endpoint that answers right away and
+hands them over to a pool of workers. The updates of one user are processed
+in order, one at a time, while different users are processed concurrently,
+up to --workers updates at once.
+
+Workers are asyncio tasks in this process (--processes 0) or in separate
+processes, each running its own dispatcher. Users are sharded over the
+processes by user ID and every user stays on the same process, so the
+per-process state cache, usage quotas and per-user rate limits stay
+consistent for them; point FAIRYTALE_STATE_DB at a shared database to keep
+the state between restarts. The per-model rate limits (requests and tokens
+per minute) are for the whole provider account, so each process gets an
+equal share of them.
+
+python -m fairytale_bot.webhook --port 8080 --workers 256 --processes 4
+"""
+
+import argparse
+import asyncio
+import importlib
+import multiprocessing
+import os
+import queue
+from collections import deque
+from typing import Awaitable, Callable, Deque, Dict, Optional
+
+from loguru import logger
+
+UpdateHandler = Callable[[dict], Awaitable[None]]
+
+# update fields that carry the user who sent it
+USER_UPDATE_FIELDS = (
+    "message",
+    "edited_message",
+    "callback_query",
+    "inline_query",
+    "chosen_inline_result",
+    "shipping_query",
+    "pre_checkout_query",
+    "poll_answer",
+    "my_chat_member",
+    "chat_member",
+    "chat_join_request",
+)
+SECRET_TOKEN_HEADER = "X-Telegram-Bot-Api-Secret-Token"
+
+
+class WorkerPoolOverloaded(Exception):
+    """The queue of the shard is full"""
+
+
+def get_update_user_id(update: dict) -> int:
+    """
+    Find the id of the user who sent the update
+    :param update: raw telegram update
+    :return: user id, chat id if there's no user, 0 if there's neither
+    """
+    for field in USER_UPDATE_FIELDS:
+        payload = update.get(field)
+        if not payload:
+            continue
+        sender = payload.get("from") or payload.get("user")
+        if sender:
+            return sender["id"]
+        chat = payload.get("chat")
+        if chat:
+            return chat["id"]
+    return 0
+
+
+class TaskWorkerPool:
+    """
+    Processes updates in asyncio tasks, one task per user with updates
+
+    The updates of a user wait in the queue of the user and are processed in
+    order, one at a time, while different users are processed concurrently.
+    A queue and its task exist only while the user has updates.
+    """
+
+    def __init__(self, handle: UpdateHandler, workers: int = 256, max_queue: int = 100):
+        """
+        :param handle: coroutine function processing one update
+        :param workers: updates processed at once
+        :param max_queue: updates waiting per user before submit() fails,
+            0 for no limit
+        """
+        self.handle = handle
+        self.workers = workers
+        self.max_queue = max_queue
+        self._queues: Dict[int, Deque[dict]] = {}
+        self._tasks: Dict[int, asyncio.Task] = {}
+        self._semaphore = asyncio.Semaphore(workers)
+        self._dequeued = asyncio.Event()
+
+    @property
+    def queue_size(self) -> int:
+        return sum(len(updates) for updates in self._queues.values())
+
+    def start(self):
+        """Nothing to start, the tasks are created as the updates come"""
+
+    def submit(self, update: dict):
+        """
+        Queue the update of its user, doesn't wait for processing
+        :param update:
+        :return:
+        """
+        user_id = get_update_user_id(update)
+        if self._is_full(user_id):
+            raise WorkerPoolOverloaded(f"User {user_id} has too many updates")
+        self._add(user_id, update)
+
+    async def put(self, update: dict):
+        """
+        Queue the update of its user, waiting for space in the queue
+        :param update:
+        :return:
+        """
+        user_id = get_update_user_id(update)
+        while self._is_full(user_id):
+            self._dequeued.clear()
+            await self._dequeued.wait()
+        self._add(user_id, update)
+
+    def _is_full(self, user_id: int) -> bool:
+        updates = self._queues.get(user_id)
+        return (
+            bool(self.max_queue)
+            and updates is not None
+            and (len(updates) >= self.max_queue)
+        )
+
+    def _add(self, user_id: int, update: dict):
+        updates = self._queues.get(user_id)
+        if updates is None:
+            updates = self._queues[user_id] = deque()
+            self._tasks[user_id] = asyncio.create_task(self._work(user_id, updates))
+        updates.append(update)
+
+    async def _work(self, user_id: int, updates: Deque[dict]):
+        try:
+            while updates:
+                update = updates.popleft()
+                self._dequeued.set()
+                async with self._semaphore:
+                    try:
+                        await self.handle(update)
+                    except Exception:
+                        logger.exception(
+                            f"Failed to process update {update.get('update_id')}"
+                        )
+        finally:
+            # no await since the queue was found empty - nothing was added
+            del self._queues[user_id], self._tasks[user_id]
+
+    async def join(self):
+        """Wait until all the queued updates are processed"""
+        while self._tasks:
+            await asyncio.wait(list(self._tasks.values()))
+
+    async def close(self):
+        tasks = list(self._tasks.values())
+        for task in tasks:
+            task.cancel()
+        await asyncio.gather(*tasks, return_exceptions=True)
+
+
+def load_dispatcher(module_name: str = "fairytale_bot.bot"):
+    """
+    Import the module defining `dp` and `bot`
+    :param module_name:
+    :return: dispatcher, bot
+    """
+    module = importlib.import_module(module_name)
+    return module.dp, module.bot
+
+
+def dispatcher_handler(dp, bot) -> UpdateHandler:
+    async def handle(update: dict):
+        await dp.feed_raw_update(bot, update)
+
+    return handle
+
+
+def _run_worker_process(
+    updates, ready, module_name: str, workers: int, processes: int = 1
+):
+    # read by the app when the dispatcher module creates it
+    os.environ["FAIRYTALE_MODEL_LIMIT_SHARE"] = str(1 / processes)
+
+    async def main():
+        dp, bot = load_dispatcher(module_name)
+        # each process runs its own dispatcher, with its own startup hooks
+        await dp.emit_startup(bot=bot)
+        ready.set()
+        # unbounded: a busy user mustn't block reading updates for the others,
+        # the process queue already limits how many updates are waiting
+        pool = TaskWorkerPool(dispatcher_handler(dp, bot), workers, max_queue=0)
+        loop = asyncio.get_running_loop()
+        try:
+            while True:
+                update = await loop.run_in_executor(None, updates.get)
+                if update is None:
+                    break
+                await pool.put(update)
+            await pool.join()
+        finally:
+            await pool.close()
+            await dp.emit_shutdown(bot=bot)
+            await bot.session.close()
+
+    asyncio.run(main())
+
+
+class ProcessWorkerPool:
+    """
+    Processes updates in worker processes, sharded by user id
+
+    Each process imports the dispatcher module and runs a TaskWorkerPool.
+    """
+
+    def __init__(
+        self,
+        processes: int = 4,
+        module_name: str = "fairytale_bot.bot",
+        workers: int = 256,
+        max_queue: int = 1600,
+    ):
+        """
+        :param processes: number of worker processes
+        :param module_name: module defining `dp` and `bot`
+        :param workers: updates processed at once per process
+        :param max_queue: updates waiting per process
+        """
+        self.processes = processes
+        self.module_name = module_name
+        self.workers = workers
+        self.max_queue = max_queue
+        self._queues = []
+        self._ready = []
+        self._processes = []
+
+    def start(self):
+        if self._queues:
+            return
+        # spawn - the workers must not inherit the event loop of the server
+        context = multiprocessing.get_context("spawn")
+        for _ in range(self.processes):
+            updates = context.Queue(self.max_queue)
+            ready = context.Event()
+            process = context.Process(
+                target=_run_worker_process,
+                args=(updates, ready, self.module_name, self.workers, self.processes),
+                daemon=True,
+            )
+            process.start()
+            self._queues.append(updates)
+            self._ready.append(ready)
+            self._processes.append(process)
+
+    def submit(self, update: dict):
+        if not self._queues:
+            self.start()
+        shard = get_update_user_id(update) % self.processes
+        try:
+            self._queues[shard].put_nowait(update)
+        except queue.Full:
+            raise WorkerPoolOverloaded(f"Process {shard} has too many updates")
+
+    async def wait_ready(self):
+        """Wait until all the workers have imported the dispatcher"""
+        loop = asyncio.get_running_loop()
+        for ready in self._ready:
+            await loop.run_in_executor(None, ready.wait)
+
+    async def close(self):
+        for updates in self._queues:
+            updates.put(None)
+        loop = asyncio.get_running_loop()
+        for process in self._processes:
+            await loop.run_in_executor(None, process.join)
+        self._queues, self._ready, self._processes = [], [], []
+
+
+def create_webhook_app(pool, path: str = "/webhook", secret_token: str = None):
+    """
+    aiohttp app receiving the updates from Telegram
+    :param pool: TaskWorkerPool or ProcessWorkerPool
+    :param path:
+    :param secret_token: expected value of the secret token header, if set
+    :return:
+    """
+    from aiohttp import web
+
+    async def webhook_view(request: web.Request):
+        if secret_token and request.headers.get(SECRET_TOKEN_HEADER) != secret_token:
+            return web.Response(status=401)
+        try:
+            update = await request.json()
+        except ValueError:
+            update = None
+        if not isinstance(update, dict):
+            return web.Response(status=400)
+        try:
+            pool.submit(update)
+        except WorkerPoolOverloaded as e:
+            # telegram will retry the update later
+            logger.warning(e)
+            return web.Response(status=503)
+        return web.Response()
+
+    async def on_startup(_):
+        pool.start()
+
+    async def on_cleanup(_):
+        await pool.close()
+
+    app = web.Application()
+    app.router.add_post(path, webhook_view)
+    app.on_startup.append(on_startup)
+    app.on_cleanup.append(on_cleanup)
+    return app
+
+
+def run_webhook(
+    url: str,
+    host: str = "0.0.0.0",
+    port: int = 8080,
+    path: str = "/webhook",
+    processes: int = 0,
+    workers: int = 256,
+    secret_token: Optional[str] = None,
+):
+    """
+    Register the webhook with Telegram and serve it
+    :param url: public url of the server, without the path
+    :param host:
+    :param port:
+    :param path:
+    :param processes: number of worker processes, 0 to use tasks in this process
+    :param workers: updates processed at once per process
+    :param secret_token:
+    :return:
+    """
+    from aiohttp import web
+
+    if processes:
+        # the workers set up their own dispatchers, only the bot is needed here
+        dp, bot = None, importlib.import_module("fairytale_bot.bot").bot
+        pool = ProcessWorkerPool(processes, workers=workers)
+    else:
+        dp, bot = load_dispatcher()
+        pool = TaskWorkerPool(dispatcher_handler(dp, bot), workers)
+    app = create_webhook_app(pool, path, secret_token)
+
+    async def set_webhook(_):
+        await bot.set_webhook(url + path, secret_token=secret_token)
+        if dp is not None:
+            await dp.emit_startup(bot=bot)
+
+    async def delete_webhook(_):
+        if dp is not None:
+            await dp.emit_shutdown(bot=bot)
+        await bot.delete_webhook()
+        await bot.session.close()
+
+    app.on_startup.append(set_webhook)
+    app.on_shutdown.append(delete_webhook)
+    web.run_app(app, host=host, port=port)
+
+
+def main():
+    from dotenv import load_dotenv
+
+    load_dotenv()
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--url", default=os.getenv("FAIRYTALE_WEBHOOK_URL"))
+    parser.add_argument("--host", default="0.0.0.0")
+    parser.add_argument("--port", type=int, default=8080)
+    parser.add_argument("--path", default="/webhook")
+    parser.add_argument("--processes", type=int, default=0)
+    parser.add_argument("--workers", type=int, default=256)
+    args = parser.parse_args()
+    if not args.url:
+        parser.error("--url or FAIRYTALE_WEBHOOK_URL is required")
+    run_webhook(
+        args.url,
+        host=args.host,
+        port=args.port,
+        path=args.path,
+        processes=args.processes,
+        workers=args.workers,
+        secret_token=os.getenv("FAIRYTALE_WEBHOOK_SECRET"),
+    )
+
+
+if __name__ == "__main__":
+    main()
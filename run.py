@@ -1,9 +1,23 @@
 import asyncio
+import os
+
 from dotenv import load_dotenv
 
 load_dotenv()
-from fairytale_bot.bot import bot, dp
 
 
 if __name__ == "__main__":
-    asyncio.run(dp.start_polling(bot))
+    webhook_url = os.getenv("FAIRYTALE_WEBHOOK_URL")
+    if webhook_url:
+        from fairytale_bot.webhook import run_webhook
+
+        run_webhook(
+            webhook_url,
+            port=int(os.getenv("FAIRYTALE_WEBHOOK_PORT", "80")),
+            processes=int(os.getenv("FAIRYTALE_WEBHOOK_PROCESSES", "0")),
+            secret_token=os.getenv("FAIRYTALE_WEBHOOK_SECRET"),
+        )
+    else:
+        from fairytale_bot.bot import bot, dp
+
+        asyncio.run(dp.start_polling(bot))
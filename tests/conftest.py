@@ -0,0 +1,20 @@
+import pytest
+
+from fairytale_bot.batch import BatchApp
+from fairytale_bot.fake_llm import FakeGptPlugin
+
+
+@pytest.fixture
+def fake_llm():
+    return FakeGptPlugin(latency=0, tokens_per_second=10**6)
+
+
+@pytest.fixture
+def app(fake_llm):
+    """BatchApp on the fake LLM, "user" has the story settings to begin a story"""
+    app = BatchApp()
+    app.gpt = fake_llm
+    app.set_moral("honesty", "user")
+    app.set_topic("a dragon", "user")
+    app.set_author("Grimm", "user")
+    return app
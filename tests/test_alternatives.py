@@ -0,0 +1,135 @@
+import asyncio
+
+import pytest
+
+from fairytale_bot.alternatives import AlternativesCache
+from fairytale_bot.prompt_budget import count_tokens
+from fairytale_bot.quota import QuotaExceeded
+
+
+def test_alternatives_serve_spares_for_the_stage():
+    async def run():
+        cache = AlternativesCache()
+        versions = iter(["first", "second"])
+
+        async def generate():
+            return next(versions)
+
+        cache.generate("user", 2, generate, n=2)
+        assert cache.has("user", 2)
+        assert not cache.has("user", 1)
+        assert await cache.pop("user", 1) is None
+        assert {await cache.pop("user", 2), await cache.pop("user", 2)} == {
+            "first",
+            "second",
+        }
+        assert await cache.pop("user", 2) is None
+        assert not cache.has("user", 2)
+
+    asyncio.run(run())
+
+
+def test_alternatives_invalidate_cancels():
+    async def run():
+        cache = AlternativesCache()
+
+        async def generate():
+            await asyncio.sleep(10)
+            return "stale"
+
+        cache.generate("user", 0, generate, n=2)
+        cache.invalidate("user")
+        assert not cache.has("user", 0)
+        assert await cache.pop("user", 0) is None
+        assert len(cache) == 0
+
+    asyncio.run(run())
+
+
+def test_regenerate_swaps_the_last_part(app, fake_llm):
+    async def run():
+        user = "user"
+        app.set_story_structure(user, app._parse_story_structure(fake_llm.STRUCTURE))
+        await app.generate_next_story_part(user)
+        await app.generate_next_story_part(user)
+        first_part = app.stories[user][0]
+
+        calls = fake_llm.calls
+        new_part = await app.regenerate_story_part(user)
+        assert app.stories[user] == [first_part, new_part]
+        assert app.story_stages[user] == 2
+        await asyncio.sleep(0)
+        assert app.has_story_part_alternative(user)
+        # K candidates at once
+        assert fake_llm.calls - calls == app.REGENERATE_CANDIDATES
+
+        # the next regenerate is a swap without new calls
+        calls = fake_llm.calls
+        spare = await app.regenerate_story_part(user)
+        assert fake_llm.calls == calls
+        assert app.stories[user] == [first_part, spare]
+
+        # moving on drops the spares of the previous part
+        await app.generate_next_story_part(user)
+        assert not app.has_story_part_alternative(user)
+
+    asyncio.run(run())
+
+
+def test_regenerate_is_charged_unless_it_swaps_a_spare(app, fake_llm):
+    async def wait_for_spares():
+        entry = app.alternatives._entries.get("user")
+        while entry is not None and entry.tasks:
+            await asyncio.sleep(0.001)
+
+    async def run():
+        app.set_story_structure("user", app._parse_story_structure(fake_llm.STRUCTURE))
+        await app.generate_next_story_part("user")
+        app.llm_scheduler.backoff_base = 0
+        model = app.model_per_user["user"]
+
+        # the new version and the spares count when generated
+        new_part = await app.regenerate_story_part("user")
+        await wait_for_spares()
+        spares = list(app.alternatives._entries["user"].parts)
+        assert len(spares) == app.REGENERATE_CANDIDATES - 1
+        new_part = new_part.replace(app.STORY_BEGINNING, "")
+        used = app.quota.used("user")
+        assert used == sum(count_tokens(part, model) for part in [new_part, *spares])
+
+        # swapping in a spare is free, even without quota left
+        app.user_limits["user"] = 1
+        app.quota.record("user", app.max_tokens_per_user["user"])
+        used = app.quota.used("user")
+        assert (
+            await app.regenerate_story_part("user") == app.STORY_BEGINNING + spares[0]
+        )
+        assert app.quota.used("user") == used
+        assert app.quota._get("user").reserved == 0
+
+        # without a spare the quota is checked before any call
+        await app.regenerate_story_part("user")
+        calls = fake_llm.calls
+        with pytest.raises(QuotaExceeded):
+            await app.regenerate_story_part("user")
+        assert fake_llm.calls == calls
+        assert app.stories["user"] == [app.STORY_BEGINNING + spares[1]]
+
+        # no spares beyond the quota
+        app.quota.reset("user")
+        await app.regenerate_story_part("user")
+        await wait_for_spares()
+        assert not app.has_story_part_alternative("user")
+        assert app.quota._get("user").reserved == 0
+
+        # failed calls give the quota back
+        app.quota.reset("user")
+        fake_llm.error_rate = 1.0
+        with pytest.raises(Exception):
+            await app.regenerate_story_part("user")
+        await wait_for_spares()
+        assert not app.has_story_part_alternative("user")
+        assert app.quota.used("user") == 0
+        assert app.quota._get("user").reserved == 0
+
+    asyncio.run(run())
@@ -1,4 +1,8 @@
+import asyncio
+
 from fairytale_bot.lib import MainApp
+from fairytale_bot.structure_parser import STORY_DELIMITER
+from fairytale_bot.user_settings import StoryCompression
 
 
 def test_extract_story_parts():
@@ -19,3 +23,77 @@ def test_extract_story_parts():
 
     # Assert
     assert output == expected_output, f"Expected {expected_output}, but got {output}"
+
+
+def test_compress_story_part():
+    """
+    Test the _compress_story_part function keeps the first 3 sentences
+    """
+    story_part = "One. Two. Three. Four. Five."
+
+    output = MainApp._compress_story_part(story_part)
+
+    assert output == "One. Two. Three"
+
+
+def test_structure_and_first_part_in_one_call(app, fake_llm):
+    async def run():
+        app.set_moral("honesty", "other")
+        app.set_topic("a dragon", "other")
+        app.set_author("Grimm", "other")
+        part = await app.generate_next_story_part("user", generate_structure=True)
+        assert fake_llm.calls == 1
+        assert app.stories["user"] == [part]
+        assert len(app.story_structures["user"]["all_parts"]) == 9
+        assert STORY_DELIMITER not in part
+
+        # the structure is cached: the first part is generated as usual
+        await app.generate_next_story_part("other", generate_structure=True)
+        assert fake_llm.calls == 2
+        assert app.story_structures["other"] == app.story_structures["user"]
+
+    asyncio.run(run())
+
+
+def test_llm_summaries_of_the_story_parts(app, fake_llm):
+    async def run():
+        user = "user"
+        compression = StoryCompression.LLM_SUMMARY
+        app.compression_per_user[user] = compression
+        app.llm_scheduler.backoff_base = 0
+        app.stories[user] = ["One. Two. Three. Four.", "The last part."]
+
+        # the first lines until the summary is ready
+        summary = app._build_story_summary(user, compression)
+        assert summary == ["One. Two. Three...", "The last part."]
+
+        # a failed summary keeps them
+        fake_llm.error_rate = 1.0
+        await app._summarize_story_part(user, 0, app.stories[user][0])
+        assert app._build_story_summary(user, compression) == summary
+
+        fake_llm.error_rate = 0.0
+        await app._summarize_story_part(user, 0, app.stories[user][0])
+        llm_summary = app.story_summaries[user][0]
+        assert llm_summary
+        # summarized once, the prompts reuse it
+        calls = fake_llm.calls
+        for _ in range(2):
+            summary = app._build_story_summary(user, compression)
+            assert summary == [llm_summary + "...", "The last part."]
+        assert fake_llm.calls == calls
+
+        # new parts are summarized in the background
+        user = "other"
+        app.compression_per_user[user] = compression
+        app.set_moral("honesty", user)
+        app.set_topic("a dragon", user)
+        app.set_author("Grimm", user)
+        app.set_story_structure(user, app._parse_story_structure(fake_llm.STRUCTURE))
+        for _ in range(2):
+            await app.generate_next_story_part(user)
+        await asyncio.gather(*app._summary_tasks)
+        assert len(app.story_summaries[user]) == 2
+        assert all(app.story_summaries[user])
+
+    asyncio.run(run())
@@ -0,0 +1,51 @@
+import zlib
+
+from fairytale_bot.archive import StoryArchive, compress, decompress
+
+
+def make_story(topic):
+    return {
+        "topic": topic,
+        "moral": "honesty",
+        "author": "Grimm",
+        "structure": {"raw": "[exposition]\n- step 1"},
+        "stage": 2,
+        "story": ["Once upon a time. " * 50, "The end."],
+    }
+
+
+def test_compress_roundtrip():
+    data = b"once upon a time " * 100
+    blob = compress(data)
+    assert len(blob) < len(data)
+    assert decompress(blob) == data
+    # stories compressed with zlib stay readable
+    assert decompress(b"z" + zlib.compress(data)) == data
+
+
+def test_archive_lists_and_loads_stories(tmp_path):
+    archive = StoryArchive(str(tmp_path / "archive.db"))
+    for i in range(12):
+        assert archive.add("user", make_story(f"topic {i}")) == i + 1
+    archive.add("other", make_story("x" * 100))
+
+    assert archive.count("user") == 12
+    page = archive.list("user", offset=10, limit=10)
+    assert [story["index"] for story in page] == [11, 12]
+    assert page[0]["title"] == "topic 10"
+    assert page[0]["parts"] == 2
+    assert len(archive.list("other")[0]["title"]) == 60
+
+    assert archive.get("user", 3) == make_story("topic 2")
+    assert archive.get("user", 13) is None
+    stories = archive.iter_stories("user")
+    assert next(stories) == (1, make_story("topic 0"))
+    assert len(list(stories)) == 11
+    archive.close()
+
+    # persisted
+    archive = StoryArchive(str(tmp_path / "archive.db"))
+    assert archive.count("user") == 12
+    archive.delete_user("user")
+    assert archive.count("user") == 0
+    assert archive.count("other") == 1
@@ -0,0 +1,35 @@
+import asyncio
+import json
+
+from fairytale_bot.batch import BatchApp, load_done_ids, make_jobs, run_batch
+from fairytale_bot.fake_llm import FakeGptPlugin
+
+
+def test_make_jobs_is_stable():
+    jobs = make_jobs(["honesty", "kindness"], ["a dragon", "a fox"], ["Grimm"])
+    assert len(jobs) == 4
+    assert len({job["id"] for job in jobs}) == 4
+    again = make_jobs(["honesty", "kindness"], ["a dragon", "a fox"], ["Grimm"])
+    assert [job["id"] for job in jobs] == [job["id"] for job in again]
+
+
+def test_load_done_ids_skips_broken_lines(tmp_path):
+    path = tmp_path / "stories.jsonl"
+    assert load_done_ids(path) == set()
+    path.write_text(json.dumps({"id": "a"}) + "\n" + '{"id": "b", "sto')
+    assert load_done_ids(path) == {"a"}
+
+
+def test_run_batch_resumes(tmp_path):
+    app = BatchApp()
+    app.gpt = FakeGptPlugin(latency=0, tokens_per_second=10**6)
+    output = tmp_path / "stories.jsonl"
+    jobs = make_jobs(["honesty"], ["a dragon", "a fox"], ["Grimm"])
+
+    assert asyncio.run(run_batch(app, jobs[:1], output)) == 1
+    assert asyncio.run(run_batch(app, jobs, output)) == 1
+    stories = [json.loads(line) for line in output.read_text().splitlines()]
+    assert [story["id"] for story in stories] == [job["id"] for job in jobs]
+    assert all(len(story["story"]) == 9 for story in stories)
+    # the batch users don't stay around
+    assert app.story_archive.count(f"batch_{jobs[0]['id']}") == 0
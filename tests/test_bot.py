@@ -0,0 +1,22 @@
+import asyncio
+
+import fairytale_bot.bot
+from fairytale_bot.batch import BatchApp
+from fairytale_bot.plugins import LazyPlugin
+
+
+def test_importing_the_bot_module_sets_up_nothing():
+    assert "app" not in vars(fairytale_bot.bot)
+    assert "dp" not in vars(fairytale_bot.bot)
+    assert "bot" not in vars(fairytale_bot.bot)
+
+
+def test_plugin_is_created_on_first_use():
+    plugin = LazyPlugin("fairytale_bot.fake_llm:FakeGptPlugin", "gpt")
+    app = BatchApp(plugins=[plugin])
+    assert app.gpt is plugin
+    assert plugin._plugin is None
+
+    text = asyncio.run(app.complete_text("Once upon a time", app.DEFAULT_MODEL, 20))
+    assert text
+    assert type(plugin.plugin).__name__ == "FakeGptPlugin"
@@ -0,0 +1,59 @@
+import asyncio
+import time
+
+from fairytale_bot.delivery import ChatPacer, StreamedFile, split_message
+
+
+def test_split_message_short():
+    assert split_message("Once upon a time.") == ["Once upon a time."]
+    assert split_message("") == [""]
+
+
+def test_split_message_on_sentences():
+    text = " ".join(f"Sentence number {i} is here." for i in range(300))
+    pieces = split_message(text, limit=100)
+    assert all(len(piece) <= 100 for piece in pieces)
+    assert all(piece.endswith(".") for piece in pieces)
+    assert " ".join(pieces) == text
+
+
+def test_split_message_prefers_paragraphs():
+    paragraph = "A short sentence. A short sentence. A short sentence."
+    text = "\n\n".join([paragraph] * 4)
+    two_paragraphs = paragraph + "\n\n" + paragraph
+    assert split_message(text, limit=120) == [two_paragraphs, two_paragraphs]
+
+
+def test_split_message_without_spaces():
+    pieces = split_message("x" * 250, limit=100)
+    assert [len(piece) for piece in pieces] == [100, 100, 50]
+
+
+def test_streamed_file_is_read_in_chunks():
+    def chunks():
+        for i in range(100):
+            yield f"part {i}\n"
+
+    file = StreamedFile(chunks, "story.txt", chunk_size=64)
+
+    async def read():
+        return [chunk async for chunk in file.read(None)]
+
+    read_chunks = asyncio.run(read())
+    assert all(len(chunk) >= 64 for chunk in read_chunks[:-1])
+    assert b"".join(read_chunks).decode() == "".join(chunks())
+    # can be read again, e.g. when the upload is retried
+    assert b"".join(asyncio.run(read())) == b"".join(read_chunks)
+
+
+def test_chat_pacer_paces_each_chat():
+    async def run():
+        pacer = ChatPacer(chat_rate=20, burst=1)
+        start = time.monotonic()
+        await pacer.wait(1)
+        await pacer.wait(2)  # other chats don't wait
+        assert time.monotonic() - start < 0.03
+        await pacer.wait(1)
+        assert time.monotonic() - start >= 0.04
+
+    asyncio.run(run())
@@ -0,0 +1,267 @@
+import asyncio
+
+from aiogram.exceptions import TelegramBadRequest
+
+from benchmarks.fake_telegram import FakeBot, FakeMessage, FakeTransport, FakeUser
+from fairytale_bot.delivery import TELEGRAM_MESSAGE_LIMIT
+from fairytale_bot.fake_llm import FakeGptPlugin
+from fairytale_bot.lib import MainApp, MainHandler
+from fairytale_bot.prompt_budget import count_tokens
+
+
+def make_message(transport: FakeTransport, text: str, user: str = "user"):
+    return FakeMessage(transport, chat_id=1, user=FakeUser(1, user), text=text)
+
+
+def test_continue_charges_only_the_added_parts(app, fake_llm):
+    transport = FakeTransport()
+    handler = MainHandler()
+    structure = app._parse_story_structure(fake_llm.STRUCTURE)
+    app.set_story_structure("user", structure)
+
+    async def continue_story():
+        message = make_message(transport, "/continue")
+        await handler.generate_next_story_part_handler(message, app, FakeBot(transport))
+
+    async def run():
+        await continue_story()
+        used = app.quota.used("user")
+        assert used == count_tokens(app.stories["user"][0], app.DEFAULT_MODEL)
+
+        # the story is complete: nothing is added, nothing is charged
+        app.story_stages["user"] = len(structure["all_parts"])
+        await continue_story()
+        await continue_story()
+        assert app.quota.used("user") == used
+
+        # neither is a failed generation
+        app.story_stages["user"] = 1
+        fake_llm.error_rate = 1.0
+        app.llm_scheduler.backoff_base = 0
+        await continue_story()
+        assert len(app.stories["user"]) == 1
+        assert app.quota.used("user") == used
+        assert app.quota._get("user").reserved == 0
+
+    asyncio.run(run())
+
+
+class SlowBot(FakeBot):
+    async def send_chat_action(self, chat_id: int, action, **kwargs):
+        await asyncio.sleep(0.01)
+        await super().send_chat_action(chat_id, action, **kwargs)
+
+
+def test_concurrent_continues_generate_one_part(app, fake_llm):
+    transport = FakeTransport()
+    handler = MainHandler()
+    app.set_story_structure("user", app._parse_story_structure(fake_llm.STRUCTURE))
+
+    async def run():
+        await asyncio.gather(
+            *(
+                handler.generate_next_story_part_handler(
+                    make_message(transport, "/continue"), app, SlowBot(transport)
+                )
+                for _ in range(2)
+            )
+        )
+
+    asyncio.run(run())
+    assert fake_llm.calls == 1
+    assert app.story_stages["user"] == 1
+    texts = [text for _, kind, _, text in transport.sent if kind == "message"]
+    assert "Still writing the previous part, hold on..." in texts
+    assert not app.is_generating_story_part("user")
+
+
+class StrictMessage(FakeMessage):
+    """Rejects the edits that don't change the text, like Telegram"""
+
+    # the messages sent in answer, to see their final text
+    answers = None
+
+    async def answer(self, text: str, **kwargs):
+        self.transport.record("message", self.chat.id, text)
+        answer = StrictMessage(self.transport, self.chat.id, self.from_user, text)
+        self.answers.append(answer)
+        return answer
+
+    async def edit_text(self, text: str, **kwargs):
+        if text.strip() == self.text.strip():
+            raise TelegramBadRequest(
+                None,
+                "Bad Request: message is not modified: specified new "
+                "message content and reply markup are exactly the same",
+            )
+        return await super().edit_text(text, **kwargs)
+
+
+class ScriptedLLM(FakeGptPlugin):
+    """Streams the given chunks"""
+
+    def __init__(self, chunks):
+        super().__init__(latency=0)
+        self.chunks = chunks
+
+    async def stream_text(self, text: str, model: str = None, **kwargs):
+        self.calls += 1
+        for chunk in self.chunks:
+            await asyncio.sleep(0)
+            yield chunk
+
+
+def stream_story_part(app, chunks):
+    transport = FakeTransport()
+    handler = MainHandler()
+    # show every chunk
+    handler.STREAM_EDIT_INTERVAL = 0
+    app.gpt = ScriptedLLM(chunks)
+    app.chat_pacer = None
+    app.set_story_structure("user", app._parse_story_structure(FakeGptPlugin.STRUCTURE))
+    message = StrictMessage(transport, 1, FakeUser(1, "user"), "/continue")
+    message.answers = []
+    asyncio.run(
+        handler.generate_next_story_part_handler(message, app, FakeBot(transport))
+    )
+    return transport, message.answers
+
+
+def test_streaming_skips_edits_that_change_only_whitespace(app):
+    transport, _ = stream_story_part(app, ["Once upon a time.", "\n\n", "The end."])
+    part = MainApp.STORY_BEGINNING + "Once upon a time.\n\nThe end."
+    assert app.stories["user"] == [part]
+    sent = [
+        (kind, text) for _, kind, _, text in transport.sent if kind != "chat_action"
+    ]
+    assert sent[-1] == ("edit", part + MainHandler.CONTINUE_SUFFIX)
+    assert ("message", "Failed, sorry :(") not in sent
+
+
+def test_streaming_goes_on_in_the_next_message(app):
+    # one and a half messages of text
+    words = ["word"] * (TELEGRAM_MESSAGE_LIMIT * 3 // 10)
+    chunks = [" ".join(words[i : i + 100]) + " " for i in range(0, len(words), 100)]
+    _, answers = stream_story_part(app, chunks)
+    assert len(app.stories["user"]) == 1
+
+    texts = [answer.text for answer in answers]
+    assert len(texts) == 2
+    assert all(len(text) <= TELEGRAM_MESSAGE_LIMIT for text in texts)
+    assert texts[1].endswith(MainHandler.CONTINUE_SUFFIX)
+    shown = " ".join(texts).replace(MainHandler.CONTINUE_SUFFIX, "")
+    assert shown.split() == app.stories["user"][0].split()
+
+
+def test_fused_randomize_writes_the_structure_and_the_first_part(app, fake_llm):
+    app.FUSE_STRUCTURE_AND_FIRST_PART = True
+    transport = FakeTransport()
+    message = make_message(transport, "/randomize")
+
+    async def run():
+        await MainHandler().randomize_handler(message, app, FakeBot(transport))
+
+    asyncio.run(run())
+    assert fake_llm.calls == 1
+    structure = app.story_structures["user"]
+    assert (
+        structure["all_parts"]
+        == app._parse_story_structure(fake_llm.STRUCTURE)["all_parts"]
+    )
+    assert len(app.stories["user"]) == 1
+    assert app.story_stages["user"] == 1
+    texts = [text for _, kind, _, text in transport.sent if kind in ("message", "edit")]
+    assert texts[-1] == app.stories["user"][0] + MainHandler.CONTINUE_SUFFIX
+
+
+def test_randomize_checks_the_quota_first(app, fake_llm):
+    transport = FakeTransport()
+    app.set_story_structure("user", app._parse_story_structure(fake_llm.STRUCTURE))
+    app.stories["user"] = ["Once upon a time."]
+    app.user_limits["user"] = 1
+    app.quota.record("user", app.max_tokens_per_user["user"])
+
+    async def run():
+        for fused in (False, True):
+            app.FUSE_STRUCTURE_AND_FIRST_PART = fused
+            message = make_message(transport, "/randomize")
+            await MainHandler().randomize_handler(message, app, FakeBot(transport))
+
+    asyncio.run(run())
+    assert fake_llm.calls == 0
+    # the current story is kept
+    assert app.stories["user"] == ["Once upon a time."]
+    texts = [text for _, kind, _, text in transport.sent if kind == "message"]
+    assert len(texts) == 2
+    assert all(text.startswith(MainHandler.USAGE_LIMIT_MESSAGE) for text in texts)
+
+
+def test_regenerate_without_quota_swaps_only_spares(app, fake_llm):
+    transport = FakeTransport()
+    app.set_story_structure("user", app._parse_story_structure(fake_llm.STRUCTURE))
+
+    async def regenerate():
+        message = make_message(transport, "/regenerate")
+        await MainHandler().regenerate_handler(message, app, FakeBot(transport))
+
+    async def spare():
+        return "Once upon a time, again."
+
+    async def run():
+        await app.generate_next_story_part("user")
+        app.alternatives.generate("user", 0, spare, n=1)
+        app.user_limits["user"] = 1
+        app.quota.record("user", app.max_tokens_per_user["user"])
+        await regenerate()
+        await regenerate()
+
+    asyncio.run(run())
+    assert fake_llm.calls == 1
+    texts = [text for _, kind, _, text in transport.sent if kind == "message"]
+    assert len(texts) == 2
+    assert "Once upon a time, again." in texts[0]
+    assert texts[1].startswith(MainHandler.USAGE_LIMIT_MESSAGE)
+
+
+def test_randomize_charges_the_first_part(app):
+    transport = FakeTransport()
+
+    async def run():
+        message = make_message(transport, "/randomize")
+        await MainHandler().randomize_handler(message, app, FakeBot(transport))
+
+    asyncio.run(run())
+    assert app.quota.used("user") == count_tokens(
+        app.stories["user"][0], app.DEFAULT_MODEL
+    )
+    assert app.quota._get("user").reserved == 0
+
+
+class DocumentBot(FakeBot):
+    def __init__(self, transport):
+        super().__init__(transport)
+        self.documents = []
+
+    async def send_document(self, chat_id: int, document, **kwargs):
+        await super().send_document(chat_id, document, **kwargs)
+        self.documents.append(b"".join([chunk async for chunk in document.read(self)]))
+
+
+def test_archive_loads_the_story_once(app):
+    transport = FakeTransport()
+    bot = DocumentBot(transport)
+    app.chat_pacer = None
+    app.story_archive.add("user", {"topic": "a dragon", "story": ["One.", "Two."]})
+    loads = []
+    get = app.story_archive.get
+    app.story_archive.get = lambda *args: loads.append(args) or get(*args)
+
+    async def run():
+        for text in ["/archive 1", "/archive 2"]:
+            await MainHandler().archive_handler(make_message(transport, text), app, bot)
+
+    asyncio.run(run())
+    assert loads == [("user", 1), ("user", 2)]
+    assert bot.documents == [b"One.\n\nTwo.\n\n"]
+    texts = [text for _, kind, _, text in transport.sent if kind == "message"]
+    assert texts == ["There's no story 2 in your archive."]
@@ -0,0 +1,152 @@
+import asyncio
+
+import pytest
+
+from fairytale_bot.llm_router import LLMBackend, LLMRouter, NoBackendAvailable
+
+MODELS = {"gpt-3.5-turbo": "gpt-3.5-turbo"}
+
+
+class FakeBackend(LLMBackend):
+    supports_streaming = True
+
+    def __init__(self, name, latency=0.0, fail=False, provider=None):
+        super().__init__(name, MODELS, provider)
+        self.latency = latency
+        self.fail = fail
+        self.calls = 0
+        self.closed = 0
+
+    async def complete_text(self, prompt, model, max_tokens):
+        self.calls += 1
+        await asyncio.sleep(self.latency)
+        if self.fail:
+            raise RuntimeError(f"{self.name} is down")
+        return self.name
+
+    async def stream_text(self, prompt, model, max_tokens):
+        self.calls += 1
+        try:
+            await asyncio.sleep(self.latency)
+            if self.fail:
+                raise RuntimeError(f"{self.name} is down")
+            for chunk in (self.name, " ", "story"):
+                yield chunk
+        finally:
+            self.closed += 1
+
+
+def complete(router):
+    return router.complete_text("prompt", model="gpt-3.5-turbo", max_tokens=10)
+
+
+def test_router_prefers_fastest_backend():
+    async def run():
+        slow, fast = FakeBackend("slow", 0.02), FakeBackend("fast", 0.001)
+        router = LLMRouter([slow, fast], hedge=False)
+        # no stats yet - both get tried
+        await complete(router)
+        router.stats["fast"].record_success(0.001)
+        assert [backend.name for backend in router.candidates("gpt-3.5-turbo")] == [
+            "fast",
+            "slow",
+        ]
+        assert await complete(router) == "fast"
+
+    asyncio.run(run())
+
+
+def test_router_fails_over():
+    async def run():
+        down, up = FakeBackend("down", fail=True), FakeBackend("up")
+        router = LLMRouter([down, up], hedge=False)
+        assert await complete(router) == "up"
+        assert router.stats["down"].error_rate == 1.0
+
+    asyncio.run(run())
+
+
+def test_router_hedges_slow_requests():
+    async def run():
+        first, second = FakeBackend("first", 0.001), FakeBackend("second", 0.001)
+        router = LLMRouter([first, second], hedge=True, hedge_min_samples=5)
+        for _ in range(5):
+            router.stats["first"].record_success(0.001)
+        router.stats["second"].record_success(0.002)
+        first.latency = 1.0  # suddenly slow
+        assert await complete(router) == "second"
+        assert first.calls == 1
+
+    asyncio.run(run())
+
+
+def test_router_stays_off_the_same_provider():
+    async def run():
+        down = FakeBackend("down", fail=True, provider="openai")
+        same = FakeBackend("same", provider="openai")
+        other = FakeBackend("other", 0.01)
+        router = LLMRouter([down, same, other], hedge=True, hedge_min_samples=1)
+        assert await complete(router) == "other"
+        assert same.calls == 0
+
+        # nor hedged to it
+        router = LLMRouter([same, down], hedge=True, hedge_min_samples=1)
+        router.stats["same"].record_success(0.001)
+        router.stats["down"].record_success(0.002)
+        same.latency = 0.05
+        calls = down.calls
+        assert await complete(router) == "same"
+        assert down.calls == calls
+
+    asyncio.run(run())
+
+
+def test_router_circuit_breaker():
+    async def run():
+        down = FakeBackend("down", fail=True)
+        router = LLMRouter([down], hedge=False, failure_threshold=2, cooldown=60)
+        for _ in range(2):
+            with pytest.raises(RuntimeError):
+                await complete(router)
+        assert router.stats["down"].is_open
+        with pytest.raises(NoBackendAvailable):
+            await complete(router)
+        assert down.calls == 2
+        assert "circuit open" in router.summary()
+
+    asyncio.run(run())
+
+
+def test_router_circuit_closes_after_successful_trial():
+    async def run():
+        backend = FakeBackend("flaky", fail=True)
+        router = LLMRouter([backend], hedge=False, failure_threshold=1, cooldown=0)
+        with pytest.raises(RuntimeError):
+            await complete(router)
+        assert router.stats["flaky"].is_open
+        backend.fail = False
+        assert await complete(router) == "flaky"
+        assert not router.stats["flaky"].is_open
+
+    asyncio.run(run())
+
+
+def test_router_stream_fails_over_before_first_chunk():
+    async def run():
+        down, up = FakeBackend("down", fail=True), FakeBackend("up")
+        router = LLMRouter([down, up], hedge=False)
+        stream = await router.stream_text(
+            "prompt", model="gpt-3.5-turbo", max_tokens=10
+        )
+        assert "".join([chunk async for chunk in stream]) == "up story"
+        assert down.closed == 1
+
+    asyncio.run(run())
+
+
+def test_app_uses_a_fake_gpt_alone(app, monkeypatch):
+    # as if OpenAI and a local model were configured
+    app.__dict__["_openai_client"] = object()
+    monkeypatch.setenv("FAIRYTALE_LOCAL_LLM", "1")
+    assert [backend.name for backend in app.llm_router.backends] == ["gpt"]
+    assert not app.llm_router.hedge
@@ -0,0 +1,15 @@
+from fairytale_bot.metrics import MetricsRegistry
+
+
+def test_metrics_render():
+    metrics = MetricsRegistry()
+    metrics.llm_duration.observe(0.3, model="gpt-4", handler="randomize_handler")
+    metrics.llm_duration.observe(3, model="gpt-4", handler="randomize_handler")
+    metrics.record_cache("structure", hit=True)
+
+    text = metrics.render()
+
+    labels = 'handler="randomize_handler",model="gpt-4"'
+    assert f'fairytale_llm_duration_seconds_bucket{{{labels},le="0.5"}} 1' in text
+    assert f"fairytale_llm_duration_seconds_count{{{labels}}} 2" in text
+    assert 'fairytale_cache_requests_total{cache="structure",result="hit"} 1' in text
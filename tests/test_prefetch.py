@@ -0,0 +1,35 @@
+import asyncio
+
+from fairytale_bot.prefetch import PrefetchScheduler
+
+
+def test_prefetch_serves_result_once():
+    async def run():
+        scheduler = PrefetchScheduler()
+
+        async def generate():
+            return "part 2"
+
+        assert scheduler.schedule("user", 1, generate)
+        assert not scheduler.schedule("user", 1, generate)
+        assert await scheduler.pop("user", 0) is None
+        assert await scheduler.pop("user", 1) == "part 2"
+        assert await scheduler.pop("user", 1) is None
+
+    asyncio.run(run())
+
+
+def test_prefetch_invalidate_cancels():
+    async def run():
+        scheduler = PrefetchScheduler()
+
+        async def generate():
+            await asyncio.sleep(10)
+            return "stale"
+
+        scheduler.schedule("user", 1, generate)
+        scheduler.invalidate("user")
+        assert await scheduler.pop("user", 1) is None
+        assert scheduler.pending == 0
+
+    asyncio.run(run())
@@ -0,0 +1,20 @@
+from fairytale_bot.prompt_budget import PromptBudget
+
+
+def test_fit_parts_compresses_then_drops_oldest():
+    budget = PromptBudget("gpt-3.5-turbo", max_completion_tokens=200)
+    parts = ["a" * 400, "b" * 400, "c" * 400]
+    compressed = ["a" * 40 + "...", "b" * 40 + "...", "c" * 400]
+    available = budget.count("".join(parts))
+
+    assert budget.fit_parts(parts, compressed, available) == parts
+
+    available = budget.count(compressed[0] + parts[1] + parts[2])
+    assert budget.fit_parts(parts, compressed, available) == [
+        compressed[0],
+        parts[1],
+        parts[2],
+    ]
+
+    available = budget.count(parts[2])
+    assert budget.fit_parts(parts, compressed, available) == [parts[2]]
@@ -0,0 +1,51 @@
+import asyncio
+
+from fairytale_bot.prompt_cache import ChatPrompt, PrefixCache, to_messages
+
+
+def test_chat_prompt_is_the_prefix_and_the_suffix():
+    prompt = ChatPrompt(["instructions\n", "part 1\n"], "part 2\nstage")
+    assert prompt == "instructions\npart 1\npart 2\nstage"
+    assert prompt.prefix == "instructions\npart 1\n"
+    assert to_messages(prompt) == [
+        {"role": "system", "content": "instructions\npart 1\n"},
+        {"role": "user", "content": "part 2\nstage"},
+    ]
+    assert to_messages("plain") == [{"role": "user", "content": "plain"}]
+
+
+def test_prefix_cache_matches_the_longest_prefix():
+    cache = PrefixCache()
+    first = ChatPrompt(["instructions\n", "part 1\n"], "part 2\nstage 3")
+    assert cache.match("gpt-4", first) == ""
+    cache.add("gpt-4", first)
+    second = ChatPrompt(["instructions\n", "part 1\n", "part 2\n"], "part 3\nstage 4")
+    assert cache.match("gpt-4", second) == "instructions\npart 1\n"
+    assert cache.match("gpt-3.5-turbo", second) == ""
+    other_story = ChatPrompt(["instructions\n", "other part\n"], "stage 2")
+    assert cache.match("gpt-4", other_story) == "instructions\n"
+
+
+def test_story_prompts_keep_the_prefix_stable(app, fake_llm):
+    async def run():
+        user = "user"
+        structure = app._parse_story_structure(fake_llm.STRUCTURE)
+        app.set_story_structure(user, structure)
+        prompts = []
+        for stage in range(3):
+            prompts.append(app._build_story_prompt(user, stage))
+            await app.generate_next_story_part(user)
+
+        # the same text as the single template
+        story = "\n".join(app._build_story_summary(user, n_parts=2))
+        assert prompts[2] == app.story_generation_template.format(
+            structure=structure["raw"], story=story, stage=structure["all_parts"][2]
+        )
+        # each prompt extends the prefix of the previous one
+        assert prompts[2].prefix.startswith(prompts[1].prefix)
+        assert len(prompts[2].prefix) > len(prompts[1].prefix)
+        labels = app.metrics.prompt_prefix_ratio.sums
+        assert sum(labels.values()) > 0
+        assert sum(app.metrics.cached_prompt_tokens.values.values()) > 0
+
+    asyncio.run(run())
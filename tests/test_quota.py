@@ -0,0 +1,130 @@
+import asyncio
+from datetime import datetime, timezone
+
+import pytest
+
+from fairytale_bot.prompt_budget import count_tokens
+from fairytale_bot.quota import (
+    CalendarWindow,
+    QuotaEngine,
+    QuotaExceeded,
+    SlidingWindow,
+)
+from fairytale_bot.session import SessionField, SessionStore, Tier
+from fairytale_bot.storage import InMemoryStore, SqliteStore
+
+
+class Clock:
+    def __init__(self, now: float = 0.0):
+        self.now = now
+
+    def __call__(self) -> float:
+        return self.now
+
+
+def make_sessions(store=None):
+    sessions = SessionStore(store or InMemoryStore())
+    sessions.add_tier(Tier("default", 200, None, "gpt-3.5-turbo", 10))
+    return sessions
+
+
+def test_sliding_window_expires_old_usage():
+    clock = Clock()
+    quota = QuotaEngine(make_sessions(), SlidingWindow(100, buckets=10), clock=clock)
+    quota.record("user", 60)
+    clock.now = 50
+    quota.record("user", 30)
+    assert quota.used("user") == 90
+
+    with pytest.raises(QuotaExceeded) as e:
+        quota.reserve("user", 20, limit=100)
+    # the first 60 leave the window after 100s
+    assert e.value.retry_after == pytest.approx(50)
+
+    clock.now = 105
+    assert quota.used("user") == 30
+    quota.reserve("user", 20, limit=100).commit()
+    assert quota.used("user") == 50
+
+
+def test_calendar_window_resets_each_month():
+    window = CalendarWindow("month")
+    end_of_january = datetime(2024, 1, 31, 23, tzinfo=timezone.utc).timestamp()
+    bucket = window.bucket(end_of_january)
+    assert window.expires_at(bucket) == end_of_january + 3600
+    december = window.bucket(datetime(2023, 12, 5, tzinfo=timezone.utc).timestamp())
+    assert (
+        window.expires_at(december)
+        == datetime(2024, 1, 1, tzinfo=timezone.utc).timestamp()
+    )
+
+    clock = Clock(end_of_january)
+    quota = QuotaEngine(make_sessions(), window, clock=clock)
+    quota.record("user", 100)
+    clock.now += 3600
+    assert quota.used("user") == 0
+
+    monday = datetime(2024, 1, 8, 12, tzinfo=timezone.utc).timestamp()
+    week = CalendarWindow("week")
+    assert week.bucket(monday) == week.bucket(monday + 6 * 24 * 3600)
+    assert week.expires_at(week.bucket(monday)) == monday + 6.5 * 24 * 3600
+
+
+def test_reservations_hold_the_quota():
+    quota = QuotaEngine(make_sessions(), CalendarWindow("day"))
+    first = quota.reserve("user", 60, limit=100)
+    with pytest.raises(QuotaExceeded) as e:
+        quota.reserve("user", 60, limit=100)
+    # nothing is used yet, only reserved
+    assert e.value.retry_after is None
+
+    first.release()
+    with quota.reserve("user", 60, limit=100) as second:
+        second.commit(25)
+    assert quota.used("user") == 25
+    # leaving the block without committing gives the quota back
+    with quota.reserve("user", 75, limit=100):
+        pass
+    quota.reserve("user", 75, limit=100)
+
+
+def test_counters_are_flushed_in_batches(tmp_path):
+    path = str(tmp_path / "state.db")
+    sessions = make_sessions(SqliteStore(path))
+    usage = SessionField(sessions, "usage")
+
+    async def run():
+        quota = QuotaEngine(sessions, CalendarWindow("day"), flush_interval=0.01)
+        quota.record("user", 10)
+        quota.record("user", 5)
+        # not written on the request path
+        assert "user" not in usage
+        await asyncio.sleep(0.05)
+        assert sum(amount for _, amount in usage["user"]) == 15
+
+    asyncio.run(run())
+    sessions.store.close()
+
+    quota = QuotaEngine(make_sessions(SqliteStore(path)), CalendarWindow("day"))
+    assert quota.used("user") == 15
+    quota.sessions.store.close()
+
+
+def test_app_counts_tokens_of_the_delivered_parts(app):
+    app.user_limits["user"] = 2
+    part = "Once upon a time there was a dragon."
+    app.stories["user"] = [part]
+    app.story_stages["user"] = 1
+
+    app.commit_usage(app.reserve_usage("user"), "user", 0)
+    tokens = count_tokens(part, app.model_per_user["user"])
+    assert app.quota.used("user") == tokens
+    # a failed generation doesn't count
+    with app.reserve_usage("user"):
+        pass
+    assert app.quota.used("user") == tokens
+
+    app.quota.record("user", app.max_tokens_per_user["user"])
+    assert app.get_user_usage("user") == round(1 + tokens / 200, 1)
+    with pytest.raises(QuotaExceeded):
+        app.reserve_usage("user")
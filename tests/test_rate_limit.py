@@ -0,0 +1,45 @@
+import asyncio
+
+import pytest
+
+from fairytale_bot.rate_limit import MODEL_RATE_LIMITS, LLMScheduler, RateLimitExceeded
+
+
+def test_user_rate_limit():
+    scheduler = LLMScheduler()
+    for _ in range(3):
+        scheduler.check_user("user", requests_per_minute=3)
+    with pytest.raises(RateLimitExceeded) as error:
+        scheduler.check_user("user", requests_per_minute=3)
+    assert 0 < error.value.retry_after <= 20
+    scheduler.check_user("other_user", requests_per_minute=3)
+
+
+def test_model_limits_are_split_between_processes():
+    requests, tokens = LLMScheduler(model_limit_share=0.25)._get_model_buckets("gpt-4")
+    rpm, tpm = MODEL_RATE_LIMITS["gpt-4"]
+    assert requests.capacity == rpm / 4
+    assert tokens.capacity == tpm / 4
+    assert tokens.rate == tpm / 4 / 60
+
+
+def test_retries_rate_limit_errors():
+    class RateLimitError(Exception):
+        status_code = 429
+
+    attempts = []
+
+    async def call():
+        attempts.append(1)
+        if len(attempts) < 3:
+            raise RateLimitError()
+        return "ok"
+
+    async def run():
+        scheduler = LLMScheduler(backoff_base=0.001)
+        result = await scheduler.submit(call, model="gpt-4", tokens=100)
+        await scheduler.close()
+        return result
+
+    assert asyncio.run(run()) == "ok"
+    assert len(attempts) == 3
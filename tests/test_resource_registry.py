@@ -0,0 +1,69 @@
+import os
+import random
+from collections import Counter
+
+from fairytale_bot.resource_registry import ResourcePool, ResourceRegistry
+
+
+def test_weights_are_parsed():
+    pool = ResourcePool.from_text("Grimm | 3\nAndersen\n\nA | B | 2\nC | D\n")
+    assert pool.entries == ["Grimm", "Andersen", "A | B", "C | D"]
+    assert pool.weights == [3.0, 1.0, 2.0, 1.0]
+
+
+def test_weighted_sampling():
+    pool = ResourcePool(["a", "b", "c"], [1, 0, 3])
+    rng = random.Random(0)
+    counts = Counter(pool.entries[pool.sample_index(rng)] for _ in range(4000))
+    assert counts["b"] == 0
+    assert 2.5 < counts["c"] / counts["a"] < 3.5
+
+
+def test_registry_is_lazy_and_reloads(tmp_path):
+    (tmp_path / "morals.txt").write_text("honesty\nbravery\n")
+    (tmp_path / "extra.txt").write_text("kindness\n")
+    registry = ResourceRegistry(tmp_path, reload_interval=0)
+    registry.register_combined("all", ["morals", "extra"])
+    assert registry._pools == {}
+
+    assert registry.entries("all") == ["honesty", "bravery", "kindness"]
+    combined = registry.get("all")
+    assert registry.get("all") is combined
+
+    path = tmp_path / "extra.txt"
+    path.write_text("kindness\npatience\n")
+    os.utime(path, (0, path.stat().st_mtime + 10))
+    assert registry.entries("all") == ["honesty", "bravery", "kindness", "patience"]
+
+
+def test_no_repeats_of_last_picks(tmp_path):
+    (tmp_path / "plots.txt").write_text("\n".join(map(str, range(10))))
+    registry = ResourceRegistry(tmp_path)
+    rng = random.Random(0)
+    picks = [
+        registry.sample("plots", "user", avoid_last=5, rng=rng) for _ in range(200)
+    ]
+    for i in range(len(picks) - 5):
+        assert len(set(picks[i : i + 6])) == 6
+    # other users are independent and the pool can be smaller than K
+    assert registry.sample("plots", "other", avoid_last=20, rng=rng) in map(
+        str, range(10)
+    )
+
+
+def test_no_repeats_after_the_pool_grows(tmp_path):
+    path = tmp_path / "plots.txt"
+    path.write_text("a\nb\n")
+    registry = ResourceRegistry(tmp_path, reload_interval=0)
+    rng = random.Random(27)
+    # smaller than K - the picks repeat
+    for _ in range(10):
+        registry.sample("plots", "user", avoid_last=3, rng=rng)
+
+    path.write_text("\n".join("abcdefgh"))
+    os.utime(path, (0, path.stat().st_mtime + 10))
+    picks = [
+        registry.sample("plots", "user", avoid_last=3, rng=rng) for _ in range(200)
+    ]
+    for i in range(len(picks) - 3):
+        assert len(set(picks[i : i + 4])) == 4
@@ -0,0 +1,87 @@
+import asyncio
+
+from fairytale_bot.response_cache import ResponseCache, ResponseCacheMode
+
+PROMPT = (
+    "Write the next part of the fairytale about a brave fox who learns that "
+    "honesty is the best policy. The story so far: once upon a time a fox "
+    "lived in a deep dark forest and never told the truth to anyone."
+)
+
+
+def test_exact_match():
+    cache = ResponseCache()
+    cache.put(PROMPT, "gpt-3.5-turbo", 200, "The fox went out.")
+    assert cache.get(PROMPT, "gpt-3.5-turbo", 200) == "The fox went out."
+    # the model and max tokens are part of the key
+    assert cache.get(PROMPT, "gpt-4", 200) is None
+    assert cache.get(PROMPT, "gpt-3.5-turbo", 1000) is None
+    assert cache.get(PROMPT + "!", "gpt-3.5-turbo", 200) is None
+    assert cache.get(PROMPT, "gpt-3.5-turbo", 200, ResponseCacheMode.OFF) is None
+    assert cache.hits == 1
+    assert cache.saved_tokens > 0 and cache.saved_cost > 0
+
+
+def test_similar_match():
+    cache = ResponseCache(similarity_threshold=0.9)
+    cache.put(PROMPT, "gpt-3.5-turbo", 200, "The fox went out.")
+    near_duplicate = PROMPT.replace("anyone", "anybody")
+    assert cache.get(near_duplicate, "gpt-3.5-turbo", 200) is None
+    assert (
+        cache.get(near_duplicate, "gpt-3.5-turbo", 200, ResponseCacheMode.SIMILAR)
+        == "The fox went out."
+    )
+    assert cache.similar_hits == 1
+    unrelated = "Summarize the following story part in one sentence: a dragon."
+    assert cache.get(unrelated, "gpt-3.5-turbo", 200, ResponseCacheMode.SIMILAR) is None
+
+
+def test_similar_needs_the_index():
+    cache = ResponseCache(index_similar=False)
+    cache.put(PROMPT, "gpt-3.5-turbo", 200, "The fox went out.")
+    near_duplicate = PROMPT.replace("anyone", "anybody")
+    mode = ResponseCacheMode.SIMILAR
+    assert cache.get(near_duplicate, "gpt-3.5-turbo", 200, mode) is None
+    assert cache.get(PROMPT, "gpt-3.5-turbo", 200, mode) == "The fox went out."
+
+
+def test_eviction():
+    cache = ResponseCache(max_size=2)
+    for i in range(3):
+        cache.put(f"{PROMPT} {i}", "gpt-3.5-turbo", 200, str(i))
+    assert len(cache) == 2
+    assert cache.evictions == 1
+    assert cache.get(f"{PROMPT} 0", "gpt-3.5-turbo", 200) is None
+    assert cache.get(f"{PROMPT} 2", "gpt-3.5-turbo", 200) == "2"
+    assert not cache._index or all(
+        key in cache._entries for keys in cache._index.values() for key in keys
+    )
+
+
+def test_ttl():
+    cache = ResponseCache(ttl=0)
+    cache.put(PROMPT, "gpt-3.5-turbo", 200, "stale")
+    assert cache.get(PROMPT, "gpt-3.5-turbo", 200) is None
+    assert len(cache) == 0
+
+
+def test_tiers_opt_in_to_the_response_cache(app, fake_llm):
+    structure = app._parse_story_structure(fake_llm.STRUCTURE)
+
+    async def begin_story(user):
+        app.set_moral("honesty", user)
+        app.set_topic("a dragon", user)
+        app.set_author("Grimm", user)
+        app.set_story_structure(user, structure)
+        calls = fake_llm.calls
+        await app.generate_next_story_part(user)
+        return fake_llm.calls - calls
+
+    async def run():
+        # a new story for the same prompt by default
+        assert [await begin_story("user"), await begin_story("other")] == [1, 1]
+        app.DEFAULT_RESPONSE_CACHE = ResponseCacheMode.EXACT
+        assert [await begin_story("third"), await begin_story("fourth")] == [1, 0]
+        assert app.stories["fourth"] == app.stories["third"]
+
+    asyncio.run(run())
@@ -0,0 +1,118 @@
+from fairytale_bot.session import SessionField, SessionStore, Tier
+from fairytale_bot.storage import InMemoryStore, SqliteStore
+
+
+def make_sessions(store=None, **kwargs):
+    sessions = SessionStore(store or InMemoryStore(), **kwargs)
+    sessions.add_tier(Tier("default", 200, None, "gpt-3.5-turbo", 10), default=True)
+    sessions.add_tier(Tier("premium", 1000, None, "gpt-4", 100))
+    return sessions
+
+
+def test_reads_dont_create_sessions():
+    sessions = make_sessions()
+    stages = SessionField(sessions, "stage", default_factory=int)
+    models = SessionField(sessions, "model", tier_default=True)
+
+    assert stages["user"] == 0
+    assert models["user"] == "gpt-3.5-turbo"
+    assert "user" not in stages
+    assert len(sessions) == 0
+    stages["user"] += 1
+    assert stages["user"] == 1
+    assert len(sessions) == 1
+    assert stages.pop("user") == 1
+    assert stages.pop("user", None) is None
+
+
+def test_tier_defaults_are_shared():
+    sessions = make_sessions()
+    models = SessionField(sessions, "model", tier_default=True)
+    models["user"] = "gpt-4o"
+    session = sessions.get("user")
+    session.set_tier("premium")
+    assert models["user"] == "gpt-4"
+    # the tier object holds the settings, not the session
+    sessions.tiers["premium"].model = "gpt-4-turbo"
+    assert models["user"] == "gpt-4-turbo"
+
+
+def test_pop_story_clears_the_story_only():
+    sessions = make_sessions()
+    session = sessions.get_or_create("user")
+    session.tier = "premium"
+    session.moral = "be kind"
+    session.story = ["part 1"]
+    story = session.pop_story()
+    assert story["moral"] == "be kind"
+    assert story["story"] == ["part 1"]
+    assert story["topic"] is None
+    assert session.to_dict() == {"tier": "premium"}
+
+
+def test_idle_sessions_are_evicted():
+    evicted = []
+    sessions = make_sessions(idle_ttl=0, on_evict=lambda *args: evicted.append(args))
+    stories = SessionField(sessions, "story", default_factory=list)
+    stories["user_1"] = ["part 1"]
+    stories["user_2"] = ["part 1"]
+    assert [user for user, _ in evicted] == ["user_1"]
+    assert "user_1" not in stories
+
+
+def test_eviction_keeps_the_plan_without_a_persistent_store():
+    sessions = make_sessions(idle_ttl=0)
+    stories = SessionField(sessions, "story", default_factory=list)
+    tiers = SessionField(sessions, "tier")
+    limits = SessionField(sessions, "user_limit", tier_default=True)
+    tiers["user_1"] = "premium"
+    limits["user_1"] = 5000
+    stories["user_1"] = ["part 1"]
+    stories["user_2"] = ["part 1"]
+    stories["user_3"] = ["part 1"]
+    # only the sessions with a plan are kept
+    assert sessions.users() == {"user_1", "user_3"}
+    assert len(sessions) == 1
+    assert "user_1" not in stories
+    assert tiers["user_1"] == "premium"
+    assert limits["user_1"] == 5000
+
+
+def test_idle_sessions_are_bounded():
+    sessions = make_sessions(idle_ttl=0, max_idle=2)
+    tiers = SessionField(sessions, "tier")
+    for i in range(5):
+        tiers[f"user_{i}"] = "premium"
+    # the last one is in use, the two before it are idle
+    assert sessions.users() == {"user_2", "user_3", "user_4"}
+    assert "user_0" not in tiers
+
+
+def test_sessions_persist_and_reload_after_eviction(tmp_path):
+    path = str(tmp_path / "state.db")
+    store = SqliteStore(path)
+    sessions = make_sessions(store, idle_ttl=0)
+    morals = SessionField(sessions, "moral")
+    stories = SessionField(sessions, "story", default_factory=list)
+    morals["user"] = "be kind"
+    stories["user"] = ["part 1"]
+    stories["other"] = ["part 1"]  # evicts the first user
+    assert len(sessions) == 1
+    assert morals["user"] == "be kind"
+    store.close()
+
+    sessions = make_sessions(SqliteStore(path))
+    assert SessionField(sessions, "story")["user"] == ["part 1"]
+    sessions.store.close()
+
+
+def test_topic_and_moral_are_separate(app):
+    app.set_moral("be kind", "user")
+    app.set_topic("a dragon", "user")
+    assert app.get_moral("user") == "be kind"
+    assert app.get_topic("user") == "a dragon"
+    app.set_premium("user")
+    assert app.model_per_user["user"] == app.PREMIUM_MODEL
+    app.reset("user")
+    assert app.get_topic("user") is None
+    assert app.is_premium("user")
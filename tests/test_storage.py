@@ -0,0 +1,27 @@
+from fairytale_bot.storage import InMemoryStore, SqliteStore
+
+
+def test_stored_dict_defaults():
+    stages = InMemoryStore().mapping("story_stages", default_factory=int)
+
+    assert stages["user"] == 0
+    assert "user" not in stages
+    assert stages.get("user") is None
+    stages["user"] += 1
+    assert stages["user"] == 1
+    assert stages.pop("user") == 1
+    assert stages.pop("user", None) is None
+
+
+def test_sqlite_store_survives_restart(tmp_path):
+    path = str(tmp_path / "state.db")
+    store = SqliteStore(path)
+    store.mapping("stories")["user"] = ["part 1", "part 2"]
+    store.mapping("morals")["user"] = "be kind"
+    del store.mapping("morals")["user"]
+    store.close()
+
+    store = SqliteStore(path)
+    assert store.mapping("stories")["user"] == ["part 1", "part 2"]
+    assert "user" not in store.mapping("morals")
+    store.close()
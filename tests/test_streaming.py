@@ -0,0 +1,63 @@
+import asyncio
+from types import SimpleNamespace
+
+from fairytale_bot.lib import MainHandler
+
+
+class StubSentMessage:
+    def __init__(self, text):
+        self.texts = [text]
+
+    async def edit_text(self, text):
+        self.texts.append(text)
+        return self
+
+
+class StubMessage:
+    def __init__(self):
+        self.chat = SimpleNamespace(id=1)
+        self.sent = []
+
+    async def answer(self, text):
+        sent_message = StubSentMessage(text)
+        self.sent.append(sent_message)
+        return sent_message
+
+
+class StubApp:
+    chat_pacer = None
+
+    def __init__(self, chunks):
+        self.chunks = chunks
+
+    async def stream_next_story_part(self, user, **kwargs):
+        for chunk in self.chunks:
+            yield chunk
+
+
+def stream(handler, chunks):
+    message = StubMessage()
+    asyncio.run(handler._stream_story_part(message, StubApp(chunks), "user"))
+    return message.sent
+
+
+def test_stream_edits_the_message_as_the_text_arrives():
+    handler = MainHandler()
+    handler.STREAM_EDIT_INTERVAL = 0
+    sent = stream(handler, ["Once", " upon", " a time."])
+    assert len(sent) == 1
+    assert sent[0].texts == [
+        "Once",
+        "Once upon",
+        "Once upon a time.",
+        "Once upon a time." + handler.CONTINUE_SUFFIX,
+    ]
+
+
+def test_stream_throttles_the_edits():
+    handler = MainHandler()
+    handler.STREAM_EDIT_INTERVAL = 60
+    sent = stream(handler, ["Once", " upon", " a time."])
+    # the first text is sent at once, the rest only with the final edit
+    assert len(sent) == 1
+    assert sent[0].texts == ["Once", "Once upon a time." + handler.CONTINUE_SUFFIX]
@@ -0,0 +1,26 @@
+from fairytale_bot.structure_cache import StructureCache
+
+
+def test_structure_cache_variants_and_disk(tmp_path):
+    cache = StructureCache(variants=2, cache_dir=tmp_path)
+    key = cache.make_key("Topic:  Dragons\n", "gpt-4")
+    assert key == cache.make_key("topic: dragons", "gpt-4")
+    assert key != cache.make_key("topic: dragons", "gpt-3.5-turbo")
+
+    assert cache.get(key) is None
+    cache.put(key, {"all_parts": ["- a"]})
+    assert cache.get(key) is None  # not enough variants yet
+    cache.put(key, {"all_parts": ["- b"]})
+    assert cache.get(key) in ({"all_parts": ["- a"]}, {"all_parts": ["- b"]})
+    assert cache.stats["hits"] == 1
+    assert cache.stats["misses"] == 2
+
+    # a new process picks up the cached structures from disk
+    assert StructureCache(variants=2, cache_dir=tmp_path).get(key) is not None
+
+
+def test_structure_cache_ttl():
+    cache = StructureCache(ttl=0)
+    key = cache.make_key("prompt", "gpt-4")
+    cache.put(key, {"all_parts": ["- a"]})
+    assert cache.get(key) is None
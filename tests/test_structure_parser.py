@@ -0,0 +1,109 @@
+import random
+from pathlib import Path
+
+import pytest
+
+from fairytale_bot.structure_parser import (
+    STORY_DELIMITER,
+    STORY_SECTIONS,
+    FusedStoryParser,
+    StructureParser,
+    parse_story_structure,
+)
+
+CORPUS = sorted((Path(__file__).parent / "data" / "structures").glob("*.txt"))
+
+
+def read(path: Path) -> str:
+    return path.read_bytes().decode()
+
+
+@pytest.mark.parametrize("path", CORPUS, ids=lambda path: path.stem)
+def test_parse_corpus(path):
+    structure = parse_story_structure(read(path))
+    sections = [structure[section] for section in STORY_SECTIONS]
+    if path.stem.endswith("no_headers"):
+        assert sections == [[], [], []]
+        assert len(structure["all_parts"]) == 6
+    else:
+        assert all(sections)
+        assert sum(sections, []) == structure["all_parts"]
+        assert len(structure["all_parts"]) in (9, 10)
+    assert all(part.startswith("- ") for part in structure["all_parts"])
+    assert all(part == part.strip() for part in structure["all_parts"])
+
+
+def test_header_words_inside_items_are_not_headers():
+    text = read(CORPUS[-1])
+    structure = parse_story_structure(text)
+    assert len(structure["exposition"]) == 3
+    assert structure["climax"][0].startswith("- The climactic concert")
+
+
+def test_dash_bullets_need_no_space():
+    text = "[Exposition]\n-First step\n- Second step\n---\n[Climax]\n-Third step\n"
+    structure = parse_story_structure(text)
+    assert structure["exposition"] == ["- First step", "- Second step"]
+    assert structure["climax"] == ["- Third step"]
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_streaming_matches_one_shot(seed):
+    rng = random.Random(seed)
+    text = read(rng.choice(CORPUS))
+    parser = StructureParser()
+    streamed = []
+    position = 0
+    while position < len(text):
+        size = rng.randint(1, 20)
+        streamed += parser.feed(text[position : position + size])
+        position += size
+    streamed += parser.close()
+    assert parser.result() == parse_story_structure(text)
+    assert streamed == parser.all_parts
+    assert parser.raw == text
+
+
+def test_parts_are_returned_when_their_line_ends():
+    parser = StructureParser()
+    assert parser.feed("[exposition]\n- The hero") == []
+    assert parser.feed(" sets out\n- The") == ["- The hero sets out"]
+    assert parser.close() == ["- The"]
+    assert parser.sections["exposition"] == ["- The hero sets out", "- The"]
+
+
+@pytest.mark.parametrize("seed", range(20))
+def test_garbage_does_not_crash(seed):
+    rng = random.Random(seed)
+    alphabet = "[]()#*-•:.\n \r1IXexpositionclimaxresolution"
+    text = "".join(rng.choice(alphabet) for _ in range(500))
+    structure = parse_story_structure(text)
+    assert len(structure["all_parts"]) >= sum(
+        len(structure[section]) for section in STORY_SECTIONS
+    )
+
+
+@pytest.mark.parametrize("chunk_size", [1, 3, 7, 1000])
+def test_fused_output_is_split_while_streaming(chunk_size):
+    structure = read(CORPUS[0])
+    story = "Once upon a time.\nThe end."
+    text = structure.rstrip("\n") + "\n=== STORY ===\n" + story
+    parser = FusedStoryParser()
+    story_chunks = []
+    for i in range(0, len(text), chunk_size):
+        story_chunks.append(parser.feed(text[i : i + chunk_size]))
+        # the structure is complete as soon as the story begins
+        if parser.in_story:
+            assert parser.structure.all_parts == (
+                parse_story_structure(structure)["all_parts"]
+            )
+    parser.close()
+    assert "".join(story_chunks) == story
+
+
+def test_fused_output_without_the_story():
+    parser = FusedStoryParser()
+    assert parser.feed("[exposition]\n- step 1\n" + STORY_DELIMITER) == ""
+    parser.close()
+    assert parser.in_story
+    assert parser.structure.all_parts == ["- step 1"]
@@ -0,0 +1,82 @@
+import asyncio
+
+from benchmarks.fake_telegram import FakeBot, FakeMessage, FakeTransport, FakeUser
+from fairytale_bot.lib import MainHandler
+from fairytale_bot.structure_pool import StructurePool
+
+
+async def wait_refills(*pools):
+    while any(pool.refilling for pool in pools):
+        await asyncio.sleep(0.001)
+
+
+def test_pool_refills_below_the_low_water_mark():
+    made = []
+
+    async def make_bundle():
+        made.append(len(made))
+        return {"id": made[-1]}
+
+    async def run():
+        pool = StructurePool(make_bundle, size=4, low_water=2)
+        # nothing is made until asked
+        assert pool.pop() is None
+        await wait_refills(pool)
+        assert len(pool) == 4
+
+        assert pool.pop() == {"id": 0}
+        assert pool.pop() == {"id": 1}
+        # still at the low-water mark
+        assert not pool.refilling
+        assert pool.pop() == {"id": 2}
+        assert pool.refilling
+        await wait_refills(pool)
+        assert len(pool) == 4
+        assert len(made) == 7
+
+    asyncio.run(run())
+
+
+def test_failed_refill_leaves_the_pool_empty():
+    async def make_bundle():
+        raise RuntimeError("no structure")
+
+    async def run():
+        pool = StructurePool(make_bundle, size=2, low_water=1)
+        pool.refill()
+        await wait_refills(pool)
+        assert len(pool) == 0
+        assert pool.pop() is None
+
+    asyncio.run(run())
+
+
+def test_pools_are_warm_before_the_first_randomize(app, fake_llm):
+    app.STRUCTURE_POOL_SIZE = 2
+
+    async def run():
+        app.warm_structure_pools()
+        await wait_refills(*app.structure_pools.values())
+        # a pool per plan
+        assert len(app.structure_pools) == 2
+        calls = fake_llm.calls
+        bundle = app.pop_story_bundle("user")
+        assert bundle["structure"]["all_parts"]
+        assert fake_llm.calls == calls
+
+    asyncio.run(run())
+
+
+def test_randomize_generates_directly_when_the_pool_is_empty(app, fake_llm):
+    app.STRUCTURE_POOL_SIZE = 2
+    transport = FakeTransport()
+    message = FakeMessage(transport, 1, FakeUser(1, "user"), "/randomize")
+
+    async def run():
+        await MainHandler().randomize_handler(message, app, FakeBot(transport))
+        await app.llm_scheduler.close()
+
+    asyncio.run(run())
+    assert len(app.stories["user"]) == 1
+    assert app.story_structures["user"]["all_parts"]
+    assert app.get_topic("user")
@@ -0,0 +1,41 @@
+import asyncio
+
+from fairytale_bot.user_locks import SingleFlight, UserLocks
+
+
+def test_single_flight_coalesces_calls():
+    calls = []
+
+    async def generate():
+        calls.append(1)
+        await asyncio.sleep(0.01)
+        return "part"
+
+    async def run():
+        single_flight = SingleFlight()
+        results = await asyncio.gather(
+            single_flight.run("user", generate), single_flight.run("user", generate)
+        )
+        assert len(single_flight) == 0
+        return results
+
+    assert asyncio.run(run()) == ["part", "part"]
+    assert len(calls) == 1
+
+
+def test_user_locks_are_released_when_idle():
+    async def run():
+        locks = UserLocks()
+        order = []
+
+        async def work(i):
+            async with locks.lock("user"):
+                order.append(i)
+                await asyncio.sleep(0.01)
+                order.append(i)
+
+        await asyncio.gather(work(1), work(2))
+        assert order == [1, 1, 2, 2]
+        assert len(locks) == 0
+
+    asyncio.run(run())
@@ -0,0 +1,234 @@
+import asyncio
+import os
+import queue
+import sys
+import threading
+from types import ModuleType, SimpleNamespace
+
+from aiohttp import web
+from aiohttp.test_utils import TestClient, TestServer
+
+import fairytale_bot.bot
+from fairytale_bot import webhook
+from fairytale_bot.webhook import (
+    TaskWorkerPool,
+    create_webhook_app,
+    get_update_user_id,
+    run_webhook,
+)
+
+
+def make_update(update_id, user_id):
+    return {
+        "update_id": update_id,
+        "message": {"chat": {"id": user_id}, "from": {"id": user_id}},
+    }
+
+
+def test_get_update_user_id():
+    assert get_update_user_id(make_update(1, 42)) == 42
+    assert get_update_user_id({"callback_query": {"from": {"id": 7}}}) == 7
+    assert get_update_user_id({"my_chat_member": {"chat": {"id": 5}}}) == 5
+    assert get_update_user_id({"update_id": 1}) == 0
+
+
+def test_worker_pool_keeps_user_order():
+    processed = []
+
+    async def handle(update):
+        await asyncio.sleep(0.01 if update["update_id"] % 2 else 0)
+        processed.append(update["update_id"])
+
+    async def run():
+        pool = TaskWorkerPool(handle, workers=4)
+        for i in range(20):
+            pool.submit(make_update(i, user_id=i % 3))
+        await pool.join()
+        await pool.close()
+
+    asyncio.run(run())
+    assert sorted(processed) == list(range(20))
+    for user_id in range(3):
+        user_updates = [i for i in processed if i % 3 == user_id]
+        assert user_updates == sorted(user_updates)
+
+
+def test_worker_pool_doesnt_wait_for_other_users():
+    processed = []
+
+    async def run():
+        blocked = asyncio.Event()
+
+        async def handle(update):
+            if update["update_id"] == 0:
+                await blocked.wait()
+            processed.append(update["update_id"])
+
+        pool = TaskWorkerPool(handle, workers=8)
+        # users 0 and 16 used to share a shard
+        for i, user_id in enumerate([0, 0, 16, 1, 16]):
+            pool.submit(make_update(i, user_id))
+        await asyncio.sleep(0.01)
+        assert sorted(processed) == [2, 3, 4]
+        assert processed.index(2) < processed.index(4)
+        blocked.set()
+        await pool.join()
+        assert processed[3:] == [0, 1]
+        # nothing is kept for the users without updates
+        assert not pool._queues and not pool._tasks
+
+    asyncio.run(run())
+
+
+def test_worker_pool_limits_the_updates_at_once():
+    running, peak = 0, 0
+
+    async def handle(update):
+        nonlocal running, peak
+        running += 1
+        peak = max(peak, running)
+        await asyncio.sleep(0.01)
+        running -= 1
+
+    async def run():
+        pool = TaskWorkerPool(handle, workers=3)
+        for i in range(10):
+            pool.submit(make_update(i, user_id=i))
+        await pool.join()
+
+    asyncio.run(run())
+    assert peak == 3
+
+
+def test_webhook_answers_before_processing():
+    processed = []
+
+    async def run():
+        done = asyncio.Event()
+
+        async def handle(update):
+            await done.wait()
+            processed.append(update["update_id"])
+
+        pool = TaskWorkerPool(handle, workers=2, max_queue=1)
+        app = create_webhook_app(pool, secret_token="secret")
+        async with TestClient(TestServer(app)) as client:
+            headers = {"X-Telegram-Bot-Api-Secret-Token": "secret"}
+            response = await client.post(
+                "/webhook", json=make_update(1, 1), headers=headers
+            )
+            assert response.status == 200
+            assert processed == []
+
+            response = await client.post("/webhook", json=make_update(2, 1))
+            assert response.status == 401
+            for body in ["{not json", "[]"]:
+                response = await client.post("/webhook", data=body, headers=headers)
+                assert response.status == 400
+
+            # the worker holds update 1, the queue holds update 3
+            await client.post("/webhook", json=make_update(3, 1), headers=headers)
+            response = await client.post(
+                "/webhook", json=make_update(4, 1), headers=headers
+            )
+            assert response.status == 503
+
+            done.set()
+            await pool.join()
+        assert processed == [1, 3]
+
+    asyncio.run(run())
+
+
+class FakeBot:
+    def __init__(self):
+        self.calls = []
+        self.session = SimpleNamespace(close=self._close)
+
+    async def set_webhook(self, url, secret_token=None):
+        self.calls.append(("set_webhook", url))
+
+    async def delete_webhook(self):
+        self.calls.append(("delete_webhook",))
+
+    async def _close(self):
+        self.calls.append(("close",))
+
+
+class FakeProcessPool:
+    def __init__(self, processes, workers=16):
+        self.processes = processes
+        self.updates = []
+
+    def start(self):
+        pass
+
+    def submit(self, update):
+        self.updates.append(update)
+
+    async def close(self):
+        pass
+
+
+def test_webhook_with_worker_processes_starts_without_a_dispatcher(monkeypatch):
+    bot = FakeBot()
+    pools = []
+
+    def make_pool(*args, **kwargs):
+        pools.append(FakeProcessPool(*args, **kwargs))
+        return pools[-1]
+
+    async def serve(app):
+        async with TestClient(TestServer(app)) as client:
+            response = await client.post("/webhook", json=make_update(1, 1))
+            assert response.status == 200
+
+    # set directly, getattr would create the real bot
+    monkeypatch.setitem(vars(fairytale_bot.bot), "bot", bot)
+    monkeypatch.setattr(webhook, "ProcessWorkerPool", make_pool)
+    monkeypatch.setattr(web, "run_app", lambda app, **_: asyncio.run(serve(app)))
+
+    run_webhook("https://example.com", processes=2)
+    assert bot.calls == [
+        ("set_webhook", "https://example.com/webhook"),
+        ("delete_webhook",),
+        ("close",),
+    ]
+    assert pools[0].processes == 2
+    assert pools[0].updates == [make_update(1, 1)]
+    # the dispatcher lives in the worker processes only
+    assert "dp" not in vars(fairytale_bot.bot)
+
+
+class FakeDispatcher:
+    def __init__(self, calls):
+        self.calls = calls
+
+    async def emit_startup(self, bot):
+        self.calls.append(("startup",))
+
+    async def emit_shutdown(self, bot):
+        self.calls.append(("shutdown",))
+
+    async def feed_raw_update(self, bot, update):
+        self.calls.append(("update", update["update_id"]))
+
+
+def test_worker_process_runs_the_dispatcher_hooks(monkeypatch):
+    module = ModuleType("fake_dispatcher")
+    module.bot = FakeBot()
+    module.dp = FakeDispatcher(module.bot.calls)
+    monkeypatch.setitem(sys.modules, module.__name__, module)
+    monkeypatch.setenv("FAIRYTALE_MODEL_LIMIT_SHARE", "1")
+    updates, ready = queue.Queue(), threading.Event()
+    for update in [make_update(1, 1), make_update(2, 2), None]:
+        updates.put(update)
+
+    webhook._run_worker_process(updates, ready, module.__name__, workers=2, processes=4)
+    assert ready.is_set()
+    # the processes split the per-model limits
+    assert os.environ["FAIRYTALE_MODEL_LIMIT_SHARE"] == "0.25"
+    calls = module.bot.calls
+    assert calls[0] == ("startup",)
+    assert sorted(calls[1:3]) == [("update", 1), ("update", 2)]
+    assert calls[3:] == [("shutdown",), ("close",)]